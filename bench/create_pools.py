@@ -0,0 +1,95 @@
+'''
+Benchmark of copying the template spec of Desktops.create_pools.
+
+Builds an automated DesktopSpec like get_automated_desktop_spec does and
+copies it once per pool with copy.deepcopy and with Suds.clone, applying
+the overrides of each pool, then checks that a clone marshals to the same
+XML as the template with the same overrides applied in place.
+
+Usage: python bench/create_pools.py [pools]
+'''
+
+import copy
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from era.core import Suds
+from era.pyview import Desktops
+
+WSDL = 'file:///' + os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'misc',
+    'wsdl', 'vdi', 'viewApiService.wsdl').lstrip('/')
+
+
+def get_template_spec(sud):
+    dt_spec = sud.get_object('ns0:DesktopSpec')
+    dt_spec.type = 'AUTOMATED'
+    dt_spec.base = sud.get_object('ns0:DesktopBase')
+    dt_spec.base.name = 'template'
+    dt_spec.base.accessGroup = sud.get_object('ns0:AccessGroupId')
+    dt_spec.base.accessGroup.id = 'AccessGroup/root'
+    dt_settings = sud.get_object('ns0:DesktopSettings')
+    dt_settings.enabled = True
+    dt_settings.logoffSettings = sud.get_object('ns0:DesktopLogoffSettings')
+    dt_settings.logoffSettings.powerPolicy = 'TAKE_NO_POWER_ACTION'
+    dt_settings.displayProtocolSettings = sud.get_object(
+        'ns0:DesktopDisplayProtocolSettings')
+    dt_settings.displayProtocolSettings.defaultDisplayProtocol = 'PCOIP'
+    dt_settings.displayProtocolSettings.pcoipDisplaySettings = sud.get_object(
+        'ns0:DesktopPCoIPDisplaySettings')
+    dt_spec.desktopSettings = dt_settings
+    auto_spec = sud.get_object('ns0:DesktopAutomatedDesktopSpec')
+    auto_spec.provisioningType = 'VIRTUAL_CENTER'
+    auto_spec.vmNamingSpec = sud.get_object('ns0:DesktopVirtualMachineNamingSpec')
+    auto_spec.vmNamingSpec.namingMethod = 'PATTERN'
+    naming = sud.get_object('ns0:DesktopPatternNamingSettings')
+    naming.namingPattern = 'template-{n}'
+    naming.maxNumberOfMachines = 10
+    auto_spec.vmNamingSpec.patternNamingSettings = naming
+    auto_spec.virtualCenter = sud.get_object('ns0:VirtualCenterId')
+    auto_spec.virtualCenter.id = 'VirtualCenter/vc'
+    dt_spec.automatedDesktopSpec = auto_spec
+    return dt_spec
+
+
+def get_overrides(i):
+    return {'pool_name': 'pool-%d' % i, 'maximum_count': 5}
+
+
+def build_specs(copy_spec, template_spec, count):
+    start = time.time()
+    specs = [Desktops.apply_pool_overrides(copy_spec(template_spec),
+                                           get_overrides(i))
+             for i in range(count)]
+    return time.time() - start, specs
+
+
+def marshal(sud, dt_spec):
+    return str(sud.client.service.Desktop_Create.method.binding.input
+               .get_message(sud.client.service.Desktop_Create.method,
+                            (None, dt_spec), {}))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    sud = Suds(WSDL, 'https://localhost/view-vlsi/sdk', 0)
+    template_spec = get_template_spec(sud)
+    cloned_sec, cloned = build_specs(Suds.clone, template_spec, count)
+    print('clone     %d pools: %.3f s, %.3f ms per pool'
+          % (count, cloned_sec, 1000 * cloned_sec / count))
+    deep_count = min(count, 3)
+    deep_sec = build_specs(copy.deepcopy, template_spec, deep_count)[0]
+    print('deepcopy  %d pools: %.3f s, %.3f ms per pool'
+          % (deep_count, deep_sec, 1000 * deep_sec / deep_count))
+    untouched = template_spec.base.name == 'template'
+    same = marshal(sud, cloned[-1]) == marshal(
+        sud, Desktops.apply_pool_overrides(template_spec,
+                                           get_overrides(count - 1)))
+    print('template untouched: %s, same XML: %s' % (untouched, same))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+'''
+Per-call latency of the SOAP transport with and without connection pooling.
+
+Starts a local HTTPS stand-in for a Connection Server, with a throwaway
+self-signed certificate made by the openssl command, and sends the same
+small SOAP request through HttpsTransport, which opens a connection for
+every call, and through PooledHttpsTransport.
+
+Usage: python bench/keepalive.py [calls]
+'''
+
+import BaseHTTPServer
+import os
+import shutil
+import SocketServer
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from suds.transport import Request
+
+from era.core import HttpsTransport
+from era.core import PooledHttpsTransport
+from era.core import SslContext
+
+MESSAGE = ('<?xml version="1.0" encoding="UTF-8"?><SOAP-ENV:Envelope '
+           'xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/">'
+           '<SOAP-ENV:Body><Ping/></SOAP-ENV:Body></SOAP-ENV:Envelope>')
+REPLY = MESSAGE.replace('Ping', 'PingResponse')
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    ## send each response in one write, as a real server does, rather than
+    ## one per header line, which stalls on delayed ACKs when kept alive
+    wbufsize = -1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(REPLY)))
+        self.end_headers()
+        self.wfile.write(REPLY)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        ## clients closing kept-alive connections without a TLS shutdown
+        pass
+
+
+def start_server(cert_dir):
+    cert = os.path.join(cert_dir, 'cert.pem')
+    key = os.path.join(cert_dir, 'key.pem')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(
+            ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+             '-keyout', key, '-out', cert, '-days', '1',
+             '-subj', '/CN=localhost'], stdout=devnull, stderr=devnull)
+    server = Server(('localhost', 0), Handler)
+    server.socket = ssl.wrap_socket(server.socket, keyfile=key,
+                                    certfile=cert, server_side=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def measure(transport, url, calls):
+    headers = {'Content-Type': 'text/xml; charset=utf-8',
+               'SOAPAction': '""'}
+    start = time.time()
+    for _ in range(calls):
+        request = Request(url, MESSAGE)
+        request.headers = dict(headers)
+        transport.send(request)
+    return (time.time() - start) / calls
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    cert_dir = tempfile.mkdtemp(prefix='era-keepalive-bench')
+    try:
+        server = start_server(cert_dir)
+        url = 'https://localhost:%d/view-vlsi/sdk' % server.server_address[1]
+        ctx = SslContext.get_context()
+        for name, transport in (('per-call', HttpsTransport(ctx)),
+                                ('pooled', PooledHttpsTransport(ctx))):
+            transport.options.timeout = 30
+            measure(transport, url, 5)
+            print('%-8s %.3f ms per call'
+                  % (name, 1000 * measure(transport, url, calls)))
+            if hasattr(transport, 'close'):
+                transport.close()
+        server.shutdown()
+        server.server_close()
+    finally:
+        shutil.rmtree(cert_dir)
+
+
+if __name__ == '__main__':
+    main()
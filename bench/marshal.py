@@ -0,0 +1,112 @@
+'''
+Micro-benchmark of typing the values of outgoing requests.
+
+Marshals a Desktop_Create request with a full automated DesktopSpec, as
+create_automated_desktop sends, and a QueryService_Create request, through
+a capturing transport. It reports the time spent in ValuePlugin.marshalled
+per request, next to the time of the whole call, with the per-operation map of typed parameters and with the
+walk of the whole operation it replaced.
+
+Usage: python bench/marshal.py [requests]
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from suds.transport import Transport
+from suds.transport import TransportError
+
+from era.core import MOR
+from era.core import Suds
+from era.core import ValuePlugin
+
+WSDL = 'file:///' + os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'misc',
+    'wsdl', 'vdi', 'viewApiService.wsdl').lstrip('/')
+
+
+class NullTransport(Transport):
+    '''
+    Drops the requests, answering 202 so that suds returns without a reply
+    '''
+
+    def send(self, request):
+        raise TransportError('Accepted', 202)
+
+
+class TimedValuePlugin(ValuePlugin):
+    '''
+    Adds up the time spent typing the values
+    '''
+
+    elapsed = 0
+
+    def marshalled(self, context):
+        start = time.time()
+        ValuePlugin.marshalled(self, context)
+        self.elapsed += time.time() - start
+
+
+def desktop_spec(sud):
+    spec = sud.get_object('ns0:DesktopSpec')
+    spec.type = 'AUTOMATED'
+    spec.base.name = 'bench-pool'
+    auto_spec = sud.get_object('ns0:DesktopAutomatedDesktopSpec')
+    auto_spec.provisioningType = 'VIRTUAL_CENTER'
+    auto_spec.virtualCenterProvisioningSettings.enableProvisioning = True
+    auto_spec.virtualCenterProvisioningSettings.minReadyVMsOnVComposerMaintenance = 0
+    template_id = sud.get_object('ns0:VmTemplateId')
+    template_id.id = 'VmTemplate/vm-42'
+    auto_spec.virtualCenterProvisioningSettings.virtualCenterProvisioningData \
+        .template = template_id
+    auto_spec.virtualCenterManagedCommonSettings.transparentPageSharingScope = 'VM'
+    auto_spec.customizationSettings.customizationType = 'SYS_PREP'
+    spec.automatedDesktopSpec = auto_spec
+    return spec
+
+
+def query_def(sud):
+    filters = []
+    for i in range(20):
+        query_filter = sud.get_object('ns0:QueryFilterEquals')
+        query_filter.memberName = 'base.name'
+        query_filter.value = 'pool-%d' % i
+        filters.append(query_filter)
+    query_filter = sud.get_object('ns0:QueryFilterOr')
+    query_filter.filters = filters
+    ret = sud.get_object('ns0:QueryDefinition')
+    ret.queryEntityType = 'DesktopSummaryView'
+    ret.filter = query_filter
+    return ret
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    sud = Suds(WSDL, 'https://localhost/view-vlsi/sdk', 0)
+    service = sud.get_svc()
+    sud.client.set_options(transport=NullTransport())
+    calls = (('Desktop_Create', lambda: service.Desktop_Create(
+                  MOR.get_mor('Desktop'), desktop_spec(sud))),
+             ('QueryService_Create', lambda: service.QueryService_Create(
+                  MOR.get_mor('QueryService'), query_def(sud))))
+    for mode, typed_params in (('full walk', {}),
+                               ('targeted', sud.value_type.typed_params)):
+        plugin = TimedValuePlugin(typed_params)
+        sud.client.set_options(plugins=[plugin])
+        for name, call in calls:
+            call()
+            plugin.elapsed = 0
+            start = time.time()
+            for _ in range(count):
+                call()
+            elapsed = time.time() - start
+            print('%-9s %-19s %.3f ms typing, %.2f ms per call'
+                  % (mode, name, 1000 * plugin.elapsed / count,
+                     1000 * elapsed / count))
+
+
+if __name__ == '__main__':
+    main()
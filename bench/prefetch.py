@@ -0,0 +1,87 @@
+'''
+Benchmark of the QueryService page read-ahead.
+
+Streams the pages of a query through Queries.pages against a local stub of
+the query service that sleeps for a given latency on every call, while the
+consumer spends some time on each page, with read-ahead depths 0 (off), 1
+and 2.
+
+Usage: python bench/prefetch.py [pages] [latency ms] [processing ms]
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from suds.sudsobject import Object
+
+from era.core import Suds
+from era.pyview import Queries
+
+WSDL = 'file:///' + os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'misc',
+    'wsdl', 'vdi', 'viewApiService.wsdl').lstrip('/')
+
+
+class QueryServiceStub(object):
+    '''
+    Serves a fixed number of pages, sleeping for the latency on every call
+    '''
+
+    def __init__(self, pages, latency_sec):
+        self.pages = pages
+        self.latency_sec = latency_sec
+        self.remaining = {}
+
+    def page(self, query_id):
+        time.sleep(self.latency_sec)
+        ret = Object()
+        ret.id = query_id
+        if self.remaining[query_id]:
+            self.remaining[query_id] -= 1
+            ret.results = [query_id] * 100
+        return ret
+
+    def QueryService_Create(self, mor, query_def):
+        query_id = len(self.remaining)
+        self.remaining[query_id] = self.pages
+        return self.page(query_id)
+
+    def QueryService_GetNext(self, mor, query_id):
+        return self.page(query_id)
+
+    def QueryService_Delete(self, mor, query_id):
+        time.sleep(self.latency_sec)
+        del self.remaining[query_id]
+
+
+class StubSuds(Suds):
+    '''
+    Builds the service objects from the real schema, calls the stub
+    '''
+
+    def __init__(self, service):
+        Suds.__init__(self, WSDL, 'https://localhost/view-vlsi/sdk', 0)
+        self.service = service
+
+    def get_svc(self):
+        return self.service
+
+
+def main():
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    latency_sec = (float(sys.argv[2]) if len(sys.argv) > 2 else 50) / 1000.0
+    processing_sec = (float(sys.argv[3]) if len(sys.argv) > 3 else 40) / 1000.0
+    queries = Queries(StubSuds(QueryServiceStub(pages, latency_sec)))
+    for prefetch in (0, 1, 2):
+        start = time.time()
+        for page in queries.pages(None, 'MachineNamesView', prefetch=prefetch):
+            time.sleep(processing_sec)
+        print('prefetch %d: %d pages in %.2f s'
+              % (prefetch, pages, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+'''
+Micro-benchmark of building service objects from cached prototypes.
+
+Builds 10,000 query filters, as Queries.get_equal_filter does, with the
+suds factory and with Suds.get_object, and a few large DesktopSpec objects
+both ways.
+
+Usage: python bench/prototypes.py [filters]
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from suds.sudsobject import Property
+
+from era.core import MOR
+from era.core import Suds
+
+WSDL = 'file:///' + os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'misc',
+    'wsdl', 'vdi', 'viewApiService.wsdl').lstrip('/')
+
+
+def build_filters(create, count):
+    start = time.time()
+    for i in range(count):
+        query_filter = create('ns0:QueryFilterEquals')
+        query_filter.memberName = 'base.desktop'
+        query_filter.value = MOR.get_mor('Desktop')
+    return time.time() - start
+
+
+def build_specs(create, count):
+    start = time.time()
+    for i in range(count):
+        create('ns0:DesktopSpec')
+    return time.time() - start
+
+
+def build_mors(get_mor, count):
+    start = time.time()
+    for i in range(count):
+        get_mor('VirtualCenter')
+    return time.time() - start
+
+
+def new_mor(mor_type):
+    mor = Property(mor_type)
+    mor._type = mor_type
+    return mor
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    sud = Suds(WSDL, 'https://localhost/view-vlsi/sdk', 0)
+    factory = sud.client.factory
+    for name, create in (('factory', factory.create),
+                         ('prototype', sud.get_object)):
+        create('ns0:DesktopSpec')
+        print('%-9s %d filters: %.3f s, DesktopSpec: %.2f ms'
+              % (name, count, build_filters(create, count),
+                 1000 * build_specs(create, 20) / 20))
+    print('MOR       %d refs: new %.3f s, interned %.3f s'
+          % (count, build_mors(new_mor, count),
+             build_mors(MOR.get_mor, count)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+'''
+Startup benchmark of the on-disk schema cache.
+
+Builds the View API template client in fresh processes, first with an empty
+cache (cold) and then with the cache filled by the first run (warm), and
+the time to build one more Suds once the schema is loaded in a process.
+
+Usage: python bench/schema_cache.py [runs]
+'''
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WSDL = 'file:///' + os.path.join(ROOT, 'misc', 'wsdl', 'vdi',
+                                  'viewApiService.wsdl').lstrip('/')
+
+CHILD = '''
+import sys, time
+sys.path.insert(0, %r)
+from era import core
+core.SchemaCache.ROOT = %r
+start = time.time()
+core.SchemaRegistry().get_client(%r)
+loaded = time.time()
+core.Suds(%r, 'https://localhost/view-vlsi/sdk')
+print('%%f %%f' %% (loaded - start, time.time() - loaded))
+'''
+
+
+def run(cache_dir):
+    out = subprocess.check_output(
+        [sys.executable, '-c', CHILD % (ROOT, cache_dir, WSDL, WSDL)])
+    return [float(x) for x in out.split()]
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    cache_dir = tempfile.mkdtemp(prefix='era-suds-bench')
+    try:
+        cold = run(cache_dir)[0]
+        warm = [run(cache_dir) for i in range(runs)]
+    finally:
+        shutil.rmtree(cache_dir)
+    print('schema load, cold cache:  %.3f s' % cold)
+    print('schema load, warm cache:  %.3f s (best of %d)'
+          % (min(load for load, _ in warm), runs))
+    print('Suds() once loaded:       %.2f ms'
+          % (1000 * min(suds for _, suds in warm)))
+
+
+if __name__ == '__main__':
+    main()
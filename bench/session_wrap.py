@@ -0,0 +1,142 @@
+'''
+Micro-benchmark of the relogin wrapper of ISession methods.
+
+Times a trivial method, and a method reading a few attributes of the session,
+on a session wrapped by the former ISession.__getattribute__, which wrapped
+the method on every access, and on one wrapped once by SessionMeta, with an
+unwrapped class as the baseline.
+
+Usage: python bench/session_wrap.py [calls]
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from era.net import ISession
+
+
+class Plain(object):
+    '''
+    The methods measured, unwrapped
+    '''
+    skip_login = False
+    session_epoch = 0
+    last_alive = 0
+    host = 'localhost'
+    user = 'administrator'
+
+    def get_session_key(self):
+        return 'ViewAPI|' + self.host + '|' + self.user
+
+    def is_logged_in(self):
+        return True
+
+    def login(self):
+        pass
+
+    def logout(self):
+        pass
+
+    def mark_alive(self):
+        self.last_alive = time.time()
+
+    def relogin(self, failed_at, epoch):
+        return False
+
+    def noop(self):
+        pass
+
+    def read_attrs(self):
+        return (self.host, self.user, self.skip_login, self.session_epoch,
+                self.last_alive)
+
+
+class GetAttribute(Plain):
+    '''
+    The former wrapper of ISession, wrapping the method on every access
+    '''
+
+    def __getattribute__(self, name):
+        attr = object.__getattribute__(self, name)
+
+        if hasattr(attr, '__call__') and \
+                        name not in \
+                        ['get_session_key','is_logged_in','login','logout',
+                         'get_connection_params',
+                         'get_settings',
+                         'wait_av',
+                         'init_av_session',
+                         'set_skip_login',
+                         'get_session_lock', 'mark_alive', 'check_logged_in',
+                         'relogin']\
+                and not name.startswith('_')\
+                and not self.skip_login:
+
+            def w(*args, **kwargs):
+                epoch = self.session_epoch
+                try:
+                    ret = attr(*args, **kwargs)
+                except:
+                    exc_info = sys.exc_info()
+                    if not self.relogin(time.time(), epoch):
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                    ret = attr(*args, **kwargs)
+                self.mark_alive()
+                return ret
+
+            return w
+        else:
+            return attr
+
+
+class Meta(ISession):
+    '''
+    The same methods, wrapped once by SessionMeta
+    '''
+    host = 'localhost'
+    user = 'administrator'
+
+    def get_session_key(self):
+        return 'ViewAPI|' + self.host + '|' + self.user
+
+    def is_logged_in(self):
+        return True
+
+    def login(self):
+        pass
+
+    def logout(self):
+        pass
+
+    def noop(self):
+        pass
+
+    def read_attrs(self):
+        return (self.host, self.user, self.skip_login, self.session_epoch,
+                self.last_alive)
+
+
+def time_calls(method, calls):
+    start = time.time()
+    for i in xrange(calls):
+        method()
+    return time.time() - start
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    for name, session in (('unwrapped', Plain()),
+                          ('getattribute', GetAttribute()),
+                          ('metaclass', Meta())):
+        ## look the method up on every call, as callers do
+        noop = time_calls(lambda: session.noop(), calls)
+        read_attrs = time_calls(lambda: session.read_attrs(), calls)
+        print('%-12s noop: %.2f us/call, read_attrs: %.2f us/call'
+              % (name, 1e6 * noop / calls, 1e6 * read_attrs / calls))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+'''
+Memory benchmark of the shared schema registry.
+
+Builds N clients of the View API in a fresh process, once as separate
+suds Clients each parsing the WSDL (as every Suds did before the registry),
+and once as Suds instances hanging off the registry's shared schema, and
+reports the resident memory added per instance. Linux only, as it reads
+/proc/self/statm.
+
+The shared instances are too small to measure a handful at a time, so
+more of them are built.
+
+Usage: python bench/shared_schema.py [separate instances] [shared instances]
+'''
+
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WSDL = 'file:///' + os.path.join(ROOT, 'misc', 'wsdl', 'vdi',
+                                  'viewApiService.wsdl').lstrip('/')
+
+CHILD = '''
+import gc, os, resource, sys, time
+sys.path.insert(0, %r)
+from era import core
+from suds.client import Client
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+wsdl, mode, count = %r, %r, %d
+## the first instance also pays for the shared parts, leave it out
+if mode == 'separate':
+    build = lambda: Client(wsdl)
+else:
+    build = lambda: core.Suds(wsdl, 'https://localhost/view-vlsi/sdk')
+keep = [build()]
+gc.collect()
+before = rss()
+start = time.time()
+for _ in range(count):
+    keep.append(build())
+elapsed = time.time() - start
+gc.collect()
+print('%%d %%f' %% (rss() - before, elapsed))
+'''
+
+
+def run(mode, count):
+    out = subprocess.check_output(
+        [sys.executable, '-c', CHILD % (ROOT, WSDL, mode, count)])
+    added, elapsed = out.split()
+    return int(added), float(elapsed)
+
+
+def main():
+    counts = {'separate': int(sys.argv[1]) if len(sys.argv) > 1 else 5,
+              'shared': int(sys.argv[2]) if len(sys.argv) > 2 else 500}
+    for mode in ('separate', 'shared'):
+        count = counts[mode]
+        added, elapsed = run(mode, count)
+        print('%-8s %8.1f KB and %8.2f ms per instance'
+              % (mode, added / 1024.0 / count, 1000 * elapsed / count))
+
+
+if __name__ == '__main__':
+    main()
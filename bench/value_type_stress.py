@@ -0,0 +1,110 @@
+'''
+Concurrency stress test of the per-thread value typing.
+
+Threads share one Suds client. Each thread repeatedly sets its own value
+type, builds a query filter and marshals a QueryService_Create call. A
+capturing transport records each request on the sending thread instead of
+sending it, and every request is checked to carry its thread's xsi:type.
+Run with --shared-state to put the type back on the shared plugin, as
+before it was kept per thread, and see the check catch the cross-talk.
+
+Usage: python bench/value_type_stress.py [--shared-state] [threads] [calls]
+'''
+
+import os
+import re
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from suds.transport import Transport
+from suds.transport import TransportError
+
+from era.core import MOR
+from era.core import Suds
+from era.core import ValuePlugin
+
+WSDL = 'file:///' + os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'misc',
+    'wsdl', 'vdi', 'viewApiService.wsdl').lstrip('/')
+TYPES = ['xsd:string', 'xsd:int', 'xsd:boolean', 'xsd:long']
+VALUE_TYPE = re.compile(r'<[\w:]*value xsi:type="([^"]+)"')
+
+
+class CapturingTransport(Transport):
+    '''
+    Keeps the last request of each thread, answering 202 so that suds
+    returns without a reply
+    '''
+
+    def __init__(self):
+        Transport.__init__(self)
+        self.local = threading.local()
+
+    def send(self, request):
+        self.local.message = request.message
+        raise TransportError('Accepted', 202)
+
+
+class SharedValuePlugin(ValuePlugin):
+    '''
+    The value type kept on the plugin itself, shared by all threads
+    '''
+
+    shared_type = 'xsd:string'
+
+    @property
+    def value_type(self):
+        return self.shared_type
+
+    def set_value_type(self, val):
+        self.shared_type = val
+
+
+def main():
+    args = sys.argv[1:]
+    shared_state = '--shared-state' in args
+    args = [arg for arg in args if arg != '--shared-state']
+    thread_count = int(args[0]) if args else 8
+    calls = int(args[1]) if len(args) > 1 else 200
+
+    sud = Suds(WSDL, 'https://localhost/view-vlsi/sdk', 0)
+    if shared_state:
+        sud.value_type = SharedValuePlugin(sud.value_type.typed_params)
+        sud.client.set_options(plugins=[sud.value_type])
+    transport = CapturingTransport()
+    sud.client.set_options(transport=transport)
+    service = sud.get_svc()
+    mor = MOR.get_mor('QueryService')
+    errors = []
+
+    def work(value_type):
+        for i in range(calls):
+            sud.set_value_type(value_type)
+            query_filter = sud.get_object('ns0:QueryFilterEquals')
+            query_filter.memberName = 'base.name'
+            query_filter.value = str(i)
+            query_def = sud.get_object('ns0:QueryDefinition')
+            query_def.queryEntityType = 'MachineNamesView'
+            query_def.filter = query_filter
+            service.QueryService_Create(mor, query_def)
+            sent = VALUE_TYPE.findall(transport.local.message)
+            if sent != [value_type]:
+                errors.append((value_type, sent))
+
+    threads = [threading.Thread(target=work, args=(TYPES[i % len(TYPES)],))
+               for i in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    total = thread_count * calls
+    print('%s: %d of %d requests carried another thread\'s type'
+          % ('shared state' if shared_state else 'per thread', len(errors),
+             total))
+    return 1 if errors and not shared_state else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,11 +6,30 @@ Created on Jul 7, 2015
 
 from urllib2 import HTTPSHandler
 import suds.transport.http
+from suds.transport import Reply
+from suds.transport import TransportError
+from suds.sudsobject import Object
 from suds.sudsobject import Property
 from suds.client import Client
+from suds.cache import NoCache
+from suds.cache import ObjectCache
 from suds.plugin import MessagePlugin
+import errno
+import hashlib
+import httplib
 import logging
+import os
+import Queue
+import select
+import socket
 import ssl
+import stat
+import threading
+import types
+import urllib2
+from StringIO import StringIO
+from urllib import addinfourl
+from urllib import url2pathname
 from urlparse import urlparse
 from datetime import datetime
 import time
@@ -66,6 +85,151 @@ class HttpsTransport(suds.transport.http.HttpTransport):
         return handlers
 
 
+class StaleConnection(Exception):
+    """Raised when a kept-alive connection turns out to be closed by the
+    server before it read the request.
+    """
+
+    def __init__(self, error):
+        Exception.__init__(self, str(error))
+        self.error = error
+
+
+class PooledHttpsTransport(HttpsTransport):
+    """A HttpsTransport sending SOAP requests over persistent connections.
+
+    Connections are kept alive and reused across calls, so that bulk
+    operations do not pay a TCP and TLS handshake for every request. At most
+    max_connections connections are open to the target at any time; callers
+    beyond that wait for a connection to be checked in.
+    """
+
+    def __init__(self, context, max_connections=4, **kwargs):
+        """Initialize the PooledHttpsTransport instance.
+        :param context: The SSL context to use.
+        :type context: :class:`ssl.SSLContext`
+        :param max_connections: the maximum number of open connections.
+        :param kwargs: keyword arguments.
+        :see: :class:`HttpsTransport` for the keyword arguments.
+        """
+        HttpsTransport.__init__(self, context, **kwargs)
+        self.max_connections = max_connections
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.idle = Queue.LifoQueue()
+
+    def connect(self, host):
+        """Open a new connection to the given host.
+        """
+        return httplib.HTTPSConnection(host, timeout=self.options.timeout,
+                                       context=self.ssl_context)
+
+    def checkout(self, host):
+        """Fetch an idle connection to the given host, or open a new one.
+        :return: the connection and whether it has been used before.
+        """
+        while True:
+            try:
+                conn_host, conn = self.idle.get_nowait()
+            except Queue.Empty:
+                return self.connect(host), False
+            if conn_host == host and not self.is_dropped(conn):
+                return conn, True
+            conn.close()
+
+    @staticmethod
+    def is_dropped(conn):
+        """Whether the server closed an idle connection. An idle connection
+        has nothing to read, unless the server closed it.
+        """
+        if conn.sock is None:
+            return True
+        try:
+            return bool(select.select([conn.sock], [], [], 0)[0])
+        except (select.error, socket.error):
+            return True
+
+    @staticmethod
+    def exchange(conn, path, message, headers):
+        """Send a request and read its response, closing the connection on
+        failure.
+
+        Only the failures showing that the server closed the connection
+        before processing the request are raised as StaleConnection, since
+        the request is then safe to send again even if it is not idempotent:
+        a reset or broken pipe while writing the request, or no status line
+        at all in response. A timeout, or any failure once the response
+        started, may come after the server acted on the request and is
+        raised as is.
+        :return: the response and its body.
+        """
+        try:
+            try:
+                conn.request('POST', path, message, headers)
+            except socket.timeout:
+                raise
+            except socket.error as e:
+                if e.errno in (errno.ECONNRESET, errno.EPIPE):
+                    raise StaleConnection(e)
+                raise
+            try:
+                resp = conn.getresponse()
+            except httplib.BadStatusLine as e:
+                raise StaleConnection(e)
+            return resp, resp.read()
+        except:
+            conn.close()
+            raise
+
+    def send(self, request):
+        """Send a SOAP request over a pooled connection.
+        """
+        url = urlparse(request.url)
+        path = url.path + ('?' + url.query if url.query else '')
+        u2request = urllib2.Request(request.url, request.message,
+                                    request.headers)
+        self.addcookies(u2request)
+        request.headers.update(u2request.headers)
+
+        self.slots.acquire()
+        try:
+            conn, reused = self.checkout(url.netloc)
+            while True:
+                try:
+                    resp, body = self.exchange(conn, path, request.message,
+                                               dict(u2request.header_items()))
+                    break
+                except StaleConnection as e:
+                    if not reused:
+                        raise e.error
+                    # the server closed the idle connection before reading
+                    # the request, retry once on a fresh one
+                    conn, reused = self.connect(url.netloc), False
+
+            if resp.will_close:
+                conn.close()
+            else:
+                self.idle.put((url.netloc, conn))
+        finally:
+            self.slots.release()
+
+        self.getcookies(addinfourl(StringIO(body), resp.msg, request.url,
+                                   resp.status), u2request)
+        if resp.status in (202, 204):
+            return None
+        if resp.status >= 300:
+            raise TransportError(resp.reason, resp.status, StringIO(body))
+        return Reply(200, resp.msg.dict, body)
+
+    def close(self):
+        """Close all idle connections.
+        """
+        while True:
+            try:
+                self.idle.get_nowait()[1].close()
+            except Queue.Empty:
+                return
+
+
 class ValuePlugin(MessagePlugin):
     '''
     The value attribute of MapEntry is of generic type. This causes the View
@@ -75,19 +239,64 @@ class ValuePlugin(MessagePlugin):
     attribute.
 
     Use set_value_Type(type) to set a specific type before calling the target
-    api.
+    api. The type is kept per thread, so that threads sharing one client do
+    not overwrite each other's type between setting it and calling the api.
+
+    While parsing the WSDL of View API, SUDS also leaves out the xsd name
+    space. This plugin re-adds xsd namespace in the same pass.
     '''
 
-    def __init__(self):
-        self.value_type = 'xsd:string'
+    ## names of the elements whose value child needs a type
+    VALUE_PARENTS = ('updates', 'filter', 'filters', 'values')
+
+    def __init__(self, typed_params=None):
+        '''
+        Constructor
+        :param typed_params: the map of operation to the parameters holding
+        values to type, see get_typed_params. Without it every message is
+        walked entirely.
+        '''
+        self.local = threading.local()
+        self.typed_params = typed_params or {}
+
+    @staticmethod
+    def get_typed_params(client):
+        '''
+        Map every operation of the given client to the kind of its parameters
+        which may hold values to type: 'entry' for MapEntry parameters and
+        'query' for QueryDefinition parameters, whose filter tree holds them
+        :param client:
+        :return:
+        '''
+        ret = {}
+        for port, methods in client.sd[0].ports:
+            for method_name, params in methods:
+                typed = {}
+                for param_name, param in params:
+                    type_name = param.resolve().name
+                    if type_name == 'MapEntry' and \
+                                    param_name in ValuePlugin.VALUE_PARENTS:
+                        typed[param_name] = 'entry'
+                    elif type_name == 'QueryDefinition':
+                        typed[param_name] = 'query'
+                ret[method_name] = typed
+        return ret
+
+    @property
+    def value_type(self):
+        '''
+        The type of the value for requests sent by the current thread
+        :return:
+        '''
+        return getattr(self.local, 'value_type', 'xsd:string')
 
     def set_value_type(self, val):
         '''
-        Set the type of the value
+        Set the type of the value for requests sent by the current thread
         :param val: type of the value
         :return:
         '''
-        self.value_type = val
+        self.local.value_type = val
 
     def add_value_type(self, node):
         '''
@@ -96,38 +305,63 @@ class ValuePlugin(MessagePlugin):
         :return:
         '''
         if node.name == 'value':
-            if node.parent.name in ('updates', 'filter', 'filters', 'values'):
+            if node.parent.name in self.VALUE_PARENTS:
                 ## only set type attribute if it does not exist
                 if len(node.attributes) == 0:
                     node.set('xsi:type', self.value_type)
 
+    def add_filter_value_type(self, node, value_type):
+        '''
+        Internal method, type the values of a query filter tree
+        :param node:
+        :param value_type:
+        :return:
+        '''
+        for child in node.children:
+            if child.name == 'value':
+                if len(child.attributes) == 0:
+                    child.set('xsi:type', value_type)
+            elif child.name in ('filter', 'filters'):
+                self.add_filter_value_type(child, value_type)
+
     def marshalled(self, context):
         '''
         Internal method
         :param context:
         :return:
         '''
-        context.envelope.walk(self.add_value_type)
-
-
-class NameSpacePlugin(MessagePlugin):
-    '''
-    While parsing the WSDL of View API, SUDS leaves out the xsd name space. This
-    plugin re-adds xsd namespace.
-    '''
-
-    def marshalled(self, context):
+        envelope = context.envelope
         ## adding xsd namespace if missing
-        if not 'xsd' in context.envelope.nsprefixes:
-            context.envelope.nsprefixes[
-                'xsd'] = 'http://www.w3.org/2001/XMLSchema'
+        if not 'xsd' in envelope.nsprefixes:
+            envelope.nsprefixes['xsd'] = 'http://www.w3.org/2001/XMLSchema'
+
+        value_type = self.value_type
+        for operation in envelope.getChild('Body').children:
+            typed = self.typed_params.get(operation.name)
+            if typed is None:
+                operation.walk(self.add_value_type)
+                continue
+            ## only visit the parameters which may hold values to type
+            for param in operation.children:
+                kind = typed.get(param.name)
+                if kind == 'entry':
+                    value = param.getChild('value')
+                    if value is not None and len(value.attributes) == 0:
+                        value.set('xsi:type', value_type)
+                elif kind == 'query':
+                    query_filter = param.getChild('filter')
+                    if query_filter is not None:
+                        self.add_filter_value_type(query_filter, value_type)
 
 
 class MOR():
     '''
     Creates a managed object reference, which is usually the first param when
     calling View API.
+    References are only read when marshalling a call, so one instance per
+    type is shared by all callers.
     '''
+    mors = {}
 
     @staticmethod
     def get_mor(mor_type):
@@ -136,8 +370,11 @@ class MOR():
         :param mor_type: The type of the object
         :return:
         '''
-        mor = Property(mor_type)
-        mor._type = mor_type
+        mor = MOR.mors.get(mor_type)
+        if mor is None:
+            mor = Property(mor_type)
+            mor._type = mor_type
+            mor = MOR.mors.setdefault(mor_type, mor)
         return mor
 
 
@@ -154,23 +391,37 @@ class Suds(object):
     logging.getLogger('suds.transport').setLevel(logging.INFO)
     logging.getLogger('suds.client').setLevel(logging.INFO)
 
-    def __init__(self, wsdl, url):
+    ## maximum number of keep-alive connections to one Connection Server
+    MAX_CONNECTIONS = 4
+
+    def __init__(self, wsdl, url, max_connections=MAX_CONNECTIONS):
         '''
         Constructor
+        :param wsdl:
+        :param url:
+        :param max_connections: the size of the keep-alive connection pool,
+        0 to open a new connection for every call
         '''
-        self.value_type = ValuePlugin()
+        self.value_type = ValuePlugin(
+            SchemaRegistry().get_typed_params(wsdl))
         self.wsdl_file = wsdl
         self.url = url
         url_parse = urlparse(url)
         self.host = url_parse.netloc
         ctx = SslContext.get_context()
         tr = None
-        if ctx:
+        if ctx and max_connections:
+            tr = PooledHttpsTransport(ctx, max_connections)
+        elif ctx:
             tr = HttpsTransport(ctx)
-        self.client = Client(self.wsdl_file, location=self.url,
-                             plugins=[self.value_type, NameSpacePlugin()],
-                             timeout=180,
-                             transport=tr)
+        ## the clone shares the parsed schema but has its own options, so
+        ## location, plugins and transport (and its cookie jar) are private
+        self.client = SchemaRegistry().get_client(self.wsdl_file).clone()
+        self.client.set_options(location=self.url,
+                                plugins=[self.value_type],
+                                timeout=180)
+        if tr:
+            self.client.set_options(transport=tr)
 
     def get_svc(self):
         '''
@@ -186,7 +437,33 @@ class Suds(object):
         :param object_type:
         :return:
         '''
-        return self.client.factory.create(object_type)
+        ## cloning a prototype is much cheaper than having the factory walk
+        ## the schema again
+        return Suds.clone(
+            SchemaRegistry().get_prototype(self.wsdl_file, object_type))
+
+    @staticmethod
+    def clone(obj):
+        '''
+        Copy a service object, e.g. a prototype or a spec to reuse. Nested
+        service objects and lists are copied, while the metadata and the
+        other values are shared. The metadata refers to the schema, which a
+        deep copy would copy entirely.
+        :param obj:
+        :return:
+        '''
+        if isinstance(obj, Object):
+            attrs = obj.__dict__.copy()
+            attrs['__keylist__'] = list(obj.__keylist__)
+            for name in obj.__keylist__:
+                if name in attrs:
+                    attrs[name] = Suds.clone(attrs[name])
+            ## suds objects are old-style, build one without calling its
+            ## constructor
+            return types.InstanceType(obj.__class__, attrs)
+        if isinstance(obj, list):
+            return [Suds.clone(item) for item in obj]
+        return obj
 
     def set_value_type(self, v_type):
         '''
@@ -198,6 +475,148 @@ class Suds(object):
         self.value_type.set_value_type(v_type)
 
 
+class SchemaCache():
+    '''
+    On-disk cache of the parsed View API schema.
+
+    Clients are built with cachingpolicy=1, so suds pickles the compiled
+    WSDL/XSD definitions into the cache location rather than only the XML
+    documents, and only the first client ever built from a given WSDL pays
+    for the parsing. See bench/schema_cache.py.
+    The location is keyed by a hash of the WSDL/XSD files, which makes a
+    changed schema miss the cache instead of being served stale, and lets all
+    processes using the same files share it.
+    Loading a pickle can run code, so the cache lives in a directory private
+    to the user, and is not used if anybody else could write to it.
+    '''
+    ROOT = os.path.join(os.path.expanduser('~'), '.cache', 'era-suds')
+
+    @staticmethod
+    def get_root():
+        '''
+        Fetch the cache root, created private to the user
+        :return: None if the root can be written by other users
+        '''
+        root = SchemaCache.ROOT
+        try:
+            os.makedirs(root, 0700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        st = os.lstat(root)
+        if not stat.S_ISDIR(st.st_mode) or (hasattr(os, 'getuid') and (
+                st.st_uid != os.getuid() or st.st_mode & 077)):
+            logging.warning(root + ' is not a directory private to the user,'
+                            ' not caching the schema')
+            return None
+        return root
+
+    @staticmethod
+    def get_key(wsdl):
+        '''
+        Fetch the content hash of the WSDL and the schema files next to it
+        :param wsdl: the WSDL URL
+        :return:
+        '''
+        url_parse = urlparse(wsdl)
+        digest = hashlib.sha1()
+        if url_parse.scheme != 'file':
+            ## remote WSDL, fall back to keying on its URL
+            digest.update(wsdl)
+            return digest.hexdigest()
+
+        wsdl_dir = os.path.dirname(url2pathname(url_parse.path))
+        for name in sorted(os.listdir(wsdl_dir)):
+            if os.path.splitext(name)[1].lower() in ('.wsdl', '.xsd'):
+                digest.update(name)
+                with open(os.path.join(wsdl_dir, name), 'rb') as f:
+                    digest.update(f.read())
+        return digest.hexdigest()
+
+    @staticmethod
+    def get_cache(wsdl):
+        '''
+        Fetch the suds object cache for the given WSDL
+        :param wsdl: the WSDL URL
+        :return:
+        '''
+        root = SchemaCache.get_root()
+        if root is None:
+            return NoCache()
+        location = os.path.join(root, SchemaCache.get_key(wsdl))
+        logging.debug('using suds schema cache ' + location)
+        ## entries never expire, a new schema gets a new location
+        return ObjectCache(location=location)
+
+
+class SchemaRegistry(object):
+    __metaclass__ = Singleton
+    '''
+    Process-wide registry of parsed View API schemas.
+
+    Every WSDL is parsed once per process into a template client. Suds
+    instances clone the template, which shares the read-only WSDL, type
+    model and factory, instead of holding their own copy of the schema.
+    Service objects are built once per type by the template's factory, and
+    handed out as copies of that prototype.
+    '''
+
+    def __init__(self):
+        '''
+        Constructor
+        '''
+        self.clients = {}
+        self.typed_params = {}
+        self.prototypes = {}
+        self.lock = threading.Lock()
+
+    def get_client(self, wsdl):
+        '''
+        Fetch the template client of the given WSDL, parsing it on first use.
+        The template must not be used to call the API, clone it instead.
+        :param wsdl: the WSDL URL
+        :return:
+        '''
+        with self.lock:
+            client = self.clients.get(wsdl)
+            if not client:
+                logging.debug('loading View API schema ' + wsdl)
+                client = Client(wsdl, cache=SchemaCache.get_cache(wsdl),
+                                cachingpolicy=1)
+                self.typed_params[wsdl] = ValuePlugin.get_typed_params(client)
+                self.clients[wsdl] = client
+            return client
+
+    def get_typed_params(self, wsdl):
+        '''
+        Fetch the operations' parameters holding values to type of the given
+        WSDL, see ValuePlugin.get_typed_params
+        :param wsdl: the WSDL URL
+        :return:
+        '''
+        self.get_client(wsdl)
+        return self.typed_params[wsdl]
+
+    def get_prototype(self, wsdl, object_type):
+        '''
+        Fetch the prototype of a service object of the given WSDL, building it
+        on first use. The prototype must not be modified, copy it instead.
+        :param wsdl: the WSDL URL
+        :param object_type:
+        :return:
+        '''
+        key = (wsdl, object_type)
+        prototype = self.prototypes.get(key)
+        if prototype is None:
+            client = self.get_client(wsdl)
+            with self.lock:
+                prototype = self.prototypes.get(key)
+                if prototype is None:
+                    prototype = client.factory.create(object_type)
+                    self.prototypes[key] = prototype
+        return prototype
+
+
 class SslContext():
     '''
     To create unverified context for SSL connection
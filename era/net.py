@@ -4,15 +4,19 @@ import os.path
 import ssl
 import sys
 from contextlib import closing
+from contextlib import contextmanager
 import time
 import abc
 from abc import ABCMeta
+import functools
 import logging
 import atexit
+import threading
 import requests
 import re
 import urllib
 import  shutil
+import types
 
 from core import Singleton
 from util import Timings
@@ -280,8 +284,63 @@ class Http(object):
                 return False
 
 
+class SessionMeta(ABCMeta):
+    '''
+    Metaclass of ISession. The public methods of each class are wrapped once,
+    when the class is created, to login again and retry a call which failed
+    on an expired session.
+    '''
+
+    ## methods managing the session itself, or never calling the server,
+    ## which are never wrapped
+    EXCLUDED = frozenset(['get_session_key', 'is_logged_in', 'login',
+                          'logout', 'get_connection_params', 'get_settings',
+                          'wait_av', 'init_av_session', 'set_skip_login',
+                          'get_session_lock', 'mark_alive', 'check_logged_in',
+                          'relogin', 'new_session', 'force_login',
+                          'get_lookup_stats'])
+
+    def __new__(mcs, name, bases, attrs):
+        for attr_name, attr in attrs.items():
+            if isinstance(attr, types.FunctionType) \
+                    and not attr_name.startswith('_') \
+                    and attr_name not in SessionMeta.EXCLUDED:
+                attrs[attr_name] = SessionMeta.wrap(attr)
+        return super(SessionMeta, mcs).__new__(mcs, name, bases, attrs)
+
+    @staticmethod
+    def wrap(method):
+        '''
+        Wrap a method to check and relogin if necessary
+        :param method:
+        :return:
+        '''
+        @functools.wraps(method)
+        def w(self, *args, **kwargs):
+            if self.skip_login:
+                return method(self, *args, **kwargs)
+            epoch = self.session_epoch
+            try:
+                ret = method(self, *args, **kwargs)
+            except:
+                # see if we are still logged in, if not login then invoke
+                # the call again. Unless somebody logged in again since the
+                # call was made, a session which succeeded a call within
+                # SESSION_TTL_SEC is taken as alive without probing it.
+                exc_info = sys.exc_info()
+                if (self.session_epoch == epoch and time.time()
+                        - self.last_alive < self.SESSION_TTL_SEC) \
+                        or not self.relogin(time.time(), epoch):
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                ret = method(self, *args, **kwargs)
+            self.mark_alive()
+            return ret
+
+        return w
+
+
 class ISession(object):
-    __metaclass__ = ABCMeta
+    __metaclass__ = SessionMeta
     '''
     Session interface
 
@@ -291,6 +350,15 @@ class ISession(object):
     WemHelper.
     '''
     skip_login = False
+    ## a session which succeeded a call within this time is not probed
+    SESSION_TTL_SEC = 60
+    ## time of the last call known to have succeeded, 0 if unknown
+    last_alive = 0
+    ## incremented by each relogin, tells the calls made before it
+    session_epoch = 0
+    ## guards the creation of the session locks
+    session_locks_lock = threading.Lock()
+
     @abc.abstractmethod
     def get_session_key(self):
         '''
@@ -329,40 +397,229 @@ class ISession(object):
         '''
         return
 
-    def __getattribute__(self, name):
+    def force_login(self):
+        '''
+        Login without checking whether the session is logged in first, when
+        it is known not to be. Implementations whose login checks the session
+        override it to skip that check.
+        '''
+        self.login()
+
+    def new_session(self):
+        '''
+        Create another session with the same key and connection parameters,
+        not logged in yet. Required to pool the sessions in the SessionMgr.
+        '''
+        raise Exception(self.get_session_key() + ': Sessions cannot be pooled')
+
+    def get_session_lock(self):
+        '''
+        Fetch the lock of this session, serializing its relogins
+        :return:
+        '''
+        lock = self.__dict__.get('session_lock')
+        if lock is None:
+            with ISession.session_locks_lock:
+                lock = self.__dict__.setdefault('session_lock',
+                                                threading.RLock())
+        return lock
+
+    def mark_alive(self):
         '''
-        Intercept to check and relogin if necessary
-        :param name:
+        Record that the session just succeeded a call
         :return:
         '''
-        attr = object.__getattribute__(self, name)
+        self.last_alive = time.time()
 
-        if hasattr(attr, '__call__') and \
-                        name not in \
-                        ['get_session_key','is_logged_in','login','logout',
-                         'get_connection_params',
-                         'get_settings',
-                         'wait_av',
-                         'init_av_session',
-                         'set_skip_login']\
-                and not name.startswith('_')\
-                and not self.skip_login:
+    def check_logged_in(self):
+        '''
+        Same as is_logged_in, without probing a session which succeeded a
+        call within SESSION_TTL_SEC
+        :return:
+        '''
+        if time.time() - self.last_alive < self.SESSION_TTL_SEC:
+            return True
+        if self.is_logged_in():
+            self.mark_alive()
+            return True
+        self.last_alive = 0
+        return False
+
+    def relogin(self, failed_at, epoch):
+        '''
+        Login again after a failed call, unless the session is still alive.
+        Concurrent failures lead to a single probe and a single login.
+        :param failed_at: the time the call failed
+        :param epoch: the session epoch when the call was made
+        :return: True if the call should be retried
+        '''
+        with self.get_session_lock():
+            if self.session_epoch != epoch:
+                ## somebody logged in again since the call was made
+                return True
+            if self.last_alive >= failed_at:
+                ## alive after the failure, the call failed for another reason
+                return False
+            if self.is_logged_in():
+                self.mark_alive()
+                return False
+            self.last_alive = 0
+            self.force_login()
+            self.session_epoch += 1
+            self.mark_alive()
+            return True
 
-            def w(*args, **kwargs):
-                try:
-                    return attr(*args, **kwargs)
-                except:
-                    # see if we are still logged in, if not login then invoke
-                    # the call again
-                    if not self.is_logged_in():
-                        self.login()
-                        return attr(*args, **kwargs)
-                    else:
-                        raise
 
-            return w
-        else:
-            return attr
+class SessionPool(object):
+    '''
+    Logged-in sessions sharing one session key, at most max_size of them.
+    Sessions idle for longer than idle_sec are logged out, and an idle
+    session is checked before being handed out again.
+    '''
+
+    def __init__(self, max_size, idle_sec):
+        '''
+        Constructor
+        :param max_size:
+        :param idle_sec:
+        '''
+        self.max_size = max(1, max_size)
+        self.idle_sec = idle_sec
+        self.cond = threading.Condition()
+        ## idle sessions with the time they were checked in, most recent last
+        self.idle = []
+        ## all logged-in sessions, idle or checked out
+        self.members = []
+        ## the members plus the sessions being logged in
+        self.size = 0
+
+    def checkout(self, imp, timeout_sec=None):
+        '''
+        Take a logged-in session out of the pool, logging in a new one if
+        none is idle and the pool is not full, otherwise waiting for one to
+        be checked in
+        :param imp: the ISession implementation creating the new sessions
+        :param timeout_sec:
+        :return:
+        '''
+        timeout_sec = timeout_sec or Timings().get_timeout_sec_4()
+        deadline = time.time() + timeout_sec
+        session = None
+        with self.cond:
+            expired = self.evict()
+        self.logout(expired)
+        with self.cond:
+            while not self.idle and self.size >= self.max_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Exception(imp.get_session_key()
+                                    + ': No session available after '
+                                    + str(timeout_sec) + 's')
+                self.cond.wait(remaining)
+            if self.idle:
+                session = self.idle.pop()[0]
+            else:
+                ## hold the slot while logging in
+                self.size += 1
+
+        created = session is None
+        try:
+            if session is None:
+                logging.debug(imp.get_session_key() + ': Adding pooled session')
+                session = imp.new_session()
+                session.force_login()
+                with self.cond:
+                    self.members.append(session)
+            elif not session.check_logged_in():
+                session.force_login()
+        except:
+            self.drop(session, created)
+            raise
+        return session
+
+    def checkin(self, session, discard=False):
+        '''
+        Return a checked out session to the pool
+        :param session:
+        :param discard: True to drop the session rather than reuse it, e.g.
+        when it is known to be broken
+        :return:
+        '''
+        if discard:
+            self.drop(session)
+            self.logout([session])
+            return
+        with self.cond:
+            ## dropped by logout_all while checked out
+            if session not in self.members:
+                return
+            self.idle.append((session, time.time()))
+            self.cond.notify()
+            expired = self.evict()
+        self.logout(expired)
+
+    def drop(self, session, reserved=False):
+        '''
+        Remove a checked out session from the pool
+        :param session: None for a session which was never created
+        :param reserved: whether the session held a slot without being a
+        member yet, i.e. it failed to login
+        :return:
+        '''
+        with self.cond:
+            if session in self.members:
+                self.members.remove(session)
+                self.size -= 1
+            elif reserved:
+                self.size -= 1
+            self.cond.notify()
+
+    def evict(self):
+        '''
+        Drop the sessions idle for too long, the lock being held
+        :return: the dropped sessions, to be logged out
+        '''
+        now = time.time()
+        expired = [session for session, checked_in in self.idle
+                   if now - checked_in > self.idle_sec]
+        if expired:
+            self.idle = [(session, checked_in)
+                         for session, checked_in in self.idle
+                         if session not in expired]
+            for session in expired:
+                self.members.remove(session)
+                self.size -= 1
+            self.cond.notify_all()
+        return expired
+
+    def logout_all(self):
+        '''
+        Log off all sessions of the pool, including the checked out ones
+        :return:
+        '''
+        with self.cond:
+            members = self.members
+            self.size -= len(members)
+            self.members = []
+            self.idle = []
+            self.cond.notify_all()
+        self.logout(members)
+
+    @staticmethod
+    def logout(sessions):
+        '''
+        Log off the given sessions, ignoring failures
+        :param sessions:
+        :return:
+        '''
+        for session in sessions:
+            logging.debug(session.get_session_key()
+                          + ': Logging off pooled session')
+            try:
+                session.logout()
+            except:
+                logging.debug(session.get_session_key()
+                              + ': Failed to log off pooled session')
 
 
 class SessionMgr(object):
@@ -376,39 +633,138 @@ class SessionMgr(object):
     maintain. This is a singleton class and guarantees there is only one
     instance at any moment. This single instance nature enables a single active
     session for each user per service host per service type.
+
+    For parallel consumers, it also keeps a SessionPool of up to POOL_SIZE
+    logged-in sessions per key, see pooled_session.
     '''
 
+    ## default maximum number of pooled sessions per key
+    POOL_SIZE = 4
+    ## pooled sessions idle for longer than this are logged off
+    POOL_IDLE_SEC = 300
+
     def __init__(self):
         '''
         Constructor
         '''
         self.sessions = {}
+        self.pools = {}
+        ## serializes the logins of each key, held without self.lock
+        self.key_locks = {}
+        self.lock = threading.RLock()
+
+    def get_key_lock(self, session_key):
+        '''
+        Fetch the lock serializing the logins of the given key
+        @param session_key:
+        '''
+        with self.lock:
+            return self.key_locks.setdefault(session_key, threading.RLock())
 
     def get_session(self, imp):
         '''
         This is used to fetch an existing or establishing a new session. The
         caller should pass an implementation of ISession, which contains a key
-        in the format 'service type'|'service host'|'API user'.
+        in the format 'service type'|'service host'|'API user'. Concurrent
+        calls for the same key wait for a single login, while other keys and
+        the pools are not held up by it.
         @param imp:
         '''
-        session = None
-        if imp.get_session_key() in self.sessions:
-            s = self.sessions[imp.get_session_key()]
-            try:
-                if s.is_logged_in():
-                    logging.debug(imp.get_session_key() + ': Reusing session')
-                    session = s
-            except:
-                logging.debug(imp.get_session_key()
-                              + ": Failed to reuse existing session")
+        session_key = imp.get_session_key()
+        with self.get_key_lock(session_key):
+            with self.lock:
+                s = self.sessions.get(session_key)
+            session = None
+            if s is not None:
+                try:
+                    if s.check_logged_in():
+                        logging.debug(session_key + ': Reusing session')
+                        session = s
+                except:
+                    logging.debug(session_key
+                                  + ": Failed to reuse existing session")
 
-        if not session:
-            imp.login()
-            self.sessions[imp.get_session_key()] = imp
-            session = imp
+            if not session:
+                imp.login()
+                with self.lock:
+                    self.sessions[session_key] = imp
+                session = imp
 
-        return session
+            return session
+
+    def get_pool(self, session_key, max_size=None):
+        '''
+        Fetch the session pool of the given key, created on first use
+        @param session_key:
+        @param max_size: the size of a new pool, POOL_SIZE if None
+        '''
+        with self.lock:
+            pool = self.pools.get(session_key)
+            if pool is None:
+                pool = self.pools[session_key] = SessionPool(
+                    max_size or SessionMgr.POOL_SIZE, SessionMgr.POOL_IDLE_SEC)
+            return pool
+
+    def checkout(self, imp, max_size=None, timeout_sec=None):
+        '''
+        Take a logged-in session of the key of imp out of its pool. New
+        sessions are created by imp.new_session. The session must be
+        returned with checkin.
+        @param imp:
+        @param max_size: the size of the pool if it does not exist yet
+        @param timeout_sec: how long to wait for a session if all of them
+        are checked out
+        '''
+        return self.get_pool(imp.get_session_key(), max_size) \
+            .checkout(imp, timeout_sec)
 
+    def checkin(self, session, discard=False):
+        '''
+        Return a session taken with checkout to its pool
+        @param session:
+        @param discard: True to log it off rather than reuse it
+        '''
+        self.get_pool(session.get_session_key()).checkin(session, discard)
+
+    @staticmethod
+    def is_broken(session, error):
+        '''
+        Whether a session which raised the given error should be discarded,
+        i.e. the error is of the transport or the session is logged off
+        @param session:
+        @param error:
+        '''
+        if isinstance(error, (IOError, httplib.HTTPException)):
+            return True
+        try:
+            return not session.is_logged_in()
+        except:
+            return True
+
+    @contextmanager
+    def pooled_session(self, imp, max_size=None, timeout_sec=None):
+        '''
+        Context manager checking out a pooled session for the duration of the
+        block, e.g.
+
+        with SessionMgr().pooled_session(view) as session:
+            session.count_machines(names)
+
+        A session which raised a transport or session error is discarded
+        rather than returned to the pool.
+        @param imp:
+        @param max_size:
+        @param timeout_sec:
+        '''
+        session = self.checkout(imp, max_size, timeout_sec)
+        broken = False
+        try:
+            yield session
+        except Exception as e:
+            broken = self.is_broken(session, e)
+            raise
+        finally:
+            self.checkin(session, broken)
 
     def logout_all_sessions(self):
         '''
@@ -416,9 +772,14 @@ class SessionMgr(object):
         test. This will go through all existing sessions being maintained
         in this session manager and call their logoffs.
         '''
-        for session_key, session in self.sessions.iteritems():
+        with self.lock:
+            sessions = self.sessions.items()
+            pools = self.pools.values()
+        for session_key, session in sessions:
             logging.debug(session_key + ': Logging off')
             session.logout()
+        for pool in pools:
+            pool.logout_all()
 
 
     @staticmethod
@@ -7,8 +7,14 @@ Created on Oct 9, 2015
 import abc
 import base64
 from collections import deque as stack
+from collections import OrderedDict
+import json
 import logging
-from datetime import datetime
+import os
+from itertools import islice
+import Queue
+import sys
+import threading
 import time
 
 from net import ISession
@@ -16,9 +22,33 @@ from util import String
 from util import Validation
 from core import Suds
 from core import MOR
+from core import Waiter
+from suds import WebFault
 from util import Timings
 
 
+class ProbeLogFilter(logging.Filter):
+    '''
+    Drops the records of the threads probing their session, so that a failed
+    probe does not log errors
+    '''
+
+    def __init__(self):
+        '''
+        Constructor
+        '''
+        logging.Filter.__init__(self)
+        self.local = threading.local()
+
+    def filter(self, record):
+        return not getattr(self.local, 'probing', False)
+
+
+## quiets suds.client while View.is_logged_in probes the session
+probe_log_filter = ProbeLogFilter()
+logging.getLogger('suds.client').addFilter(probe_log_filter)
+
+
 class UserStats(object):
     '''
     User status container
@@ -153,18 +183,956 @@ class UserStats(object):
                + str(self.get_total_logon_time())
 
 
+class LookupCache(object):
+    '''
+    Cache of name to ID lookups, bounded in size and age of the entries.
+    Entries are keyed by the kind of entity and its name. Failed lookups are
+    not cached, so that a newly created entity is found right away.
+    '''
+
+    ## seconds an entry stays valid
+    TTL_SEC = 60
+    ## maximum number of entries, the least recently used are evicted
+    MAX_SIZE = 1024
+
+    def __init__(self, ttl_sec=TTL_SEC, max_size=MAX_SIZE):
+        '''
+        Constructor
+        :param ttl_sec:
+        :param max_size:
+        '''
+        self.ttl_sec = ttl_sec
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, kind, name, loader):
+        '''
+        Fetch the cached value, or load and cache it
+        :param kind: the kind of entity, e.g. desktop
+        :param name:
+        :param loader: called without arguments to look the value up
+        :return:
+        '''
+        key = (kind, name)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry and entry[0] > time.time():
+                self.entries[key] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self.generation
+
+        value = loader()
+        if value is not None:
+            with self.lock:
+                ## skip values which may have been invalidated while loading
+                if generation == self.generation:
+                    self.put(kind, name, value)
+        return value
+
+    def peek(self, kind, name):
+        '''
+        Fetch the cached value without loading it nor counting a hit or a
+        miss, e.g. to find the names a batched lookup still has to load
+        :param kind:
+        :param name:
+        :return: None if not cached
+        '''
+        key = (kind, name)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry and entry[0] > time.time():
+                self.entries[key] = entry
+                return entry[1]
+        return None
+
+    def put(self, kind, name, value, ttl_sec=None):
+        '''
+        Cache a value
+        :param kind:
+        :param name:
+        :param value:
+        :param ttl_sec: the seconds the entry stays valid, None for the
+        cache's TTL
+        :return:
+        '''
+        key = (kind, name)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + (ttl_sec or self.ttl_sec),
+                                 value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, kind, name=None):
+        '''
+        Drop the cached values of the given kind
+        :param kind:
+        :param name: the name to drop, None to drop all of the kind
+        :return:
+        '''
+        with self.lock:
+            self.generation += 1
+            for key in self.entries.keys():
+                if key[0] == kind and (name is None or key[1] == name):
+                    del self.entries[key]
+
+    def clear(self):
+        '''
+        Drop all cached values
+        :return:
+        '''
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def get_stats(self):
+        '''
+        Fetch the hit/miss counters and the current size
+        :return:
+        '''
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self.entries)}
+
+
+class PrincipalCache(LookupCache):
+    '''
+    Cache of AD users and groups, keyed by domain and login name. Names that
+    were not found are cached too, for a shorter time, so that a missing
+    user in a large batch is only searched for once.
+    '''
+
+    TTL_SEC = 600
+    MAX_SIZE = 16384
+    ## seconds a name that was not found stays cached
+    NEGATIVE_TTL_SEC = 60
+
+    def __init__(self, ttl_sec=TTL_SEC, max_size=MAX_SIZE):
+        super(PrincipalCache, self).__init__(ttl_sec, max_size)
+
+
+class VCInventory(object):
+    '''
+    Snapshot of the base image VMs, templates and snapshots of one VC,
+    indexed by lowercase name. Each list is fetched once and served from the
+    index until the snapshot expires or is refreshed. A name missing from an
+    index listed earlier lists it again once before being reported as not
+    found. When several entities have the same name, the first one listed is
+    kept.
+    '''
+
+    ## seconds the snapshot stays valid
+    TTL_SEC = 300
+
+    def __init__(self, viewapi, vc_id, ttl_sec=TTL_SEC):
+        '''
+        Constructor
+        :param viewapi: the View API service
+        :param vc_id:
+        :param ttl_sec:
+        '''
+        self.viewapi = viewapi
+        self.vc_id = vc_id
+        self.ttl_sec = ttl_sec
+        self.lock = threading.RLock()
+        self.refresh()
+
+    def refresh(self):
+        '''
+        Drop the snapshot, the lists are fetched again on next use
+        :return:
+        '''
+        with self.lock:
+            self.expires = time.time() + self.ttl_sec
+            ## index of each list, keyed by 'vm', 'template' or the id of the
+            ## VM whose snapshots are listed
+            self.indexes = {}
+
+    @staticmethod
+    def index(entities, get_name):
+        '''
+        Index the entities by lowercase name, keeping the first of each name
+        :param entities:
+        :param get_name:
+        :return:
+        '''
+        ret = {}
+        for entity in entities or []:
+            ret.setdefault(get_name(entity).lower(), entity)
+        return ret
+
+    def check_expired(self):
+        '''
+        Refresh the snapshot if it has expired
+        :return:
+        '''
+        if self.expires <= time.time():
+            self.refresh()
+
+    def get_index(self, key, fetch, refetch=False):
+        '''
+        Fetch the index of a list, listing it if not in the snapshot
+        :param key:
+        :param fetch: lists the entities and indexes them
+        :param refetch: list again even if in the snapshot
+        :return: the index, and whether it has just been listed
+        '''
+        with self.lock:
+            self.check_expired()
+            ret = self.indexes.get(key)
+            if ret is not None and not refetch:
+                return ret, False
+            ret = fetch()
+            self.indexes[key] = ret
+            return ret, True
+
+    def lookup(self, key, fetch, name):
+        '''
+        Look up an entity by name. A miss lists again once if the index was
+        not just listed, the entity may have been created since.
+        :param key:
+        :param fetch:
+        :param name:
+        :return: None if not found
+        '''
+        with self.lock:
+            index, fresh = self.get_index(key, fetch)
+            ret = index.get(name.lower())
+            if ret is None and not fresh:
+                index, fresh = self.get_index(key, fetch, refetch=True)
+                ret = index.get(name.lower())
+            return ret
+
+    def get_vm(self, vm_name):
+        '''
+        Fetch the base image VM object given its name
+        :param vm_name:
+        :return:
+        '''
+        return self.lookup('vm', lambda: self.index(
+            self.viewapi.BaseImageVm_List(MOR.get_mor('BaseImageVm'),
+                                          self.vc_id),
+            lambda vm: vm.name), vm_name)
+
+    def get_template(self, template_name):
+        '''
+        Fetch the template object given its name
+        :param template_name:
+        :return:
+        '''
+        return self.lookup('template', lambda: self.index(
+            self.viewapi.VmTemplate_List(MOR.get_mor('VmTemplate'),
+                                         self.vc_id),
+            lambda template: template.name), template_name)
+
+    def fetch_snapshots(self, vm_id):
+        '''
+        List the snapshots of the given VM, indexed by lowercase path
+        :param vm_id:
+        :return:
+        '''
+        return self.index(self.viewapi.BaseImageSnapshot_List(
+            MOR.get_mor('BaseImageSnapshot'), vm_id),
+            lambda snapshot: snapshot.path)
+
+    def get_snapshots(self, vm_id):
+        '''
+        Fetch the snapshots of the given VM, indexed by lowercase path
+        :param vm_id:
+        :return:
+        '''
+        return self.get_index(vm_id.id,
+                              lambda: self.fetch_snapshots(vm_id))[0]
+
+    def get_snapshot(self, vm_id, ss_path):
+        '''
+        Fetch the snapshot object of the given VM given its path
+        :param vm_id:
+        :param ss_path:
+        :return:
+        '''
+        return self.lookup(vm_id.id, lambda: self.fetch_snapshots(vm_id),
+                           ss_path)
+
+
+class VCTree(object):
+    '''
+    Index of a VC inventory tree, e.g. the VM folders of a datacenter. The
+    tree is walked once and its nodes are indexed by lowercase name, and by
+    lowercase path below the root, e.g. dept/team/pools. When several nodes
+    have the same name, the first one found by the depth first search of the
+    original lookups is kept.
+    '''
+
+    def __init__(self, root, get_name, get_id):
+        '''
+        Constructor
+        :param root:
+        :param get_name: fetches the name of a node
+        :param get_id: fetches the ID object of a node, None if it has none
+        '''
+        self.root_id = get_id(root)
+        self.ids = {}
+        self.paths = {}
+        ## parent path of each node being walked
+        s = stack([(root, None)])
+        while len(s):
+            e, parent_path = s.pop()
+            name = get_name(e).lower()
+            if parent_path is None:
+                path = ''
+            elif parent_path:
+                path = parent_path + '/' + name
+            else:
+                path = name
+            e_id = get_id(e)
+            if e_id is not None:
+                self.ids.setdefault(name, e_id)
+                if parent_path is not None:
+                    self.paths.setdefault(path, e_id)
+
+            if 'children' in e:
+                for child in e.children:
+                    s.append((child, path))
+
+    def get_id(self, name):
+        '''
+        Fetch the ID object of the node given its name, or its path below the
+        root when the name contains a /
+        :param name:
+        :return:
+        '''
+        name = name.lower()
+        if '/' in name:
+            return self.paths.get(name.strip('/'))
+        return self.ids.get(name)
+
+
+class DependencyResolver(object):
+    '''
+    Resolves a small graph of dependent lookups, e.g. a VC, then its base
+    image, then the datacenter of the image. A lookup starts as soon as the
+    lookups it depends on are resolved, so independent lookups run
+    concurrently and resolving takes about as long as the longest chain of
+    dependent lookups rather than the sum of all of them.
+    '''
+
+    ## maximum number of lookups running at once
+    MAX_WORKERS = 4
+
+    def __init__(self, max_workers=MAX_WORKERS):
+        '''
+        Constructor
+        :param max_workers:
+        '''
+        self.max_workers = max_workers
+        self.lookups = OrderedDict()
+
+    def add(self, name, lookup, deps=(), message=None):
+        '''
+        Add a lookup. Dependencies must be added before the lookups that
+        depend on them.
+        :param name: the name of the resolved value
+        :param lookup: called with the values of the dependencies
+        :param deps: the names of the lookups this one depends on
+        :param message: the error raised if the value is empty, None to
+        accept any value
+        :return:
+        '''
+        for dep in deps:
+            if dep not in self.lookups:
+                raise Exception('Unknown dependency ' + dep + ' of ' + name)
+        self.lookups[name] = (lookup, tuple(deps), message)
+
+    def run(self, name, args, done):
+        '''
+        Run a lookup, posting its value or error to the done queue
+        :param name:
+        :param args: the values of the dependencies
+        :param done:
+        :return:
+        '''
+        lookup, _, message = self.lookups[name]
+        try:
+            value = lookup(*args)
+            if message:
+                Validation.validate_param(value, message)
+            done.put((name, value, None))
+        except Exception:
+            done.put((name, None, sys.exc_info()))
+
+    def resolve(self):
+        '''
+        Run all lookups. Once a lookup fails no more lookups are started, and
+        its error is raised when the running ones are done.
+        :return: the value of each lookup, keyed by name
+        '''
+        values = {}
+        pending = OrderedDict(self.lookups)
+        running = 0
+        done = Queue.Queue()
+        error = None
+        while True:
+            if error is None:
+                for name, (_, deps, _) in pending.items():
+                    if running >= self.max_workers:
+                        break
+                    if all(dep in values for dep in deps):
+                        del pending[name]
+                        running += 1
+                        worker = threading.Thread(
+                            target=self.run,
+                            args=(name, [values[dep] for dep in deps], done))
+                        worker.daemon = True
+                        worker.start()
+            if not running:
+                break
+            name, value, exc_info = done.get()
+            running -= 1
+            if exc_info:
+                error = error or exc_info
+            else:
+                values[name] = value
+        if error:
+            raise error[0], error[1], error[2]
+        return values
+
+
+class BatchRunner(object):
+    '''
+    Runs a function over many items on a bounded number of threads. A failed
+    item does not stop the others, its error is reported with the results.
+    '''
+
+    ## maximum number of items processed at once
+    MAX_CONCURRENCY = 8
+
+    def __init__(self, max_concurrency=MAX_CONCURRENCY):
+        '''
+        Constructor
+        :param max_concurrency:
+        '''
+        self.max_concurrency = max(1, max_concurrency)
+
+    def run(self, func, items):
+        '''
+        Call the function with each item
+        :param func:
+        :param items:
+        :return: the (value, error) of each item in order, the error being
+        None if the call succeeded
+        '''
+        items = list(items)
+        ret = [None] * len(items)
+        todo = Queue.Queue()
+        for i, item in enumerate(items):
+            todo.put((i, item))
+
+        def work():
+            while True:
+                try:
+                    i, item = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    ret[i] = (func(item), None)
+                except Exception as e:
+                    ret[i] = (None, e)
+
+        workers = [threading.Thread(target=work)
+                   for _ in range(min(self.max_concurrency, len(items)))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return ret
+
+
+class DeleteJournal(object):
+    '''
+    Progress of a bulk delete, kept in a file so that an interrupted run can
+    be resumed without deleting the same entities again. Each deleted entity
+    is appended to the file as one line of JSON.
+    '''
+
+    def __init__(self, path=None):
+        '''
+        Constructor
+        :param path: the journal file, None to only keep the progress in
+        memory
+        '''
+        self.path = path
+        self.lock = threading.Lock()
+        self.deleted = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    ## the last line may be cut short by an interruption
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.deleted[entry['id']] = entry['name']
+
+    def is_deleted(self, entity_id):
+        '''
+        Whether the entity was deleted
+        :param entity_id: the id string of the entity
+        :return:
+        '''
+        with self.lock:
+            return entity_id in self.deleted
+
+    def add(self, entity_id, name):
+        '''
+        Record a deleted entity
+        :param entity_id: the id string of the entity
+        :param name:
+        :return:
+        '''
+        with self.lock:
+            self.deleted[entity_id] = name
+            if self.path:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps({'id': entity_id, 'name': name})
+                            + '\n')
+
+
+class StateSubscription(object):
+    '''
+    A waiter registered with a StatePoller
+    '''
+
+    def __init__(self, predicate):
+        '''
+        Constructor
+        :param predicate: called with each fetched state, returns a true
+        value once the wait is over
+        '''
+        self.predicate = predicate
+        self.event = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+
+class StatePoller(object):
+    '''
+    Polls states on behalf of many waiters on one background thread. Waiters
+    on the same key share a single fetch per tick, and each of them is woken
+    as soon as its predicate holds. The interval starts at min_interval_sec,
+    and doubles up to max_interval_sec while no waiter is woken. The thread
+    ends when nobody waits.
+    '''
+
+    MIN_INTERVAL_SEC = 1
+
+    def __init__(self, min_interval_sec=MIN_INTERVAL_SEC,
+                 max_interval_sec=None):
+        '''
+        Constructor
+        :param min_interval_sec:
+        :param max_interval_sec:
+        '''
+        self.min_interval_sec = min_interval_sec
+        self.max_interval_sec = max_interval_sec \
+            or Timings().get_task_wait_interval_sec_3()
+        self.interval_sec = min_interval_sec
+        self.cond = threading.Condition()
+        ## fetch function and subscriptions of each key
+        self.subscriptions = {}
+        self.thread = None
+
+    def wait(self, key, fetch, predicate, max_wait_sec=None, message=None):
+        '''
+        Wait until the predicate holds for the state fetched for the key
+        :param key: identifies the state, waiters on equal keys share the
+        fetches
+        :param fetch: called without arguments to fetch the state, only the
+        function of the first waiter on the key is used
+        :param predicate: called with the state, returns a true value once
+        the wait is over
+        :param max_wait_sec:
+        :param message: a message to log
+        :return: the value returned by the predicate, None if timed out
+        '''
+        max_wait_sec = max_wait_sec or Timings().get_timeout_sec_4()
+        if message:
+            logging.debug(message + ' - timeout=' + str(max_wait_sec) + 's')
+        subscription = StateSubscription(predicate)
+        with self.cond:
+            self.subscriptions.setdefault(key, (fetch, []))[1] \
+                .append(subscription)
+            ## check the new waiter right away
+            self.interval_sec = self.min_interval_sec
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            else:
+                self.cond.notify()
+        subscription.event.wait(max_wait_sec)
+        with self.cond:
+            if not subscription.event.is_set():
+                self.remove(key, [subscription])
+                if message:
+                    logging.debug(message + ' - timed out.')
+                return None
+        if subscription.exc_info:
+            exc_info = subscription.exc_info
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return subscription.value
+
+    def remove(self, key, subscriptions):
+        '''
+        Unregister waiters, the lock being held
+        :param key:
+        :param subscriptions:
+        :return:
+        '''
+        fetch, waiting = self.subscriptions[key]
+        waiting[:] = [subscription for subscription in waiting
+                      if subscription not in subscriptions]
+        if not waiting:
+            del self.subscriptions[key]
+
+    def run(self):
+        '''
+        Poll until nobody waits
+        :return:
+        '''
+        while True:
+            with self.cond:
+                if not self.subscriptions:
+                    self.thread = None
+                    return
+                tick = [(key, fetch, list(waiting)) for key, (fetch, waiting)
+                        in self.subscriptions.items()]
+            woken = False
+            for key, fetch, waiting in tick:
+                done = []
+                try:
+                    state = fetch()
+                except Exception:
+                    exc_info = sys.exc_info()
+                    for subscription in waiting:
+                        subscription.exc_info = exc_info
+                    done = waiting
+                else:
+                    for subscription in waiting:
+                        try:
+                            subscription.value = subscription.predicate(state)
+                        except Exception:
+                            subscription.exc_info = sys.exc_info()
+                        if subscription.value or subscription.exc_info:
+                            done.append(subscription)
+                if done:
+                    woken = True
+                    with self.cond:
+                        if key in self.subscriptions:
+                            self.remove(key, done)
+                        for subscription in done:
+                            subscription.event.set()
+            with self.cond:
+                if woken:
+                    self.interval_sec = self.min_interval_sec
+                else:
+                    self.interval_sec = min(self.max_interval_sec,
+                                            self.interval_sec * 2)
+                if self.subscriptions:
+                    self.cond.wait(self.interval_sec)
+
+
+class RollingWaves(object):
+    '''
+    Runs an operation which takes machines offline, such as a refresh or a
+    recompose, over many pools or farms in waves. A wave holds at most
+    max_concurrency targets and at most max_offline_pct percent of all their
+    machines, a target larger than that going alone. The next wave starts
+    once the machines of the previous one are back online: available, or
+    holding the session of a user who reconnected. Machines which were
+    already offline before the wave, e.g. in error or in maintenance, are
+    not waited for.
+    '''
+
+    ## maximum number of targets per wave
+    MAX_CONCURRENCY = 4
+    ## maximum percentage of the machines offline at once
+    MAX_OFFLINE_PCT = 25
+    ## the machine states counting as back online
+    ONLINE_STATES = ('AVAILABLE', 'CONNECTED', 'DISCONNECTED')
+
+    def __init__(self, operation, count_states,
+                 max_concurrency=MAX_CONCURRENCY,
+                 max_offline_pct=MAX_OFFLINE_PCT, max_wait_sec=None,
+                 delay_sec=None, poller=None, online_states=ONLINE_STATES):
+        '''
+        Constructor
+        :param operation: called with each target name to start the
+        operation on it
+        :param count_states: called with a list of target names, returns the
+        machine count of each state of each of them
+        :param max_concurrency:
+        :param max_offline_pct:
+        :param max_wait_sec: how long to wait for a wave to be available
+        :param delay_sec: the time left to the operation to take the machines
+        offline before the first availability check
+        :param poller: the StatePoller checking the availability, shared with
+        other waits on the same targets
+        :param online_states: the machine states counting as back online
+        '''
+        self.operation = operation
+        self.count_states = count_states
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_offline_pct = max_offline_pct
+        self.max_wait_sec = max_wait_sec or Timings().get_timeout_sec_4()
+        self.delay_sec = delay_sec or Timings().get_task_wait_interval_sec_3()
+        self.poller = poller or StatePoller()
+        self.online_states = frozenset(online_states)
+
+    def plan(self, names):
+        '''
+        Split the targets into waves, keeping their order
+        :param names:
+        :return: the list of target names of each wave
+        '''
+        counts = self.count_states(names)
+        capacity = dict((name, sum(counts.get(name, {}).values()))
+                        for name in names)
+        budget = sum(capacity.values()) * self.max_offline_pct / 100.0
+        waves = []
+        wave = []
+        offline = 0
+        for name in names:
+            if wave and (len(wave) >= self.max_concurrency
+                         or offline + capacity[name] > budget):
+                waves.append(wave)
+                wave = []
+                offline = 0
+            wave.append(name)
+            offline += capacity[name]
+        if wave:
+            waves.append(wave)
+        return waves
+
+    def count_offline(self, counts):
+        '''
+        Count the machines of each target which are not online
+        :param counts: the machine count of each state of each target
+        :return:
+        '''
+        return dict((name, sum(count for state, count in states.items()
+                               if state not in self.online_states))
+                    for name, states in counts.items())
+
+    def wait_available(self, names, offline_before=None):
+        '''
+        Wait until the machines of the given targets are back online
+        :param names:
+        :param offline_before: the number of machines of each target offline
+        before the operation, which are not waited for. None to wait for all
+        machines.
+        :return: the targets still having machines offline, empty if all of
+        them are online
+        '''
+        offline_before = offline_before or {}
+        not_available = list(names)
+
+        def available(counts):
+            offline = self.count_offline(counts)
+            not_available[:] = [name for name in names
+                                if offline.get(name, 0)
+                                > offline_before.get(name, 0)]
+            return not not_available
+
+        time.sleep(self.delay_sec)
+        ## the bound count function is part of the key, so that only waits
+        ## on the same View and targets share the counts
+        self.poller.wait((self.count_states, tuple(names)),
+                         lambda: self.count_states(names), available,
+                         self.max_wait_sec,
+                         'waiting for ' + ', '.join(names) + ' to be available')
+        return not_available
+
+    def run(self, names):
+        '''
+        Run the operation over all targets, wave by wave. A wave with a
+        failed operation or with machines not available in time stops the
+        run.
+        :param names:
+        :return: the list of waves done
+        '''
+        names = list(OrderedDict.fromkeys(names))
+        waves = self.plan(names)
+        done = []
+        for i, wave in enumerate(waves):
+            not_started = [name for later in waves[i + 1:] for name in later]
+            logging.debug('wave ' + str(i + 1) + '/' + str(len(waves)) + ': '
+                          + ', '.join(wave))
+            offline_before = self.count_offline(self.count_states(wave))
+            results = BatchRunner(self.max_concurrency).run(self.operation,
+                                                            wave)
+            failed = [name + ' (' + str(error) + ')'
+                      for name, (_, error) in zip(wave, results) if error]
+            if failed:
+                raise Exception('Failed on ' + ', '.join(failed)
+                                + ', not started: '
+                                + (', '.join(not_started) or 'none'))
+            not_available = self.wait_available(wave, offline_before)
+            if not_available:
+                raise Exception(', '.join(not_available)
+                                + ' not back online after '
+                                + str(self.max_wait_sec) + 's, not started: '
+                                + (', '.join(not_started) or 'none'))
+            done.append(wave)
+        return done
+
+
+class Shared(object):
+    '''
+    Descriptor for an object shared within a View, such as its LookupCache.
+    The object is built on first access and kept in the helper registry.
+    '''
+
+    def __init__(self, factory):
+        '''
+        Constructor
+        :param factory: called without arguments to build the object
+        '''
+        self.factory = factory
+
+    def __get__(self, obj, owner):
+        if obj is None:
+            return self
+        value = obj.helpers.get(self.factory)
+        if value is None:
+            value = obj.helpers.setdefault(self.factory, self.factory())
+        return value
+
+
+class Helper(object):
+    '''
+    Descriptor building a View helper on first access.
+    The helper is registered in the registry of the owner, so all helpers
+    bound to the same View share a single instance of each helper type.
+    '''
+
+    def __init__(self, class_name):
+        '''
+        Constructor
+        :param class_name: name of the ViewBase subclass to build
+        '''
+        self.class_name = class_name
+
+    def __get__(self, obj, owner):
+        if obj is None:
+            return self
+        helper_class = globals()[self.class_name]
+        helper = obj.helpers.get(helper_class)
+        if helper is None:
+            helper_class(obj.sud, obj.helpers)
+            ## another thread may have won the race, use the registered one
+            helper = obj.helpers[helper_class]
+        return helper
+
+
+class PageReader(object):
+    '''
+    Reads the pages of a query on a worker thread, staying at most a given
+    number of pages ahead of the consumer, so that the round trip for the
+    next page overlaps with the processing of the current one.
+    '''
+
+    def __init__(self, queries, first_page, query_id, depth):
+        '''
+        Constructor
+        :param queries: the Queries helper to fetch pages with
+        :param first_page: the page returned when creating the query
+        :param query_id:
+        :param depth: the maximum number of pages read ahead, at least 2 as
+        the reader holds the page it read while waiting for room in the queue
+        '''
+        self.pages = Queue.Queue(max(depth - 1, 1))
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.read,
+                                       args=(queries, first_page, query_id))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, kind, value):
+        '''
+        Internal method, hand an item to the consumer unless it has stopped
+        :param kind:
+        :param value:
+        :return:
+        '''
+        while not self.stopped.is_set():
+            try:
+                self.pages.put((kind, value), timeout=0.5)
+                return
+            except Queue.Full:
+                pass
+
+    def read(self, queries, ret, query_id):
+        '''
+        Internal method, the worker thread
+        :param queries:
+        :param ret:
+        :param query_id:
+        :return:
+        '''
+        try:
+            while 'results' in ret and not self.stopped.is_set():
+                self.put('page', ret.results)
+                ret = queries.next(query_id)
+            self.put('end', None)
+        except:
+            self.put('error', sys.exc_info())
+
+    def __iter__(self):
+        while True:
+            kind, value = self.pages.get()
+            if kind == 'page':
+                yield value
+            elif kind == 'error':
+                raise value[0], value[1], value[2]
+            else:
+                return
+
+    def stop(self):
+        '''
+        Stop reading ahead and wait for the page being read, if any
+        :return:
+        '''
+        self.stopped.set()
+        self.thread.join()
+
+
 class ViewBase(object):
     '''
     Base class for View helpers
     '''
 
-    def __init__(self, sud):
+    lookups = Shared(LookupCache)
+    poller = Shared(StatePoller)
+
+    def __init__(self, sud, helpers=None):
         '''
         Constructor
+        :param sud:
+        :param helpers: the helper registry shared within a View
         '''
         self.sud = sud
         self.viewapi = sud.get_svc()
         self.mor = MOR.get_mor(self.get_mor_type())
+        self.helpers = {} if helpers is None else helpers
+        self.helpers.setdefault(type(self), self)
 
     @abc.abstractmethod
     def get_mor_type(self):
@@ -195,9 +1163,43 @@ class VC(ViewBase):
     Helper for VC serice APIs
     '''
 
+    def __init__(self, sud, helpers=None):
+        super(VC, self).__init__(sud, helpers)
+        ## inventory snapshot of each VC, keyed by the VC id
+        self.inventories = {}
+        self.inventories_lock = threading.Lock()
+
     def get_mor_type(self):
         return 'VirtualCenter'
 
+    def get_inventory(self, vc_id):
+        '''
+        Fetch the inventory snapshot of given VC ID
+        :param vc_id:
+        :return:
+        '''
+        with self.inventories_lock:
+            inventory = self.inventories.get(vc_id.id)
+            if inventory is None:
+                inventory = VCInventory(self.viewapi, vc_id)
+                self.inventories[vc_id.id] = inventory
+            return inventory
+
+    def refresh_inventory(self, vc_id=None):
+        '''
+        Drop the inventory snapshot of given VC ID
+        :param vc_id: None to drop the snapshots of all VCs
+        :return:
+        '''
+        with self.inventories_lock:
+            if vc_id is None:
+                inventories = self.inventories.values()
+            else:
+                inventories = [self.inventories.get(vc_id.id)]
+        for inventory in inventories:
+            if inventory:
+                inventory.refresh()
+
     def list(self):
         '''
         Fetch a list of VC that have been added to View
@@ -207,7 +1209,16 @@ class VC(ViewBase):
 
     def get_id(self, vc_host):
         '''
-        Fetch the View ID object of given VC
+        Fetch the View ID object of given VC, cached
+        :param vc_host:
+        :return:
+        '''
+        return self.lookups.get('vc', vc_host.lower(),
+                                lambda: self.find_id(vc_host))
+
+    def find_id(self, vc_host):
+        '''
+        Look up the View ID object of given VC
         :param vc_host:
         :return:
         '''
@@ -227,13 +1238,7 @@ class VC(ViewBase):
         :param template_name:
         :return:
         '''
-        images = self.viewapi.VmTemplate_List(MOR.get_mor('VmTemplate'),
-                                               vc_id)
-        for image in images:
-            if image.name.lower() == template_name.lower():
-                return image
-
-        return None
+        return self.get_inventory(vc_id).get_template(template_name)
 
     def get_template_id(self, vc_id, template_name):
         '''
@@ -268,13 +1273,7 @@ class VC(ViewBase):
         :param vm_name:
         :return:
         '''
-        images = self.viewapi.BaseImageVm_List(MOR.get_mor('BaseImageVm'),
-                                               vc_id)
-        for image in images:
-            if image.name.lower() == vm_name.lower():
-                return image
-
-        return None
+        return self.get_inventory(vc_id).get_vm(vm_name)
 
     def get_vm_id(self, vc_id, vm_name):
         '''
@@ -313,87 +1312,124 @@ class VC(ViewBase):
         image_id = self.get_vm_id(vc_id, vm_name)
         if not image_id:
             raise Exception('Image ' + vm_name + ' is not found')
-        image_ss_list = self.viewapi.BaseImageSnapshot_List(MOR.get_mor(
-            'BaseImageSnapshot'), image_id)
-        if not image_ss_list:
+        inventory = self.get_inventory(vc_id)
+        image_ss = inventory.get_snapshot(image_id, ss_path)
+        if image_ss:
+            return image_ss.id
+        if not inventory.get_snapshots(image_id):
             raise Exception('Image ' + vm_name + ' has no snapshot.')
 
-        for image_ss in image_ss_list:
-            if image_ss.path.lower() == ss_path.lower():
-                return image_ss.id
-
         return None
 
-    def __search(self, root, expected_value, compare, returner):
+    def get_vm_folder_tree(self, dc_id):
         '''
-        Internal method to search for a VIM object
-        :param root:
-        :param expected_value:
-        :param compare:
-        :param returner:
+        Fetch the index of the VM folder tree of the given DC ID, cached
+        :param dc_id:
         :return:
         '''
-        s = stack([root])
-        while len(s):
-            e = s.pop()
-            if compare(e, expected_value):
-                return returner(e)
-
-            if 'children' in e:
-                for child in e.children:
-                    s.append(child)
-        return None
+        return self.lookups.get(
+            'vm_folder_tree', dc_id.id,
+            lambda: VCTree(self.viewapi.VmFolder_GetVmFolderTree(
+                MOR.get_mor('VmFolder'), dc_id),
+                lambda x: x.folderData.name, lambda x: x.id))
 
     def get_vm_folder_id(self, dc_id, folder_name):
         '''
         Fetch the folder ID object for the given folder name and DC ID
         :param dc_id:
-        :param folder_name:
+        :param folder_name: the folder name, or its path below the VM folder
         :return:
         '''
-        t = self.viewapi.VmFolder_GetVmFolderTree(MOR.get_mor('VmFolder'),
-                                                  dc_id)
+        t = self.get_vm_folder_tree(dc_id)
         if not folder_name:
-            return t.id
+            return t.root_id
+
+        return t.get_id(folder_name)
 
-        return self.__search(t, folder_name,
-                             lambda x,
-                                    y: x.folderData.name.lower() == y.lower(),
-                             lambda x: x.id)
+    def get_host_or_cluster_tree(self, dc_id):
+        '''
+        Fetch the index of the host and cluster tree of the given DC ID,
+        cached
+        :param dc_id:
+        :return:
+        '''
+        return self.lookups.get(
+            'host_or_cluster_tree', dc_id.id,
+            lambda: VCTree(self.viewapi.HostOrCluster_GetHostOrClusterTree(
+                MOR.get_mor('HostOrCluster'), dc_id).treeContainer,
+                lambda x: x.info.name if 'info' in x else x.name,
+                lambda x: x.info.id if 'info' in x else None))
 
     def get_host_or_cluster_id(self, dc_id, host_or_cluster_name):
         '''
         Fetch the host or cluster ID object given the name
         :param dc_id:
-        :param host_or_cluster_name:
+        :param host_or_cluster_name: the name, or the path below the DC
         :return:
         '''
-        t = self.viewapi.HostOrCluster_GetHostOrClusterTree(MOR.get_mor(
-            'HostOrCluster'), dc_id)
-        return self.__search(t.treeContainer, host_or_cluster_name,
-                             lambda x, y: x.info.name.lower() == y.lower()
-                             if 'info' in x else x.name.lower() ==
-                                                 y.lower(),
-                             lambda x: x.info.id)
+        return self.get_host_or_cluster_tree(dc_id) \
+            .get_id(host_or_cluster_name)
+
+    def get_resource_pool_tree(self, host_or_cluster_id):
+        '''
+        Fetch the index of the resource pool tree of the given host or
+        cluster ID, cached
+        :param host_or_cluster_id:
+        :return:
+        '''
+        return self.lookups.get(
+            'resource_pool_tree', host_or_cluster_id.id,
+            lambda: VCTree(self.viewapi.ResourcePool_GetResourcePoolTree(
+                MOR.get_mor('ResourcePool'), host_or_cluster_id),
+                lambda x: x.resourcePoolData.name, lambda x: x.id))
 
     def get_resource_pool_id(self, host_or_cluster_id, resource_pool_name):
         '''
         Fetch the resource pool ID object given the name
         :param host_or_cluster_id:
-        :param resource_pool_name:
+        :param resource_pool_name: the name, or the path below the root pool
         :return:
         '''
-        t = self.viewapi.ResourcePool_GetResourcePoolTree(MOR.get_mor(
-            'ResourcePool'), host_or_cluster_id)
+        t = self.get_resource_pool_tree(host_or_cluster_id)
 
         if not resource_pool_name:
-            return t.id
+            return t.root_id
+
+        return t.get_id(resource_pool_name)
+
+    def list_network_labels(self, host_or_cluster_id):
+        '''
+        Fetch the network labels of the given host or cluster ID, cached
+        :param host_or_cluster_id:
+        :return:
+        '''
+        return self.lookups.get(
+            'network_labels', host_or_cluster_id.id,
+            lambda: self.viewapi.NetworkLabel_ListByHostOrCluster(
+                MOR.get_mor('NetworkLabel'), host_or_cluster_id) or [])
+
+    def list_nics(self, base_image_ss_id):
+        '''
+        Fetch the NICs of the given snapshot ID, cached
+        :param base_image_ss_id:
+        :return:
+        '''
+        return self.lookups.get(
+            'nics', base_image_ss_id.id,
+            lambda: self.viewapi.NetworkInterfaceCard_ListBySnapshot(
+                MOR.get_mor('NetworkInterfaceCard'), base_image_ss_id) or [])
+
+    def list_datastores(self, host_or_cluster_id):
+        '''
+        Fetch the datastores of the given host or cluster ID, cached
+        :param host_or_cluster_id:
+        :return:
+        '''
+        return self.lookups.get(
+            'datastores', host_or_cluster_id.id,
+            lambda: self.viewapi.Datastore_ListDatastoresByHostOrCluster(
+                MOR.get_mor('Datastore'), host_or_cluster_id) or [])
 
-        return self.__search(t, resource_pool_name,
-                             lambda x,
-                                    y: x.resourcePoolData.name.lower() ==
-                                       y.lower(),
-                             lambda x: x.id)
     def get_network_label_id(self, host_or_cluster_id, network):
         '''
         Fetch the network Id of the given network label
@@ -401,7 +1437,7 @@ class VC(ViewBase):
         :param network:
         :return:
         '''
-        networks = self.viewapi.NetworkLabel_ListByHostOrCluster(MOR.get_mor('NetworkLabel'), host_or_cluster_id)
+        networks = self.list_network_labels(host_or_cluster_id)
         for network_label in networks:
             if network.lower() in network_label.data.name.lower():
                 return network_label.id
@@ -412,7 +1448,7 @@ class VC(ViewBase):
         Get the NIc Id
         :return:
         '''
-        nics = self.viewapi.NetworkInterfaceCard_ListBySnapshot(MOR.get_mor('NetworkInterfaceCard'), base_image_ss_id)
+        nics = self.list_nics(base_image_ss_id)
         for nic_tmp in nics:
             if nic.lower() in nic_tmp.data.name.lower():
                 return nic_tmp.id
@@ -474,9 +1510,7 @@ class VC(ViewBase):
         :param datastore_path:
         :return:
         '''
-        datastores = self.viewapi.Datastore_ListDatastoresByHostOrCluster(MOR
-            .get_mor(
-            'Datastore'), host_or_cluster_id)
+        datastores = self.list_datastores(host_or_cluster_id)
         for datastore in datastores:
             if datastore_path.lower() in datastore.datastoreData.path.lower():
                 return datastore.id
@@ -562,6 +1596,68 @@ class VC(ViewBase):
                 return self.get_datastore_id(host_or_cluster_id, ds_path)
         return None
 
+    def add_provisioning_lookups(self, resolver, vc_host, vc_setting_pars,
+                                 template=False):
+        '''
+        Add the lookups of the VC, the base image or template, and where to
+        place the VMs to the resolver. The values are named vc_id, image_id,
+        image_ss_id (not for templates), dc_id, vm_folder_id,
+        host_or_cluster_id and resource_pool_id.
+        :param resolver: the DependencyResolver
+        :param vc_host:
+        :param vc_setting_pars: the vc_settings params
+        :param template: whether to clone a template instead of a snapshot
+        :return:
+        '''
+        resolver.add('vc_id', lambda: self.get_id(vc_host),
+                     message='VC ' + vc_host + ' is not found')
+        if template:
+            base_template = vc_setting_pars['template_name']
+            resolver.add('image_id',
+                         lambda vc_id: self.get_template_id(vc_id,
+                                                            base_template),
+                         ['vc_id'],
+                         'Template ' + base_template + ' is not found')
+            resolver.add('dc_id',
+                         lambda vc_id: self.get_template_dc_id(vc_id,
+                                                               base_template),
+                         ['vc_id'], 'Datacenter for base template '
+                         + base_template + ' is not found.')
+        else:
+            base_image = vc_setting_pars['vm_name']
+            base_image_ss_path = vc_setting_pars['snapshot_path']
+            resolver.add('image_id',
+                         lambda vc_id: self.get_vm_id(vc_id, base_image),
+                         ['vc_id'],
+                         'Base image ' + base_image + ' is not found.')
+            resolver.add('image_ss_id',
+                         lambda vc_id, image_id: self.get_vm_ss_id(
+                             vc_id, base_image, base_image_ss_path),
+                         ['vc_id', 'image_id'],
+                         'Snapshot ' + base_image_ss_path + ' for base image '
+                         + base_image + ' is not found.')
+            resolver.add('dc_id',
+                         lambda vc_id: self.get_vm_dc_id(vc_id, base_image),
+                         ['vc_id'], 'Datacenter for base image '
+                         + base_image + ' is not found.')
+
+        vm_folder = vc_setting_pars['folder_name']
+        resolver.add('vm_folder_id',
+                     lambda dc_id: self.get_vm_folder_id(dc_id, vm_folder),
+                     ['dc_id'], 'Folder ' + vm_folder + ' is not found.')
+        host_or_cluster_name = vc_setting_pars['host_or_cluster_name']
+        resolver.add('host_or_cluster_id',
+                     lambda dc_id: self.get_host_or_cluster_id(
+                         dc_id, host_or_cluster_name),
+                     ['dc_id'], 'Host or cluster ' + host_or_cluster_name
+                     + ' is not found.')
+        resource_pool_name = vc_setting_pars['resource_pool_name']
+        resolver.add('resource_pool_id',
+                     lambda host_or_cluster_id: self.get_resource_pool_id(
+                         host_or_cluster_id, resource_pool_name),
+                     ['host_or_cluster_id'], 'Resource pool '
+                     + resource_pool_name + ' is not found.')
+
     def get_customization_spec_id(self, vc_id, spec_name):
         '''
         Fetch the customization spec ID object given the name
@@ -660,7 +1756,9 @@ class VC(ViewBase):
                           + ', View Composer ' + composer_host)
         else:
             logging.debug(self.get_host() + ': adding VC ' + vc_host)
-        return self.viewapi.VirtualCenter_Create(self.mor, vc_spec)
+        vc_id = self.viewapi.VirtualCenter_Create(self.mor, vc_spec)
+        self.lookups.invalidate('vc', vc_host.lower())
+        return vc_id
 
     def add_composer_domain(self, domain_name, user_name, password, vc_id):
         '''
@@ -690,8 +1788,6 @@ class InstantCloneDomain(ViewBase):
     '''
     Helper for Instant clone domain related APIs
     '''
-    def __init__(self, sud):
-        super(InstantCloneDomain, self).__init__(sud)
     def get_ad_domain_id(self, domain_name):
         ad_domain_infos = self.viewapi.ADDomain_List(MOR.get_mor('ADDomain'))
         if not ad_domain_infos:
@@ -723,17 +1819,84 @@ class InstantCloneDomain(ViewBase):
         mor = MOR.get_mor('InstantCloneEngineDomainAdministrator')
         return self.viewapi.InstantCloneEngineDomainAdministrator_Create(mor, spec)
 
+    def get_ad_container_id(self, ad_domain_id, rdn='CN=Computers'):
+        '''
+        Fetch the ID of the AD container given its RDN
+        :param ad_domain_id:
+        :param rdn:
+        :return:
+        '''
+        ad_container_infos = self.viewapi.ADContainer_ListByDomain(
+            MOR.get_mor('ADContainer'), ad_domain_id)
+        for ad_container_info in ad_container_infos or []:
+            if ad_container_info.rdn == rdn:
+                return ad_container_info.id
+        return None
+
+    def add_clone_prep_lookups(self, resolver, view_param):
+        '''
+        Add the lookups of the AD container and the instant clone engine
+        domain admin to the resolver. The values are named ad_container_id
+        and instant_clone_domain_admin_id, the admin being None if missing.
+        Once all lookups are resolved, add_missing_clone_prep_admin adds it.
+        :param resolver: the DependencyResolver
+        :param view_param: the domain, user and password of the admin
+        :return:
+        '''
+        domain_name = view_param['domain']
+        resolver.add('ad_domain_id',
+                     lambda: self.get_ad_domain_id(domain_name),
+                     message='ADDomainId for ' + domain_name
+                     + ' is not found.')
+        resolver.add('ad_container_id', self.get_ad_container_id,
+                     ['ad_domain_id'],
+                     'ADContainerId for ' + domain_name + ' is not found.')
+        resolver.add('instant_clone_domain_admin_id',
+                     lambda: self.get_instant_clone_domain_admin_id(
+                         domain_name))
+
+    def add_missing_clone_prep_admin(self, ctx, view_param):
+        '''
+        Add the instant clone engine domain admin if the lookups of
+        add_clone_prep_lookups did not find it. Called once all lookups are
+        resolved, so that nothing is added when one of them fails.
+        :param ctx: the values resolved
+        :param view_param: the domain, user and password of the admin
+        :return:
+        '''
+        if ctx['instant_clone_domain_admin_id'] is None:
+            ctx['instant_clone_domain_admin_id'] = \
+                self.get_or_add_instant_clone_domain_admin(
+                    view_param['domain'], view_param['user'],
+                    view_param['password'])
+
+    def get_or_add_instant_clone_domain_admin(self, domain_name, user_name,
+                                              password):
+        '''
+        Fetch the ID of the instant clone engine domain admin of the domain,
+        adding it if missing
+        :param domain_name:
+        :param user_name:
+        :param password:
+        :return:
+        '''
+        admin_id = self.get_instant_clone_domain_admin_id(domain_name)
+        if admin_id is None:
+            logging.info('Adding Instant clone engine domain admin')
+            admin_id = self.add_instant_clone_domain_admin(domain_name,
+                                                           user_name, password)
+            logging.debug('Instant Clone domain id = ' + str(admin_id))
+        return admin_id
+
 
 class Apps(ViewBase):
     '''
     Helper for Application Service API
     '''
 
-    def __init__(self, sud):
-        super(Apps, self).__init__(sud)
-        self.queries = Queries(sud)
-        self.vc = VC(sud)
-        self.farms = Farms(sud)
+    queries = Helper('Queries')
+    vc = Helper('VC')
+    farms = Helper('Farms')
 
     def get_mor_type(self):
         return 'Application'
@@ -756,7 +1919,16 @@ class Apps(ViewBase):
 
     def get_app_id_by_name(self, app_name):
         '''
-        Get the app id given its name
+        Get the app id given its name, cached
+        :param app_name:
+        :return:
+        '''
+        return self.lookups.get('app', app_name,
+                                lambda: self.find_app_id_by_name(app_name))
+
+    def find_app_id_by_name(self, app_name):
+        '''
+        Look up the app id given its name
         :param app_name:
         :return:
         '''
@@ -773,7 +1945,16 @@ class Apps(ViewBase):
 
     def get_farm_id_by_app_name(self, app_name):
         '''
-        Get the farm id of the farm to which the app_name belongs to
+        Get the farm id of the farm to which the app_name belongs to, cached
+        :param app_name:
+        :return:
+        '''
+        return self.lookups.get('app_farm', app_name,
+                                lambda: self.find_farm_id_by_app_name(app_name))
+
+    def find_farm_id_by_app_name(self, app_name):
+        '''
+        Look up the farm id of the farm to which the app_name belongs to
         :param app_name:
         :return:
         '''
@@ -788,6 +1969,21 @@ class Apps(ViewBase):
 
         return ret.results[0].executionData.farm
 
+    def resolve_app_ids(self, app_names, width=None):
+        '''
+        Get the app ids of many app pools in batched queries
+        :param app_names:
+        :param width: the number of names per query
+        :return: the app id of each name
+        '''
+        resolved = self.queries.resolve('ApplicationInfo', 'data.name',
+                                        app_names,
+                                        width or Queries.RESOLVE_WIDTH)
+        ret = Queries.get_unique_ids(resolved, 'app pool')
+        for app_name, app_id in ret.items():
+            self.lookups.put('app', app_name, app_id)
+        return ret
+
     def get_access_group_id(self):
         '''
         Fetch the access group ID
@@ -827,6 +2023,8 @@ class Apps(ViewBase):
         app_spec.executionData = app_exec_data
 
         app_id = self.viewapi.Application_Create(self.mor, app_spec)
+        self.lookups.invalidate('app', app_data.name)
+        self.lookups.invalidate('app_farm', app_data.name)
         logging.debug(self.get_host() + ': Start creating application pool '
                       + app_data.name + ' ID = ' + app_id.id)
         return app_id
@@ -847,6 +2045,8 @@ class Apps(ViewBase):
         :return:
         '''
         self.viewapi.Application_Delete(self.mor, app_id)
+        self.lookups.invalidate('app')
+        self.lookups.invalidate('app_farm')
 
 
 class Farms(ViewBase):
@@ -854,11 +2054,9 @@ class Farms(ViewBase):
     Helper for Farm Service API
     '''
 
-    def __init__(self, sud):
-        super(Farms, self).__init__(sud)
-        self.queries = Queries(sud)
-        self.vc = VC(sud)
-        self.instantclonedomain = InstantCloneDomain(sud)
+    queries = Helper('Queries')
+    vc = Helper('VC')
+    instantclonedomain = Helper('InstantCloneDomain')
 
     def get_mor_type(self):
         return 'Farm'
@@ -881,7 +2079,16 @@ class Farms(ViewBase):
 
     def get_farm_id_by_name(self, farm_name):
         '''
-        Get the farm id given its name
+        Get the farm id given its name, cached
+        :param farm_name:
+        :return:
+        '''
+        return self.lookups.get('farm', farm_name,
+                                lambda: self.find_farm_id_by_name(farm_name))
+
+    def find_farm_id_by_name(self, farm_name):
+        '''
+        Look up the farm id given its name
         :param farm_name:
         :return:
         '''
@@ -896,52 +2103,129 @@ class Farms(ViewBase):
 
         return ret.results[0].id
 
+    def resolve_farm_ids(self, farm_names, width=None):
+        '''
+        Get the farm ids of many farms in batched queries
+        :param farm_names:
+        :param width: the number of names per query
+        :return: the farm id of each name
+        '''
+        resolved = self.queries.resolve('FarmSummaryView', 'data.name',
+                                        farm_names,
+                                        width or Queries.RESOLVE_WIDTH)
+        ret = Queries.get_unique_ids(resolved, 'farm')
+        for farm_name, farm_id in ret.items():
+            self.lookups.put('farm', farm_name, farm_id)
+        return ret
+
     def query_farm_summary_view(self, query_filter):
         '''
         :param query_filter:
         :return:
         '''
-        ret = self.queries.create(query_filter, 'FarmSummaryView')
-        query_id = ret.id
-        rds_servers = []
         rds_server_count = 0
-        try:
-            while 'results' in ret:
-                for mc in ret.results:
-                    rds_server_count = mc.data.rdsServerCount
-                    rds_servers.append(mc)
-                ret = self.queries.next(query_id)
-        finally:
-            if query_id:
-                self.queries.delete(query_id)
+        for mc in self.queries.stream(query_filter, 'FarmSummaryView'):
+            rds_server_count = mc.data.rdsServerCount
         return rds_server_count
 
     def query_farm_health_info(self, farm_id, rds_server_count):
         '''
         Get the farm health info
         :param farm_id:
-        :param rds_server_count
+        :param rds_server_count: the number of RDS servers to fetch at most,
+        0 or None to fetch all of them
         :return:
         '''
-        ret = self.queries.create_without_filter('FarmHealthInfo')
-        query_id = ret.id
-        rds_servers = []
-        count = 0
-        try:
-            while 'results' in ret:
-                for rds_s in ret.results:
-                    if rds_s.id.id == farm_id.id:
-                        while 'rdsServerHealth' in rds_s:
-                            for rdsh_s in rds_s.rdsServerHealth:
-                                rds_servers.append(rdsh_s)
-                                count += 1
-                            if rds_server_count == count:
-                                break
-                ret = self.queries.next(query_id)
-        finally:
-            if query_id:
-                self.queries.delete(query_id)
-        return rds_servers
+        rds_servers = self.stream_rds_server_health(farm_id)
+        if rds_server_count:
+            rds_servers = islice(rds_servers, rds_server_count)
+        return list(rds_servers)
+
+    def stream_rds_server_health(self, farm_id):
+        '''
+        Iterate over the health of the RDS servers of the given farm. Only the
+        farm's health info is queried, and the servers are yielded as the
+        result pages arrive.
+        :param farm_id:
+        :return:
+        '''
+        for farm_health in self.queries.stream_where(None, 'FarmHealthInfo',
+                                                     'id', farm_id, None):
+            if 'rdsServerHealth' in farm_health:
+                for rdsh_s in farm_health.rdsServerHealth:
+                    yield rdsh_s
+
+    def get_farms_health(self, farm_ids, width=None):
+        '''
+        Get the health of the RDS servers of many farms in a single pass over
+        their health info, with one query per batch of width farms
+        :param farm_ids:
+        :param width: the number of farms per query
+        :return: the list of RDS server health of each farm, keyed by the
+        farm's id string
+        '''
+        width = width or Queries.RESOLVE_WIDTH
+        farm_ids_by_id = OrderedDict((farm_id.id, farm_id)
+                                     for farm_id in farm_ids)
+        ret = dict((farm_id, []) for farm_id in farm_ids_by_id)
+        pending = farm_ids_by_id.keys()
+        while pending:
+            if ('FarmHealthInfo', 'id') in self.queries.client_side_members:
+                ## filtered here anyway, do it in one pass
+                batch = pending
+            else:
+                batch = pending[:width]
+            pending = pending[len(batch):]
+
+            wanted = set(batch)
+            filters = [self.queries.get_equal_filter('id',
+                                                     farm_ids_by_id[farm_id])
+                       for farm_id in batch]
+            if len(filters) == 1:
+                member_filter = filters[0]
+            else:
+                member_filter = self.queries.get_or_filter(filters)
+            for farm_health in self.queries.stream_pushdown(
+                    None, 'FarmHealthInfo', 'id', member_filter,
+                    lambda entity: entity.id.id in wanted):
+                if 'rdsServerHealth' in farm_health:
+                    ret[farm_health.id.id].extend(farm_health.rdsServerHealth)
+        return ret
+
+    def get_farm_ids(self, farm_names, width=None):
+        '''
+        Get the farm ids of many farms, cached. The farms missing from the
+        cache are looked up in batched queries.
+        :param farm_names:
+        :param width: the number of names per query
+        :return: the farm id of each name
+        '''
+        ret = {}
+        missing = []
+        for farm_name in farm_names:
+            farm_id = self.lookups.peek('farm', farm_name)
+            if farm_id is None:
+                missing.append(farm_name)
+            else:
+                ret[farm_name] = farm_id
+        if missing:
+            ret.update(self.resolve_farm_ids(missing, width))
+        return ret
+
+    def count_rds_servers(self, farm_names):
+        '''
+        Count the RDS servers of many farms by status, from their health info
+        :param farm_names:
+        :return: the RDS server count of each status of each farm name
+        '''
+        farm_ids = self.get_farm_ids(farm_names)
+        health = self.get_farms_health(farm_ids.values())
+        ret = {}
+        for farm_name, farm_id in farm_ids.items():
+            counts = ret[farm_name] = {}
+            for rds_s in health[farm_id.id]:
+                counts[rds_s.status] = counts.get(rds_s.status, 0) + 1
+        return ret
 
     def get_farm_rdsh_in_state(self, farm_name, rdsh_state):
         '''
@@ -951,11 +2235,8 @@ class Farms(ViewBase):
         :return:
         '''
         farm_id = self.get_farm_id_by_name(farm_name)
-        query_filter = self.queries.get_equal_filter('data.name', farm_name)
-        rds_server_count = self.query_farm_summary_view(query_filter)
-        rds_servers = self.query_farm_health_info(farm_id, rds_server_count)
         ret = []
-        for rds_s in rds_servers:
+        for rds_s in self.stream_rds_server_health(farm_id):
             if rds_s.status == rdsh_state:
                 ret.append(rds_s)
         return ret
@@ -985,20 +2266,48 @@ class Farms(ViewBase):
         :param params:
         :return:
         '''
+        farm_settings_pars = params['farm_settings']
+        vc_settings_pars = params['vc_settings']
+        storage_optimization_pars = params['storage_optimization']
+        datastore_paths = vc_settings_pars['datastores']
+
+        ## resolve all lookups first, the independent ones concurrently
+        resolver = DependencyResolver()
+        resolver.add('access_group_id', self.get_access_group_id)
+        self.vc.add_provisioning_lookups(resolver, farm_settings_pars['vc'],
+                                         vc_settings_pars)
+        resolver.add('ds_settings',
+                     lambda host_or_cluster_id: self.vc
+                     .get_os_datastores_for_farm(host_or_cluster_id,
+                                                 datastore_paths),
+                     ['host_or_cluster_id'],
+                     'datastores ' + datastore_paths + ' are not found.')
+        if String.is_true(storage_optimization_pars[
+                'use_separate_datastore_4_replica_and_os_disks']):
+            resolver.add('replica_datastore_id',
+                         lambda host_or_cluster_id: self.vc
+                         .get_replica_datastore_id(host_or_cluster_id,
+                                                   datastore_paths),
+                         ['host_or_cluster_id'])
+        cust_spec_name = params['guest_customization'] \
+            ['customization_spec_name']
+        resolver.add('customization_spec_id',
+                     lambda vc_id: self.vc.get_customization_spec_id(
+                         vc_id, cust_spec_name), ['vc_id'])
+        resolver.add('composer_domain_admin_id',
+                     self.vc.get_view_composer_domain_admin_id, ['vc_id'])
+        ctx = resolver.resolve()
+
         farm_spec = self.sud.get_object('ns0:FarmSpec')
         farm_spec.type = 'AUTOMATED'
 
         farm_data = self.sud.get_object('ns0:FarmData')
-        farm_settings_pars = params['farm_settings']
         farm_session_settings_pars = params['session_settings']
         farm_protocol_settings_pars = params['protocol_settings']
-        vc_settings_pars = params['vc_settings']
         adv_storage_pars = params['advanced_storage_options']
-        cust_spec_pars = params['guest_customization']
-        storage_optimization_pars = params['storage_optimization']
         farm_data.name = farm_settings_pars['farm_name']
         farm_data.displayName = farm_data.name
-        farm_data.accessGroup = self.get_access_group_id()
+        farm_data.accessGroup = ctx['access_group_id']
         farm_data.description = farm_data.name
         farm_data.enabled = True
         farm_data.deleting = False
@@ -1022,10 +2331,7 @@ class Farms(ViewBase):
 
         farm_auto_spec = self.sud.get_object('ns0:FarmAutomatedFarmSpec')
         farm_auto_spec.provisioningType = 'VIEW_COMPOSER'
-        vc = farm_settings_pars['vc']
-        vc_id = self.vc.get_id(vc)
-        Validation.validate_param(vc_id, 'VC ' + vc + ' is not found')
-        farm_auto_spec.virtualCenter = vc_id
+        farm_auto_spec.virtualCenter = ctx['vc_id']
 
         farm_naming_spec = self.sud.get_object('ns0:FarmRDSServerNamingSpec')
         farm_naming_spec.namingMethod = 'PATTERN'
@@ -1044,51 +2350,25 @@ class Farms(ViewBase):
         farm_vc_provision_settings.minReadyVMsOnVComposerMaintenance = int(farm_settings_pars['min_ready'])
 
         farm_vc_provisioning_data = self.sud.get_object('ns0:FarmVirtualCenterProvisioningData')
-        base_image = vc_settings_pars['vm_name']
-        base_image_id = self.vc.get_vm_id(vc_id, base_image)
-        Validation.validate_param(base_image_id, 'Base image ' + base_image + ' is not found.')
-        farm_vc_provisioning_data.parentVm = base_image_id
-        base_image_ss_path = vc_settings_pars['snapshot_path']
-        base_image_ss_id = self.vc.get_vm_ss_id(vc_id, base_image,
-                                                base_image_ss_path)
-        farm_vc_provisioning_data.snapshot = base_image_ss_id
-        Validation.validate_param(base_image_ss_id,
-                                  'Snapshot ' + base_image_ss_path + ' for base image  ' + base_image + ' is not found.')
-        base_image_dc_id = self.vc.get_vm_dc_id(vc_id, base_image)
-        Validation.validate_param(base_image_dc_id, 'Datacenter for base image ' + base_image + ' is not found.')
-        farm_vc_provisioning_data.datacenter = base_image_dc_id
-
-        vm_folder = vc_settings_pars['folder_name']
-        vm_folder_id = self.vc.get_vm_folder_id(base_image_dc_id, vm_folder)
-        Validation.validate_param(vm_folder_id, 'Folder ' + vm_folder + ' is not found.')
-        farm_vc_provisioning_data.vmFolder = vm_folder_id
-
-        host_or_cluster_name = vc_settings_pars['host_or_cluster_name']
-        host_or_cluster_id = self.vc.get_host_or_cluster_id(base_image_dc_id, host_or_cluster_name)
-        Validation.validate_param(host_or_cluster_id, 'Host or cluster ' + host_or_cluster_name + ' is not found.')
-        farm_vc_provisioning_data.hostOrCluster = host_or_cluster_id
-
-        resource_pool_name = vc_settings_pars['resource_pool_name']
-        resource_pool_id = self.vc.get_resource_pool_id(host_or_cluster_id, resource_pool_name)
-        Validation.validate_param(resource_pool_id, 'Resource pool ' + resource_pool_name + ' is not found.')
-        farm_vc_provisioning_data.resourcePool = resource_pool_id
+        farm_vc_provisioning_data.parentVm = ctx['image_id']
+        farm_vc_provisioning_data.snapshot = ctx['image_ss_id']
+        farm_vc_provisioning_data.datacenter = ctx['dc_id']
+        farm_vc_provisioning_data.vmFolder = ctx['vm_folder_id']
+        farm_vc_provisioning_data.hostOrCluster = ctx['host_or_cluster_id']
+        farm_vc_provisioning_data.resourcePool = ctx['resource_pool_id']
         farm_vc_provision_settings.virtualCenterProvisioningData = farm_vc_provisioning_data
 
         farm_vc_storage_settings = self.sud.get_object('ns0:FarmVirtualCenterStorageSettings')
 
-        datastore_paths = vc_settings_pars['datastores']
-        ds_settings = self.vc.get_os_datastores_for_farm(host_or_cluster_id,
-                                                datastore_paths)
-        Validation.validate_param(ds_settings, 'datastores ' + datastore_paths + ' are not found.')
-        farm_vc_storage_settings.datastores = ds_settings
+        farm_vc_storage_settings.datastores = ctx['ds_settings']
         farm_vc_storage_settings.useVSan = String.is_true(storage_optimization_pars['use_vsan'])
 
         farm_composer_storage_settings = self.sud.get_object('ns0:FarmViewComposerStorageSettings')
         farm_composer_storage_settings.useSeparateDatastoresReplicaAndOSDisks = String.is_true(
             storage_optimization_pars['use_separate_datastore_4_replica_and_os_disks'])
         if farm_composer_storage_settings.useSeparateDatastoresReplicaAndOSDisks:
-            farm_composer_storage_settings.replicaDiskDatastore = self.vc \
-                .get_replica_datastore_id(host_or_cluster_id, datastore_paths)
+            farm_composer_storage_settings.replicaDiskDatastore = \
+                ctx['replica_datastore_id']
         farm_composer_storage_settings.useNativeSnapshots = False
 
         farm_space_reclaim_settings = self.sud.get_object('ns0:FarmSpaceReclamationSettings')
@@ -1112,12 +2392,13 @@ class Farms(ViewBase):
 
         farm_customization_settings = self.sud.get_object('ns0:FarmCustomizationSettings')
         farm_customization_settings.customizationType = 'SYS_PREP'
-        farm_customization_settings.domainAdministrator = self.vc.get_view_composer_domain_admin_id(vc_id)
+        farm_customization_settings.domainAdministrator = \
+            ctx['composer_domain_admin_id']
         farm_customization_settings.reusePreExistingAccounts = False
 
         farm_sysprep_cust_settings = self.sud.get_object('ns0:FarmSysprepCustomizationSettings')
-        cust_spec_name = cust_spec_pars['customization_spec_name']
-        farm_sysprep_cust_settings.customizationSpec = self.vc.get_customization_spec_id(vc_id, cust_spec_name)
+        farm_sysprep_cust_settings.customizationSpec = \
+            ctx['customization_spec_id']
         farm_customization_settings.sysprepCustomizationSettings = farm_sysprep_cust_settings
 
         farm_auto_spec.customizationSettings = farm_customization_settings
@@ -1130,6 +2411,7 @@ class Farms(ViewBase):
 
         farm_spec.automatedFarmSpec = farm_auto_spec
         farm_id = self.viewapi.Farm_Create(self.mor, farm_spec)
+        self.lookups.invalidate('farm', farm_data.name)
         logging.debug(self.get_host() + ': Start creating automated farm '
                         + farm_data.name + ' ID = ' + farm_id.id)
         return farm_id
@@ -1141,19 +2423,51 @@ class Farms(ViewBase):
         :param view_param
         :return:
         '''
+        farm_settings_pars = params['farm_settings']
+        vc_settings_pars = params['vc_settings']
+        storage_optimization_pars = params['storage_optimization']
+        datastore_paths = vc_settings_pars['datastores']
+
+        ## resolve all lookups first, the independent ones concurrently
+        resolver = DependencyResolver()
+        resolver.add('access_group_id', self.get_access_group_id)
+        self.vc.add_provisioning_lookups(resolver, farm_settings_pars['vc'],
+                                         vc_settings_pars)
+        resolver.add('ds_settings',
+                     lambda host_or_cluster_id: self.vc
+                     .get_os_datastores_for_farm(host_or_cluster_id,
+                                                 datastore_paths),
+                     ['host_or_cluster_id'],
+                     'datastores ' + datastore_paths + ' are not found.')
+        if String.is_true(storage_optimization_pars[
+                'use_separate_datastore_4_replica_and_os_disks']):
+            resolver.add('replica_datastore_id',
+                         lambda host_or_cluster_id: self.vc
+                         .get_replica_datastore_id(host_or_cluster_id,
+                                                   datastore_paths),
+                         ['host_or_cluster_id'])
+        networks = vc_settings_pars['networks']
+        if networks:
+            nic = vc_settings_pars['nic']
+            resolver.add('nics',
+                         lambda host_or_cluster_id, image_ss_id: self.vc
+                         .get_farm_networks(host_or_cluster_id, networks,
+                                            image_ss_id, nic),
+                         ['host_or_cluster_id', 'image_ss_id'])
+        self.instantclonedomain.add_clone_prep_lookups(resolver, view_param)
+        ctx = resolver.resolve()
+        self.instantclonedomain.add_missing_clone_prep_admin(ctx, view_param)
+
         farm_spec = self.sud.get_object('ns0:FarmSpec')
         farm_spec.type = 'AUTOMATED'
 
         farm_data = self.sud.get_object('ns0:FarmData')
-        farm_settings_pars = params['farm_settings']
         farm_session_settings_pars = params['session_settings']
         farm_protocol_settings_pars = params['protocol_settings']
-        vc_settings_pars = params['vc_settings']
         adv_storage_pars = params['advanced_storage_options']
-        storage_optimization_pars = params['storage_optimization']
         farm_data.name = farm_settings_pars['farm_name']
         farm_data.displayName = farm_data.name
-        farm_data.accessGroup = self.get_access_group_id()
+        farm_data.accessGroup = ctx['access_group_id']
         farm_data.description = farm_data.name
         farm_data.enabled = True
         farm_data.deleting = False
@@ -1177,10 +2491,7 @@ class Farms(ViewBase):
 
         farm_auto_spec = self.sud.get_object('ns0:FarmAutomatedFarmSpec')
         farm_auto_spec.provisioningType = 'INSTANT_CLONE_ENGINE'
-        vc = farm_settings_pars['vc']
-        vc_id = self.vc.get_id(vc)
-        Validation.validate_param(vc_id, 'VC ' + vc + ' is not found')
-        farm_auto_spec.virtualCenter = vc_id
+        farm_auto_spec.virtualCenter = ctx['vc_id']
 
         farm_naming_spec = self.sud.get_object('ns0:FarmRDSServerNamingSpec')
         farm_naming_spec.namingMethod = 'PATTERN'
@@ -1199,51 +2510,25 @@ class Farms(ViewBase):
         farm_vc_provision_settings.minReadyVMsOnVComposerMaintenance = int(farm_settings_pars['min_ready'])
 
         farm_vc_provisioning_data = self.sud.get_object('ns0:FarmVirtualCenterProvisioningData')
-        base_image = vc_settings_pars['vm_name']
-        base_image_id = self.vc.get_vm_id(vc_id, base_image)
-        Validation.validate_param(base_image_id, 'Base image ' + base_image + ' is not found.')
-        farm_vc_provisioning_data.parentVm = base_image_id
-        base_image_ss_path = vc_settings_pars['snapshot_path']
-        base_image_ss_id = self.vc.get_vm_ss_id(vc_id, base_image,
-                                                base_image_ss_path)
-        farm_vc_provisioning_data.snapshot = base_image_ss_id
-        Validation.validate_param(base_image_ss_id,
-                                  'Snapshot ' + base_image_ss_path + ' for base image  ' + base_image + ' is not found.')
-        base_image_dc_id = self.vc.get_vm_dc_id(vc_id, base_image)
-        Validation.validate_param(base_image_dc_id, 'Datacenter for base image ' + base_image + ' is not found.')
-        farm_vc_provisioning_data.datacenter = base_image_dc_id
-
-        vm_folder = vc_settings_pars['folder_name']
-        vm_folder_id = self.vc.get_vm_folder_id(base_image_dc_id, vm_folder)
-        Validation.validate_param(vm_folder_id, 'Folder ' + vm_folder + ' is not found.')
-        farm_vc_provisioning_data.vmFolder = vm_folder_id
-
-        host_or_cluster_name = vc_settings_pars['host_or_cluster_name']
-        host_or_cluster_id = self.vc.get_host_or_cluster_id(base_image_dc_id, host_or_cluster_name)
-        Validation.validate_param(host_or_cluster_id, 'Host or cluster ' + host_or_cluster_name + ' is not found.')
-        farm_vc_provisioning_data.hostOrCluster = host_or_cluster_id
-
-        resource_pool_name = vc_settings_pars['resource_pool_name']
-        resource_pool_id = self.vc.get_resource_pool_id(host_or_cluster_id, resource_pool_name)
-        Validation.validate_param(resource_pool_id, 'Resource pool ' + resource_pool_name + ' is not found.')
-        farm_vc_provisioning_data.resourcePool = resource_pool_id
+        farm_vc_provisioning_data.parentVm = ctx['image_id']
+        farm_vc_provisioning_data.snapshot = ctx['image_ss_id']
+        farm_vc_provisioning_data.datacenter = ctx['dc_id']
+        farm_vc_provisioning_data.vmFolder = ctx['vm_folder_id']
+        farm_vc_provisioning_data.hostOrCluster = ctx['host_or_cluster_id']
+        farm_vc_provisioning_data.resourcePool = ctx['resource_pool_id']
         farm_vc_provision_settings.virtualCenterProvisioningData = farm_vc_provisioning_data
 
         farm_vc_storage_settings = self.sud.get_object('ns0:FarmVirtualCenterStorageSettings')
 
-        datastore_paths = vc_settings_pars['datastores']
-        ds_settings = self.vc.get_os_datastores_for_farm(host_or_cluster_id,
-                                                datastore_paths)
-        Validation.validate_param(ds_settings, 'datastores ' + datastore_paths + ' are not found.')
-        farm_vc_storage_settings.datastores = ds_settings
+        farm_vc_storage_settings.datastores = ctx['ds_settings']
         farm_vc_storage_settings.useVSan = String.is_true(storage_optimization_pars['use_vsan'])
 
         farm_composer_storage_settings = self.sud.get_object('ns0:FarmViewComposerStorageSettings')
         farm_composer_storage_settings.useSeparateDatastoresReplicaAndOSDisks = String.is_true(
             storage_optimization_pars['use_separate_datastore_4_replica_and_os_disks'])
         if farm_composer_storage_settings.useSeparateDatastoresReplicaAndOSDisks:
-            farm_composer_storage_settings.replicaDiskDatastore = self.vc \
-                .get_replica_datastore_id(host_or_cluster_id, datastore_paths)
+            farm_composer_storage_settings.replicaDiskDatastore = \
+                ctx['replica_datastore_id']
         farm_composer_storage_settings.useNativeSnapshots = False
 
         farm_space_reclaim_settings = self.sud.get_object('ns0:FarmSpaceReclamationSettings')
@@ -1260,10 +2545,8 @@ class Farms(ViewBase):
         farm_vc_provision_settings.virtualCenterStorageSettings = farm_vc_storage_settings
 
         farm_vc_nw_settings = self.sud.get_object('ns0:FarmVirtualCenterNetworkingSettings')
-        networks = vc_settings_pars['networks']
-        if networks:
-            nic = vc_settings_pars['nic']
-            farm_vc_nw_settings.nics = self.vc.get_farm_networks(host_or_cluster_id, networks, base_image_ss_id, nic)
+        if 'nics' in ctx:
+            farm_vc_nw_settings.nics = ctx['nics']
         farm_vc_provision_settings.virtualCenterNetworkingSettings = farm_vc_nw_settings
         farm_auto_spec.virtualCenterProvisioningSettings = farm_vc_provision_settings
 
@@ -1276,33 +2559,10 @@ class Farms(ViewBase):
         farm_customization_settings.customizationType = 'CLONE_PREP'
         farm_customization_settings.reusePreExistingAccounts = False
 
-        domain_name = view_param['domain']
-        ad_domain_id = self.instantclonedomain.get_ad_domain_id(domain_name)
-        Validation.validate_param(ad_domain_id, 'ADDomainId for ' \
-                                  + domain_name + ' is not found.')
-        ad_container_infos = self.viewapi.ADContainer_ListByDomain(MOR \
-                                                                   .get_mor('ADContainer'), ad_domain_id)
-        for ad_container_info in ad_container_infos:
-            if ad_container_info.rdn == "CN=Computers":
-                ad_container_id = ad_container_info.id
-                break
-        Validation.validate_param(ad_container_id, 'ADContainerId for ' \
-                                  + domain_name + ' is not found.')
-        farm_customization_settings.adContainer = ad_container_id
+        farm_customization_settings.adContainer = ctx['ad_container_id']
         farm_cloneprep_cust_settings = self.sud.get_object('ns0:FarmCloneprepCustomizationSettings')
-        instant_clone_domain_admin_id = self.instantclonedomain \
-            .get_instant_clone_domain_admin_id(domain_name)
-        if instant_clone_domain_admin_id is None:
-            user = view_param['user']
-            password = view_param['password']
-            logging.info('Adding Instant clone engine domain admin')
-            instant_clone_domain_admin_id = self.instantclonedomain \
-                .add_instant_clone_domain_admin(domain_name, user, password)
-            logging.debug('Instant Clone domain id = ' \
-                          + str(instant_clone_domain_admin_id))
-
         farm_cloneprep_cust_settings.instantCloneEngineDomainAdministrator = \
-            instant_clone_domain_admin_id
+            ctx['instant_clone_domain_admin_id']
 
         farm_customization_settings.cloneprepCustomizationSettings = \
                 farm_cloneprep_cust_settings
@@ -1317,6 +2577,7 @@ class Farms(ViewBase):
 
         farm_spec.automatedFarmSpec = farm_auto_spec
         farm_id = self.viewapi.Farm_Create(self.mor, farm_spec)
+        self.lookups.invalidate('farm', farm_data.name)
         logging.debug(self.get_host() + ': Start creating instant clone farm '
                         + farm_data.name + ' ID = ' + farm_id.id)
         return farm_id
@@ -1348,11 +2609,8 @@ class Farms(ViewBase):
         farm_recompose_spec.logoffSetting = "FORCE_LOGOFF"
         farm_recompose_spec.stopOnFirstError = True
 
-        query_filter = self.queries.get_equal_filter('data.name', farm_name)
-        rds_server_count = self.query_farm_summary_view(query_filter)
-        rds_servers = self.query_farm_health_info(farm_id, rds_server_count)
         rds_server_ids = []
-        for rds_server in rds_servers:
+        for rds_server in self.stream_rds_server_health(farm_id):
             rds_server_ids.append(rds_server.id)
         farm_recompose_spec.rdsServers = rds_server_ids
 
@@ -1417,18 +2675,18 @@ class Farms(ViewBase):
         farm_id = self.get_farm_id_by_name(farm_name)
         logging.debug(self.get_host() + ': Start deleting farm ' + farm_name)
         self.viewapi.Farm_Delete(self.mor, farm_id)
+        self.lookups.invalidate('farm')
+        self.lookups.invalidate('app_farm')
 
 class Desktops(ViewBase):
     '''
     Helper for View desktop service API
     '''
 
-    def __init__(self, sud):
-        super(Desktops, self).__init__(sud)
-        self.queries = Queries(sud)
-        self.vc = VC(sud)
-        self.instantclonedomain = InstantCloneDomain(sud)
-        self.farms = Farms(sud)
+    queries = Helper('Queries')
+    vc = Helper('VC')
+    instantclonedomain = Helper('InstantCloneDomain')
+    farms = Helper('Farms')
 
     def get_mor_type(self):
         return 'Desktop'
@@ -1451,7 +2709,17 @@ class Desktops(ViewBase):
 
     def get_desktop_id_by_name(self, desktop_name):
         '''
-        Search for desktop given the name
+        Search for desktop given the name, cached
+        :param desktop_name:
+        :return:
+        '''
+        return self.lookups.get('desktop', desktop_name,
+                                lambda: self.find_desktop_id_by_name(
+                                    desktop_name))
+
+    def find_desktop_id_by_name(self, desktop_name):
+        '''
+        Look up the desktop given the name
         :param desktop_name:
         :return:
         '''
@@ -1466,6 +2734,60 @@ class Desktops(ViewBase):
 
         return ret.results[0].id
 
+    def resolve_desktop_ids(self, desktop_names, width=None):
+        '''
+        Get the desktop ids of many pools in batched queries
+        :param desktop_names:
+        :param width: the number of names per query
+        :return: the desktop id of each name
+        '''
+        resolved = self.queries.resolve('DesktopSummaryView',
+                                        'desktopSummaryData.name',
+                                        desktop_names,
+                                        width or Queries.RESOLVE_WIDTH)
+        ret = Queries.get_unique_ids(resolved, 'pool')
+        for desktop_name, desktop_id in ret.items():
+            self.lookups.put('desktop', desktop_name, desktop_id)
+        return ret
+
+    def get_desktop_ids(self, desktop_names, width=None):
+        '''
+        Get the desktop ids of many pools, cached. The pools missing from the
+        cache are looked up in batched queries.
+        :param desktop_names:
+        :param width: the number of names per query
+        :return: the desktop id of each name
+        '''
+        ret = {}
+        missing = []
+        for desktop_name in desktop_names:
+            desktop_id = self.lookups.peek('desktop', desktop_name)
+            if desktop_id is None:
+                missing.append(desktop_name)
+            else:
+                ret[desktop_name] = desktop_id
+        if missing:
+            ret.update(self.resolve_desktop_ids(missing, width))
+        return ret
+
+    def count_machines(self, desktop_names):
+        '''
+        Count the machines of many pools by state, without keeping the
+        machines. The machines are read in large pages of the names view.
+        :param desktop_names:
+        :return: the machine count of each state of each pool name
+        '''
+        desktop_ids = self.get_desktop_ids(desktop_names)
+        counts = self.queries.count_by_ref(
+            'MachineNamesView', 'base.desktop', desktop_ids.values(),
+            lambda machine: (machine.base.desktop.id,
+                             getattr(machine.base, 'basicState', None)))
+        by_id = {}
+        for (desktop_id, state), count in counts.items():
+            by_id.setdefault(desktop_id, {})[state] = count
+        return dict((desktop_name, by_id.get(desktop_id.id, {}))
+                    for desktop_name, desktop_id in desktop_ids.items())
+
     def get_desktop_type(self, desktop_name):
         '''
         Search for desktop type given the name
@@ -1495,18 +2817,7 @@ class Desktops(ViewBase):
         :param query_filter:
         :return:
         '''
-        ret = self.queries.create(query_filter, 'RDSServerSummaryView')
-        query_id = ret.id
-        machines = []
-        try:
-            while 'results' in ret:
-                for mc in ret.results:
-                    machines.append(mc)
-                ret = self.queries.next(query_id)
-        finally:
-            if query_id:
-                self.queries.delete(query_id)
-        return machines
+        return list(self.queries.stream(query_filter, 'RDSServerSummaryView'))
 
     def get_rds_machines_in_state(self, rds_name, machine_state):
         '''
@@ -1517,12 +2828,10 @@ class Desktops(ViewBase):
         '''
         rds_desktop_id = self.get_desktop_id_by_name(rds_name)
         query_filter = self.queries.get_equal_filter('base.desktop', rds_desktop_id)
-        machines = self.query_rds_summary_view(query_filter)
-        ret = []
-        for machine in machines:
-            if machine.runtimeData.status == machine_state:
-                ret.append(machine)
-        return ret
+        return list(self.queries.stream_where(query_filter,
+                                              'RDSServerSummaryView',
+                                              'runtimeData.status',
+                                              machine_state))
 
     def query_machine_names_view(self, query_filter):
         '''
@@ -1530,18 +2839,7 @@ class Desktops(ViewBase):
         :param query_filter:
         :return:
         '''
-        ret = self.queries.create(query_filter, 'MachineNamesView')
-        query_id = ret.id
-        machines = []
-        try:
-            while 'results' in ret:
-                for mc in ret.results:
-                    machines.append(mc)
-                ret = self.queries.next(query_id)
-        finally:
-            if query_id:
-                self.queries.delete(query_id)
-        return machines
+        return list(self.queries.stream(query_filter, 'MachineNamesView'))
 
     def get_machines_in_state1(self, desktop_id, machine_state):
         '''
@@ -1551,12 +2849,9 @@ class Desktops(ViewBase):
         :return:
         '''
         query_filter = self.queries.get_equal_filter('base.desktop', desktop_id)
-        machines = self.query_machine_names_view(query_filter)
-        ret = []
-        for machine in machines:
-            if machine.base.basicState == machine_state:
-                ret.append(machine)
-        return ret
+        return list(self.queries.stream_where(query_filter, 'MachineNamesView',
+                                              'base.basicState',
+                                              machine_state))
 
     def get_machines_in_state(self, desktop_name, machine_state):
         '''
@@ -1568,6 +2863,36 @@ class Desktops(ViewBase):
         desktop_id = self.get_desktop_id_by_name(desktop_name)
         return self.get_machines_in_state1(desktop_id, machine_state)
 
+    def wait_machines_in_state(self, desktop_name, machine_state,
+                               machine_count=None, max_wait_sec=None):
+        '''
+        Wait until enough machines of the given desktop are in the given
+        state. Concurrent waits on the same desktop share one count per poll.
+        :param desktop_name:
+        :param machine_state:
+        :param machine_count: the number of machines to wait for, None to
+        wait for all of them once the desktop has any
+        :param max_wait_sec:
+        :return: the machine count of each state, None if timed out
+        '''
+        def enough(counts):
+            if machine_count is None:
+                ## a new desktop has no machines until it provisions them
+                total = sum(counts.values())
+                if total and counts.get(machine_state, 0) >= total:
+                    return counts
+            elif counts.get(machine_state, 0) >= machine_count:
+                ## the poller waits while the result is false, as an empty
+                ## count is when waiting for no machines
+                return counts or {machine_state: 0}
+
+        return self.poller.wait(
+            ('MachineNamesView', desktop_name),
+            lambda: self.count_machines([desktop_name]).get(desktop_name, {}),
+            enough, max_wait_sec,
+            self.get_host() + ': waiting for machines of ' + desktop_name
+            + ' to be ' + machine_state)
+
     def get_machines(self, desktop_name):
         '''
         Fetch machines in the given desktop
@@ -1576,9 +2901,8 @@ class Desktops(ViewBase):
         '''
         desktop_id = self.get_desktop_id_by_name(desktop_name)
         query_filter = self.queries.get_equal_filter('base.desktop', desktop_id)
-        machines = self.query_machine_names_view(query_filter)
         ret = []
-        for machine in machines:
+        for machine in self.queries.stream(query_filter, 'MachineNamesView'):
             ret.append(machine.id)
         return ret
 
@@ -1599,6 +2923,127 @@ class Desktops(ViewBase):
         :param params:
         :return:
         '''
+        return self.create_desktop(self.get_automated_desktop_spec(params))
+
+    def create_desktop(self, dt_spec):
+        '''
+        Create a desktop given its spec
+        :param dt_spec:
+        :return:
+        '''
+        desktop_id = self.viewapi.Desktop_Create(self.mor, dt_spec)
+        self.lookups.invalidate('desktop', dt_spec.base.name)
+        logging.debug(self.get_host() + ': Start creating pool '
+                      + dt_spec.base.name + ' ID = ' + desktop_id.id)
+        return desktop_id
+
+    def create_pools(self, template_params, overrides_list,
+                     max_concurrency=BatchRunner.MAX_CONCURRENCY):
+        '''
+        Create many automated desktops from one template. The lookups and the
+        spec of the template are done once, and each pool gets a copy of the
+        spec with its overrides applied.
+        :param template_params: the params of create_automated_desktop
+        :param overrides_list: the overrides of each pool, a dict with
+        pool_name and optionally display_name, name_prefix, maximum_count,
+        minimum_count and headroom_count
+        :param max_concurrency: the number of pools created at once
+        :return: the outcome of each pool in order, a dict with pool_name and
+        either desktop_id or error, e.g. of invalid overrides
+        '''
+        template_spec = self.get_automated_desktop_spec(template_params)
+        overrides_list = list(overrides_list)
+
+        def create_pool(overrides):
+            return self.create_desktop(self.apply_pool_overrides(
+                Suds.clone(template_spec), overrides))
+
+        results = BatchRunner(max_concurrency).run(create_pool, overrides_list)
+        ret = []
+        for overrides, (desktop_id, error) in zip(overrides_list, results):
+            outcome = {'pool_name': overrides.get('pool_name')}
+            if error:
+                logging.error(self.get_host() + ': failed to create pool '
+                              + str(outcome['pool_name']) + ': ' + str(error))
+                outcome['error'] = error
+            else:
+                outcome['desktop_id'] = desktop_id
+            ret.append(outcome)
+        return ret
+
+    @staticmethod
+    def apply_pool_overrides(dt_spec, overrides):
+        '''
+        Apply the overrides of create_pools to an automated desktop spec
+        :param dt_spec:
+        :param overrides:
+        :return: the spec
+        '''
+        dt_spec.base.name = overrides['pool_name']
+        dt_spec.base.displayName = overrides.get('display_name',
+                                                 overrides['pool_name'])
+        naming = dt_spec.automatedDesktopSpec.vmNamingSpec \
+            .patternNamingSettings
+        if 'name_prefix' in overrides:
+            naming.namingPattern = overrides['name_prefix']
+        if 'maximum_count' in overrides:
+            naming.maxNumberOfMachines = int(overrides['maximum_count'])
+            naming.minNumberOfMachines = int(overrides.get(
+                'minimum_count', overrides['maximum_count']))
+            naming.numberOfSpareMachines = int(overrides.get(
+                'headroom_count', overrides['maximum_count']))
+        else:
+            if 'minimum_count' in overrides:
+                naming.minNumberOfMachines = int(overrides['minimum_count'])
+            if 'headroom_count' in overrides:
+                naming.numberOfSpareMachines = int(overrides['headroom_count'])
+        return dt_spec
+
+    def get_automated_desktop_spec(self, params):
+        '''
+        Build the spec of an automated desktop
+        :param params:
+        :return:
+        '''
+        pool_def_pars = params['pool_definition']
+        vc_setting_pars = params['vc_settings']
+        storage_opt_pars = params['storage_optimization']
+        datastore_paths = vc_setting_pars['datastores']
+
+        ## resolve all lookups first, the independent ones concurrently
+        resolver = DependencyResolver()
+        resolver.add('access_group_id', self.get_access_group_id)
+        self.vc.add_provisioning_lookups(resolver, pool_def_pars['vc'],
+                                         vc_setting_pars)
+        resolver.add('ds_settings',
+                     lambda host_or_cluster_id: self.vc.get_os_datastores(
+                         host_or_cluster_id, datastore_paths),
+                     ['host_or_cluster_id'],
+                     'datastores ' + datastore_paths + ' are not found.')
+        if String.is_true(storage_opt_pars[
+                'use_separate_datastore_4_replica_and_os_disks']):
+            resolver.add('replica_datastore_id',
+                         lambda host_or_cluster_id: self.vc
+                         .get_replica_datastore_id(host_or_cluster_id,
+                                                   datastore_paths),
+                         ['host_or_cluster_id'])
+        guest_cust_pars = params['guest_customization']
+        if guest_cust_pars['customization_type'].lower() == 'sys_prep':
+            spec_name = guest_cust_pars['customization_spec_name']
+            resolver.add('customization_spec_id',
+                         lambda vc_id: self.vc.get_customization_spec_id(
+                             vc_id, spec_name), ['vc_id'])
+        if String.is_true(storage_opt_pars[
+                'use_separate_datastore_4_data_and_os_disks']):
+            resolver.add('persistent_datastores',
+                         lambda host_or_cluster_id: self.vc
+                         .get_persistent_datastores(host_or_cluster_id,
+                                                    datastore_paths),
+                         ['host_or_cluster_id'])
+        resolver.add('composer_domain_admin_id',
+                     self.vc.get_view_composer_domain_admin_id, ['vc_id'])
+        ctx = resolver.resolve()
+
         dt_spec = self.sud.get_object('ns0:DesktopSpec')
         dt_spec.type = 'AUTOMATED'
 
@@ -1655,13 +3100,9 @@ class Desktops(ViewBase):
         dt_spec.desktopSettings = dt_settings
 
         adt_spec = self.sud.get_object('ns0:DesktopAutomatedDesktopSpec')
-        adt_spec.provisioningType = 'VIEW_COMPOSER'
-
-        pool_def_pars = params['pool_definition']
-        vc = pool_def_pars['vc']
-        vc_id = self.vc.get_id(vc)
-        Validation.validate_param(vc_id, 'VC ' + vc + ' is not found')
-        adt_spec.virtualCenter = vc_id
+        adt_spec.provisioningType = 'VIEW_COMPOSER'
+
+        adt_spec.virtualCenter = ctx['vc_id']
         user_assignment = self.sud.get_object('ns0:DesktopUserAssignment')
         user_assignment.userAssignment = pool_def_pars['user_assignment']
         if user_assignment.userAssignment == 'DEDICATED':
@@ -1707,60 +3148,19 @@ class Desktops(ViewBase):
         vc_provision_settings.minReadyVMsOnVComposerMaintenance = \
             prov_settings_pars['min_ready_vms']
 
-        vc_setting_pars = params['vc_settings']
-        base_image = vc_setting_pars['vm_name']
-        base_image_id = self.vc.get_vm_id(vc_id, base_image)
-        Validation.validate_param(base_image_id, 'Base image ' + base_image
-                                  + ' is not found.')
         vc_provision_data = self.sud \
             .get_object('ns0:DesktopVirtualCenterProvisioningData')
-        vc_provision_data.parentVm = base_image_id
-
-        base_image_ss_path = vc_setting_pars['snapshot_path']
-        base_image_ss_id = self.vc.get_vm_ss_id(vc_id, base_image,
-                                                base_image_ss_path)
-        Validation.validate_param(base_image_ss_id, 'Snapshot '
-                                  + base_image_ss_path + ' for base image '
-                                  + base_image + ' is not found.')
-
-        vc_provision_data.snapshot = base_image_ss_id
-        base_image_dc_id = self.vc.get_vm_dc_id(vc_id, base_image)
-        Validation.validate_param(base_image_dc_id, 'Datacenter for base '
-                                                    'image '
-                                  + base_image + ' is not found.')
-        vc_provision_data.datacenter = base_image_dc_id
-
-        vm_folder = vc_setting_pars['folder_name']
-        vm_folder_id = self.vc.get_vm_folder_id(base_image_dc_id, vm_folder)
-        Validation.validate_param(vm_folder_id, 'Folder ' + vm_folder
-                                  + ' is not found.')
-        vc_provision_data.vmFolder = vm_folder_id
-
-        host_or_cluster_name = vc_setting_pars['host_or_cluster_name']
-        host_or_cluster_id = self.vc.get_host_or_cluster_id(base_image_dc_id,
-                                                            host_or_cluster_name)
-        Validation.validate_param(host_or_cluster_id, 'Host or cluster '
-                                  + host_or_cluster_name + ' is not found.')
-        vc_provision_data.hostOrCluster = host_or_cluster_id
-
-        resource_pool_name = vc_setting_pars['resource_pool_name']
-        resource_pool_id = self.vc.get_resource_pool_id(host_or_cluster_id,
-                                                        resource_pool_name)
-        Validation.validate_param(resource_pool_id, 'Resource pool '
-                                  + resource_pool_name + ' is not found.')
-        vc_provision_data.resourcePool = resource_pool_id
+        vc_provision_data.parentVm = ctx['image_id']
+        vc_provision_data.snapshot = ctx['image_ss_id']
+        vc_provision_data.datacenter = ctx['dc_id']
+        vc_provision_data.vmFolder = ctx['vm_folder_id']
+        vc_provision_data.hostOrCluster = ctx['host_or_cluster_id']
+        vc_provision_data.resourcePool = ctx['resource_pool_id']
         vc_provision_settings.virtualCenterProvisioningData = vc_provision_data
 
-        datastore_paths = vc_setting_pars['datastores']
-        ds_settings = self.vc.get_os_datastores(host_or_cluster_id,
-                                                datastore_paths)
-        Validation.validate_param(ds_settings, 'datastores '
-                                  + datastore_paths + ' are not found.')
-
-        storage_opt_pars = params['storage_optimization']
         vc_storage_settings = self.sud \
             .get_object('ns0:DesktopVirtualCenterStorageSettings')
-        vc_storage_settings.datastores = ds_settings
+        vc_storage_settings.datastores = ctx['ds_settings']
         vc_storage_settings.useVSan = String.is_true(storage_opt_pars
                                                      ['use_vsan'])
 
@@ -1773,8 +3173,8 @@ class Desktops(ViewBase):
                                'use_separate_datastore_4_replica_and_os_disks'])
         if view_composer_storage_settings \
                 .useSeparateDatastoresReplicaAndOSDisks:
-            view_composer_storage_settings.replicaDiskDatastore = self.vc \
-                .get_replica_datastore_id(host_or_cluster_id, datastore_paths)
+            view_composer_storage_settings.replicaDiskDatastore = \
+                ctx['replica_datastore_id']
 
         adv_storage_opt_pars = params['advanced_storage_options']
         view_composer_storage_settings.useNativeSnapshots = String \
@@ -1805,8 +3205,8 @@ class Desktops(ViewBase):
             String.is_true(storage_opt_pars
                            ['use_separate_datastore_4_data_and_os_disks'])
         if persistent_disk_settings.useSeparateDatastoresPersistentAndOSDisks:
-            persistent_disk_settings.persistentDiskDatastores = self.vc \
-                .get_persistent_datastores(host_or_cluster_id, datastore_paths)
+            persistent_disk_settings.persistentDiskDatastores = \
+                ctx['persistent_datastores']
 
         view_composer_storage_settings.persistentDiskSettings = \
             persistent_disk_settings
@@ -1848,7 +3248,6 @@ class Desktops(ViewBase):
 
         adt_spec.virtualCenterProvisioningSettings = vc_provision_settings
 
-        guest_cust_pars = params['guest_customization']
         customize_settings = self.sud \
             .get_object('ns0:DesktopCustomizationSettings')
         customize_settings.customizationType = \
@@ -1870,17 +3269,16 @@ class Desktops(ViewBase):
         elif customize_settings.customizationType.lower() == 'sys_prep':
             sys_prep_cust_settings = self.sud \
                 .get_object('ns0:DesktopSysprepCustomizationSettings')
-            spec_name = guest_cust_pars['customization_spec_name']
-            sys_prep_cust_settings.customizationSpec = self.vc \
-                .get_customization_spec_id(vc_id, spec_name)
+            sys_prep_cust_settings.customizationSpec = \
+                ctx['customization_spec_id']
             customize_settings.sysprepCustomizationSettings = \
                 sys_prep_cust_settings
         else:
             raise Exception('Invalid customization type '
                             + customize_settings.customizationType)
 
-        customize_settings.domainAdministrator = self.vc \
-            .get_view_composer_domain_admin_id(vc_id)
+        customize_settings.domainAdministrator = \
+            ctx['composer_domain_admin_id']
 
         customize_settings.reusePreExistingAccounts = String \
             .is_true(guest_cust_pars['reuse_existing_accounts'])
@@ -1895,13 +3293,9 @@ class Desktops(ViewBase):
         dt_base = self.sud.get_object('ns0:DesktopBase')
         dt_base.name = pl_settings_pars['pool_name']
         dt_base.displayName = pl_settings_pars['pool_name']
-        dt_base.accessGroup = self.get_access_group_id()
+        dt_base.accessGroup = ctx['access_group_id']
         dt_spec.base = dt_base
-
-        desktop_id = self.viewapi.Desktop_Create(self.mor, dt_spec)
-        logging.debug(self.get_host() + ': Start creating pool '
-                      + dt_base.name + ' ID = ' + desktop_id.id)
-        return desktop_id
+        return dt_spec
 
     def create_automated_full_desktop(self, params):
         '''
@@ -1909,6 +3303,30 @@ class Desktops(ViewBase):
         :param params:
         :return:
         '''
+        pool_def_pars = params['pool_definition']
+        vc_setting_pars = params['vc_settings']
+        storage_opt_pars = params['storage_optimization']
+        datastore_paths = vc_setting_pars['datastores']
+
+        ## resolve all lookups first, the independent ones concurrently
+        resolver = DependencyResolver()
+        resolver.add('access_group_id', self.get_access_group_id)
+        self.vc.add_provisioning_lookups(resolver, pool_def_pars['vc'],
+                                         vc_setting_pars,
+                                         template=True)
+        resolver.add('ds_settings',
+                     lambda host_or_cluster_id: self.vc.get_os_datastores(
+                         host_or_cluster_id, datastore_paths),
+                     ['host_or_cluster_id'],
+                     'datastores ' + datastore_paths + ' are not found.')
+        guest_cust_pars = params['guest_customization']
+        if guest_cust_pars['customization_type'].lower() == 'sys_prep':
+            spec_name = guest_cust_pars['customization_spec_name']
+            resolver.add('customization_spec_id',
+                         lambda vc_id: self.vc.get_customization_spec_id(
+                             vc_id, spec_name), ['vc_id'])
+        ctx = resolver.resolve()
+
         dt_spec = self.sud.get_object('ns0:DesktopSpec')
         dt_spec.type = 'AUTOMATED'
 
@@ -1967,11 +3385,7 @@ class Desktops(ViewBase):
         adt_spec = self.sud.get_object('ns0:DesktopAutomatedDesktopSpec')
         adt_spec.provisioningType = 'VIRTUAL_CENTER'
 
-        pool_def_pars = params['pool_definition']
-        vc = pool_def_pars['vc']
-        vc_id = self.vc.get_id(vc)
-        Validation.validate_param(vc_id, 'VC ' + vc + ' is not found')
-        adt_spec.virtualCenter = vc_id
+        adt_spec.virtualCenter = ctx['vc_id']
         user_assignment = self.sud.get_object('ns0:DesktopUserAssignment')
         user_assignment.userAssignment = pool_def_pars['user_assignment']
         if user_assignment.userAssignment == 'DEDICATED':
@@ -2017,49 +3431,17 @@ class Desktops(ViewBase):
         vc_provision_settings.minReadyVMsOnVComposerMaintenance = \
             prov_settings_pars['min_ready_vms']
 
-        vc_setting_pars = params['vc_settings']
-        base_template = vc_setting_pars['template_name']
-        base_template_id = self.vc.get_template_id(vc_id, base_template)
-        Validation.validate_param(base_template_id, 'Template ' + base_template + ' is not found')
         vc_provision_data = self.sud.get_object('ns0:DesktopVirtualCenterProvisioningData')
-        vc_provision_data.template = base_template_id
-        base_template_dc_id = self.vc.get_template_dc_id(vc_id, base_template)
-        Validation.validate_param(base_template_dc_id, 'Datacenter for base '
-                                                       'template '
-                                  + base_template + ' is not found.')
-        vc_provision_data.datacenter = base_template_dc_id
-
-        vm_folder = vc_setting_pars['folder_name']
-        vm_folder_id = self.vc.get_vm_folder_id(base_template_dc_id, vm_folder)
-        Validation.validate_param(vm_folder_id, 'Folder ' + vm_folder
-                                  + ' is not found.')
-        vc_provision_data.vmFolder = vm_folder_id
-
-        host_or_cluster_name = vc_setting_pars['host_or_cluster_name']
-        host_or_cluster_id = self.vc.get_host_or_cluster_id(base_template_dc_id,
-                                                            host_or_cluster_name)
-        Validation.validate_param(host_or_cluster_id, 'Host or cluster '
-                                  + host_or_cluster_name + ' is not found.')
-        vc_provision_data.hostOrCluster = host_or_cluster_id
-
-        resource_pool_name = vc_setting_pars['resource_pool_name']
-        resource_pool_id = self.vc.get_resource_pool_id(host_or_cluster_id,
-                                                        resource_pool_name)
-        Validation.validate_param(resource_pool_id, 'Resource pool '
-                                  + resource_pool_name + ' is not found.')
-        vc_provision_data.resourcePool = resource_pool_id
+        vc_provision_data.template = ctx['image_id']
+        vc_provision_data.datacenter = ctx['dc_id']
+        vc_provision_data.vmFolder = ctx['vm_folder_id']
+        vc_provision_data.hostOrCluster = ctx['host_or_cluster_id']
+        vc_provision_data.resourcePool = ctx['resource_pool_id']
         vc_provision_settings.virtualCenterProvisioningData = vc_provision_data
 
-        datastore_paths = vc_setting_pars['datastores']
-        ds_settings = self.vc.get_os_datastores(host_or_cluster_id,
-                                                datastore_paths)
-        Validation.validate_param(ds_settings, 'datastores '
-                                  + datastore_paths + ' are not found.')
-
-        storage_opt_pars = params['storage_optimization']
         vc_storage_settings = self.sud \
             .get_object('ns0:DesktopVirtualCenterStorageSettings')
-        vc_storage_settings.datastores = ds_settings
+        vc_storage_settings.datastores = ctx['ds_settings']
         vc_storage_settings.useVSan = String.is_true(storage_opt_pars
                                                      ['use_vsan'])
         adv_storage_opt_pars = params['advanced_storage_options']
@@ -2082,7 +3464,6 @@ class Desktops(ViewBase):
 
         adt_spec.virtualCenterProvisioningSettings = vc_provision_settings
 
-        guest_cust_pars = params['guest_customization']
         customize_settings = self.sud \
             .get_object('ns0:DesktopCustomizationSettings')
         customize_settings.customizationType = \
@@ -2095,9 +3476,8 @@ class Desktops(ViewBase):
         elif customize_settings.customizationType.lower() == 'sys_prep':
             sys_prep_cust_settings = self.sud \
                 .get_object('ns0:DesktopSysprepCustomizationSettings')
-            spec_name = guest_cust_pars['customization_spec_name']
-            sys_prep_cust_settings.customizationSpec = self.vc \
-                .get_customization_spec_id(vc_id, spec_name)
+            sys_prep_cust_settings.customizationSpec = \
+                ctx['customization_spec_id']
             customize_settings.sysprepCustomizationSettings = \
                 sys_prep_cust_settings
         else:
@@ -2117,10 +3497,11 @@ class Desktops(ViewBase):
         dt_base = self.sud.get_object('ns0:DesktopBase')
         dt_base.name = pl_settings_pars['pool_name']
         dt_base.displayName = pl_settings_pars['pool_name']
-        dt_base.accessGroup = self.get_access_group_id()
+        dt_base.accessGroup = ctx['access_group_id']
         dt_spec.base = dt_base
 
         desktop_id = self.viewapi.Desktop_Create(self.mor, dt_spec)
+        self.lookups.invalidate('desktop', dt_base.name)
         return desktop_id
 
     def create_rds_desktop(self, params):
@@ -2157,6 +3538,7 @@ class Desktops(ViewBase):
         dt_spec.rdsDesktopSpec = dt_rds_spec
 
         desktop_id = self.viewapi.Desktop_Create(self.mor, dt_spec)
+        self.lookups.invalidate('desktop', dt_base.name)
         return desktop_id
 
     def delete(self, desktop_id):
@@ -2168,6 +3550,7 @@ class Desktops(ViewBase):
         spec = self.sud.get_object('ns0:DesktopDeleteSpec')
         spec.archivePersistentDisk = False
         self.viewapi.Desktop_Delete(self.mor, desktop_id, spec)
+        self.lookups.invalidate('desktop')
 
     def delete_by_name(self, desktop_name):
         '''
@@ -2178,34 +3561,97 @@ class Desktops(ViewBase):
         logging.debug(self.get_host() + ': deleting pool ' + desktop_name)
         self.delete(self.get_desktop_id_by_name(desktop_name))
 
-    def delete_all(self, desktop_type):
-        '''
-        Destroy all desktops of given type
-        :param desktop_type:
-        :return:
+    def delete_all(self, desktop_type,
+                   max_concurrency=BatchRunner.MAX_CONCURRENCY,
+                   journal_path=None, wait=False):
+        '''
+        Destroy all desktops of given type, deleting max_concurrency of them
+        at once. Pools whose deletion fails do not stop the others, and are
+        reported in the raised error once all pools were tried.
+        :param desktop_type: None to destroy all desktops
+        :param max_concurrency:
+        :param journal_path: the file recording the deleted pools, so that a
+        run interrupted half way can be resumed. None to not record them.
+        :param wait: whether to wait until the pools are gone
+        :return: the names of the deleted pools, and of the pools skipped
+        since they were deleted by a previous run
         '''
         d_filter = None
         if desktop_type:
             d_filter = self.queries.get_equal_filter(
                 'desktopSummaryData.type', desktop_type)
-        ret = self.query_desktop(d_filter)
-
-        if not ret or not hasattr(ret, 'results'):
-            return
+        journal = DeleteJournal(journal_path)
 
-        for desktop in ret.results:
+        ## the specs are only read when marshalling, so they are shared
+        specs = {}
+        for del_from_disk in (False, True):
             spec = self.sud.get_object('ns0:DesktopDeleteSpec')
             spec.archivePersistentDisk = False
+            spec.deleteFromDisk = del_from_disk
+            specs[del_from_disk] = spec
+
+        desktops = []
+        skipped = []
+        desktop_ids = set()
+        for desktop in self.queries.stream(d_filter, 'DesktopSummaryView'):
+            desktop_ids.add(desktop.id.id)
+            if journal.is_deleted(desktop.id.id):
+                skipped.append(desktop.desktopSummaryData.name)
+            else:
+                desktops.append(desktop)
+
+        def delete(desktop):
             d_source = desktop.desktopSummaryData.source
             d_type = desktop.desktopSummaryData.type
             d_name = desktop.desktopSummaryData.name
             del_from_disk = d_type.lower() == 'automated' or \
                             (d_type.lower() == 'manual' and
                              d_source.lower() == 'virtual_center')
-            spec.deleteFromDisk = del_from_disk
-            logging.debug(self.get_host() + ': deleting pool ' + d_name + ' with id '
-                          + String.to_string(desktop.id))
-            self.viewapi.Desktop_Delete(self.mor, desktop.id, spec)
+            logging.debug(self.get_host() + ': deleting pool ' + d_name
+                          + ' with id ' + String.to_string(desktop.id))
+            self.viewapi.Desktop_Delete(self.mor, desktop.id,
+                                        specs[del_from_disk])
+            self.lookups.invalidate('desktop', d_name)
+            journal.add(desktop.id.id, d_name)
+
+        results = BatchRunner(max_concurrency).run(delete, desktops)
+        deleted = []
+        failed = []
+        for desktop, (_, error) in zip(desktops, results):
+            d_name = desktop.desktopSummaryData.name
+            if error:
+                failed.append(d_name + ' (' + str(error) + ')')
+            else:
+                deleted.append(d_name)
+        if failed:
+            raise Exception('Failed to delete pools ' + ', '.join(failed))
+
+        if wait:
+            self.wait_deleted(d_filter, desktop_ids)
+        return {'deleted': deleted, 'skipped': skipped}
+
+    def wait_deleted(self, d_filter, desktop_ids):
+        '''
+        Wait until none of the given desktops exists
+        :param d_filter: the filter of the desktops
+        :param desktop_ids: the id strings of the desktops
+        :return:
+        '''
+        waiter = Waiter(Timings().get_timeout_sec_4(),
+                        Timings().get_task_wait_interval_sec_3(),
+                        self.get_host() + ': waiting for pools to be deleted')
+        remaining = {}
+        while waiter.waiting():
+            remaining = dict(
+                (desktop.id.id, desktop.desktopSummaryData.name)
+                for desktop in self.queries.stream(d_filter,
+                                                   'DesktopSummaryView')
+                if desktop.id.id in desktop_ids)
+            if not remaining:
+                return
+        raise Exception('Pools ' + ', '.join(sorted(remaining.values()))
+                        + ' are not deleted after '
+                        + str(waiter.max_wait_sec) + 's')
 
     def refresh(self, desktop_name):
         '''
@@ -2264,6 +3710,40 @@ class Desktops(ViewBase):
         self.viewapi.Desktop_Recompose(self.mor, desktop_id, spec)
 
     def create_instant_clone_pool(self, params, view_param):
+        pool_def_pars = params['pool_definition']
+        vc_setting_pars = params['vc_settings']
+        storage_opt_pars = params['storage_optimization']
+        datastore_paths = vc_setting_pars['datastores']
+
+        ## resolve all lookups first, the independent ones concurrently
+        resolver = DependencyResolver()
+        resolver.add('access_group_id', self.get_access_group_id)
+        self.vc.add_provisioning_lookups(resolver, pool_def_pars['vc'],
+                                         vc_setting_pars)
+        resolver.add('ds_settings',
+                     lambda host_or_cluster_id: self.vc.get_os_datastores(
+                         host_or_cluster_id, datastore_paths),
+                     ['host_or_cluster_id'],
+                     'datastores ' + datastore_paths + ' are not found.')
+        if String.is_true(storage_opt_pars[
+                'use_separate_datastore_4_replica_and_os_disks']):
+            resolver.add('replica_datastore_id',
+                         lambda host_or_cluster_id: self.vc
+                         .get_replica_datastore_id(host_or_cluster_id,
+                                                   datastore_paths),
+                         ['host_or_cluster_id'])
+        networks = vc_setting_pars['networks']
+        if networks:
+            nic = vc_setting_pars['nic']
+            resolver.add('nics',
+                         lambda host_or_cluster_id, image_ss_id: self.vc
+                         .get_networks(host_or_cluster_id, networks,
+                                       image_ss_id, nic),
+                         ['host_or_cluster_id', 'image_ss_id'])
+        self.instantclonedomain.add_clone_prep_lookups(resolver, view_param)
+        ctx = resolver.resolve()
+        self.instantclonedomain.add_missing_clone_prep_admin(ctx, view_param)
+
         desktop_spec = self.sud.get_object('ns0:DesktopSpec')
         desktop_spec.type = 'AUTOMATED'
 
@@ -2319,11 +3799,7 @@ class Desktops(ViewBase):
         adt_spec = self.sud.get_object('ns0:DesktopAutomatedDesktopSpec')
         adt_spec.provisioningType = 'INSTANT_CLONE_ENGINE'
 
-        pool_def_pars = params['pool_definition']
-        vc = pool_def_pars['vc']
-        vc_id = self.vc.get_id(vc)
-        Validation.validate_param(vc_id, 'VC ' + vc + ' is not found')
-        adt_spec.virtualCenter = vc_id
+        adt_spec.virtualCenter = ctx['vc_id']
         user_assignment = self.sud.get_object('ns0:DesktopUserAssignment')
         user_assignment.userAssignment = 'FLOATING'
         adt_spec.userAssignment = user_assignment
@@ -2364,58 +3840,19 @@ class Desktops(ViewBase):
                         prov_settings_pars['stop_provision_on_error'])
         vc_provision_settings.minReadyVMsOnVComposerMaintenance = 0
 
-        vc_setting_pars = params['vc_settings']
-        base_image = vc_setting_pars['vm_name']
-        base_image_id = self.vc.get_vm_id(vc_id, base_image)
-        Validation.validate_param(base_image_id, 'Base image ' + base_image \
-                                  + ' is not found.')
         vc_provision_data = self.sud\
                     .get_object('ns0:DesktopVirtualCenterProvisioningData')
-        vc_provision_data.parentVm = base_image_id
-
-        base_image_ss_path = vc_setting_pars['snapshot_path']
-        base_image_ss_id = self.vc.get_vm_ss_id(vc_id, base_image, \
-                                                base_image_ss_path)
-        Validation.validate_param(base_image_ss_id, 'Snapshot ' \
-                            + base_image_ss_path + ' for base image '
-                            + base_image + ' is not found.')
-
-        vc_provision_data.snapshot = base_image_ss_id
-        base_image_dc_id = self.vc.get_vm_dc_id(vc_id, base_image)
-        Validation.validate_param(base_image_dc_id, 'Datacenter for base image ' \
-                                  + base_image + ' is not found.')
-        vc_provision_data.datacenter = base_image_dc_id
-
-        vm_folder = vc_setting_pars['folder_name']
-        vm_folder_id = self.vc.get_vm_folder_id(base_image_dc_id, vm_folder)
-        Validation.validate_param(vm_folder_id, 'Folder ' + vm_folder \
-                                  + ' is not found.')
-        vc_provision_data.vmFolder = vm_folder_id
-
-        host_or_cluster_name = vc_setting_pars['host_or_cluster_name']
-        host_or_cluster_id = self.vc.get_host_or_cluster_id(base_image_dc_id, \
-                                                        host_or_cluster_name)
-        Validation.validate_param(host_or_cluster_id, 'Cluster ' \
-                                  + host_or_cluster_name + ' is not found.')
-        vc_provision_data.hostOrCluster = host_or_cluster_id
-
-        resource_pool_name = vc_setting_pars['resource_pool_name']
-        resource_pool_id = self.vc.get_resource_pool_id(host_or_cluster_id, \
-                                                        resource_pool_name)
-        Validation.validate_param(resource_pool_id, 'Resource pool ' \
-                                  + resource_pool_name + ' is not found.')
-        vc_provision_data.resourcePool = resource_pool_id
+        vc_provision_data.parentVm = ctx['image_id']
+        vc_provision_data.snapshot = ctx['image_ss_id']
+        vc_provision_data.datacenter = ctx['dc_id']
+        vc_provision_data.vmFolder = ctx['vm_folder_id']
+        vc_provision_data.hostOrCluster = ctx['host_or_cluster_id']
+        vc_provision_data.resourcePool = ctx['resource_pool_id']
         vc_provision_settings.virtualCenterProvisioningData = vc_provision_data
 
-        datastore_paths = vc_setting_pars['datastores']
-        ds_settings = self.vc.get_os_datastores(host_or_cluster_id, datastore_paths)
-        Validation.validate_param(ds_settings, 'datastores ' \
-                                  + datastore_paths + ' are not found.')
-
-        storage_opt_pars = params['storage_optimization']
         vc_storage_settings = self.sud\
                     .get_object('ns0:DesktopVirtualCenterStorageSettings')
-        vc_storage_settings.datastores = ds_settings
+        vc_storage_settings.datastores = ctx['ds_settings']
         vc_storage_settings.useVSan = String.is_true(storage_opt_pars\
                                                          ['use_vsan'])
 
@@ -2425,8 +3862,8 @@ class Desktops(ViewBase):
                 String.is_true(storage_opt_pars
                             ['use_separate_datastore_4_replica_and_os_disks'])
         if view_composer_storage_settings.useSeparateDatastoresReplicaAndOSDisks:
-            view_composer_storage_settings.replicaDiskDatastore = self.vc\
-                    .get_replica_datastore_id(host_or_cluster_id, datastore_paths)
+            view_composer_storage_settings.replicaDiskDatastore = \
+                    ctx['replica_datastore_id']
         view_composer_storage_settings.useNativeSnapshots = False
         space_reclaim_settings = self.sud\
                             .get_object('ns0:DesktopSpaceReclamationSettings')
@@ -2460,10 +3897,8 @@ class Desktops(ViewBase):
 
         vc_network_settings = self.sud\
                         .get_object('ns0:DesktopVirtualCenterNetworkingSettings')
-        networks = vc_setting_pars['networks']
-        if networks:
-            nic = vc_setting_pars['nic']
-            vc_network_settings.nics = self.vc.get_networks(host_or_cluster_id, networks, base_image_ss_id, nic)
+        if 'nics' in ctx:
+            vc_network_settings.nics = ctx['nics']
         vc_provision_settings.virtualCenterNetworkingSettings = vc_network_settings
 
         adt_spec.virtualCenterProvisioningSettings = vc_provision_settings
@@ -2473,33 +3908,11 @@ class Desktops(ViewBase):
         customize_settings.customizationType = "CLONE_PREP"
         customize_settings.reusePreExistingAccounts = False
 
-        domain_name = view_param['domain']
-        ad_domain_id = self.instantclonedomain.get_ad_domain_id(domain_name)
-        Validation.validate_param(ad_domain_id, 'ADDomainId for ' \
-                                  + domain_name + ' is not found.')
-        ad_container_infos = self.viewapi.ADContainer_ListByDomain(MOR\
-                                .get_mor('ADContainer'), ad_domain_id)
-        for ad_container_info in ad_container_infos:
-            if ad_container_info.rdn == "CN=Computers":
-                ad_container_id = ad_container_info.id
-                break
-        Validation.validate_param(ad_container_id, 'ADContainerId for ' \
-                                  + domain_name + ' is not found.')
-        customize_settings.adContainer = ad_container_id
+        customize_settings.adContainer = ctx['ad_container_id']
         cloneprep_customize_settings = self.sud\
                         .get_object('ns0:DesktopCloneprepCustomizationSettings')
-        instant_clone_domain_admin_id = self.instantclonedomain\
-                        .get_instant_clone_domain_admin_id(domain_name)
-        if instant_clone_domain_admin_id is None:
-            user = view_param['user']
-            password = view_param['password']
-            logging.info('Adding Instant clone engine domain admin')
-            instant_clone_domain_admin_id = self.instantclonedomain\
-                .add_instant_clone_domain_admin(domain_name, user, password)
-            logging.debug('Instant Clone domain id = ' \
-                + str(instant_clone_domain_admin_id))
         cloneprep_customize_settings.instantCloneEngineDomainAdministrator = \
-                         instant_clone_domain_admin_id
+                         ctx['instant_clone_domain_admin_id']
         customize_settings.cloneprepCustomizationSettings = \
                          cloneprep_customize_settings
         adt_spec.customizationSettings = customize_settings
@@ -2508,10 +3921,11 @@ class Desktops(ViewBase):
         desktop_base = self.sud.get_object('ns0:DesktopBase')
         desktop_base.name = pl_settings_pars['pool_name']
         desktop_base.displayName = pl_settings_pars['pool_name']
-        desktop_base.accessGroup = self.get_access_group_id()
+        desktop_base.accessGroup = ctx['access_group_id']
         desktop_spec.base = desktop_base
 
         desktop_id = self.viewapi.Desktop_Create(self.mor, desktop_spec)
+        self.lookups.invalidate('desktop', desktop_base.name)
         logging.debug('Start creating instant clone pool ' + desktop_base.name + ' ID = ' \
                      + desktop_id.id)
         return desktop_id
@@ -2552,20 +3966,21 @@ class Desktops(ViewBase):
         logging.debug('Start pushing image to the pool ' + pool_name)
         self.viewapi.Desktop_SchedulePushImage(self.mor, desktop_id, push_image_spec)
 
-    def get_all_machines_in_pool(self, pool_name):
+    def get_all_machines_in_pool(self, pool_name, prefetch=0):
         '''
         Queries View for pool name and get selective machine properties like
         agent state, dns name etc
         :param pool_name: Desktop Pool name
+        :param prefetch: the number of result pages to read ahead
         :return: Machine properties in the form of a dictionary
         Key- Machine Name
         Attributes include View Agent State, Computer FQDN
         '''
         desktop_id = self.get_desktop_id_by_name(pool_name)
         query_filter = self.queries.get_equal_filter('base.desktop', desktop_id)
-        machines = self.query_machine_names_view(query_filter)
         machine_properties = {}
-        for machine in machines:
+        for machine in self.queries.stream(query_filter, 'MachineNamesView',
+                                           prefetch=prefetch):
             machine_name = str(machine.base.name)
             machine_properties[machine_name] = {}
             if hasattr(machine.base, 'basicState'):
@@ -2586,6 +4001,18 @@ class Queries(ViewBase):
     Helper for View Query service APIs
     '''
 
+    ## maximum number of names OR'ed together in one query by resolve
+    RESOLVE_WIDTH = 50
+    ## the page size of queries only counting their results
+    COUNT_PAGE_SIZE = 1000
+    ## the faults of a query filtering on a member the broker cannot filter
+    FILTER_FAULTS = ('InvalidArgument', 'InvalidType')
+
+    def __init__(self, sud, helpers=None):
+        super(Queries, self).__init__(sud, helpers)
+        ## (entity type, member name) pairs the broker refused to filter on
+        self.client_side_members = set()
+
     def get_mor_type(self):
         return 'QueryService'
 
@@ -2601,30 +4028,35 @@ class Queries(ViewBase):
         query_def.filter = query_filter
         return query_def
 
-    def get_filter(self, filter_type, entity_name, entity_value):
+    def get_filter(self, filter_type, entity_name, entity_value,
+                   value_type=None):
         '''
         Create a filter
         :param filter_type:
         :param entity_name:
         :param entity_value:
+        :param value_type: the xsi type of the value, e.g. xsd:string
         :return:
         '''
-        if 'name' in entity_name.lower():
+        if value_type:
+            self.sud.set_value_type(value_type)
+        elif 'name' in entity_name.lower():
             self.sud.set_value_type('xsd:string')
         query_filter = self.sud.get_object(filter_type)
         query_filter.memberName = entity_name
         query_filter.value = entity_value
         return query_filter
 
-    def get_equal_filter(self, entity_name, entity_value):
+    def get_equal_filter(self, entity_name, entity_value, value_type=None):
         '''
         Create an EQUAL filter
         :param entity_name:
         :param entity_value:
+        :param value_type: the xsi type of the value, e.g. xsd:string
         :return:
         '''
         return self.get_filter('ns0:QueryFilterEquals', entity_name,
-                               entity_value)
+                               entity_value, value_type)
 
     def get_and_filter(self, filters):
         '''
@@ -2646,6 +4078,183 @@ class Queries(ViewBase):
         or_filter.filters = filters
         return or_filter
 
+    @staticmethod
+    def get_member(entity, member_name):
+        '''
+        Fetch the value of a member given its dotted name, e.g. data.name
+        :param entity:
+        :param member_name:
+        :return:
+        '''
+        for name in member_name.split('.'):
+            entity = getattr(entity, name)
+        return entity
+
+    @staticmethod
+    def equals(value, expected):
+        '''
+        Compare a member value with the expected one, ID objects by their id
+        :param value:
+        :param expected:
+        :return:
+        '''
+        if hasattr(expected, 'id'):
+            return getattr(value, 'id', None) == expected.id
+        return value == expected
+
+    def stream_where(self, query_filter, entity_type, member_name,
+                     member_value, value_type='xsd:string', prefetch=0):
+        '''
+        Iterate over the entities matching given type and filter whose member
+        equals the given value. See stream_pushdown.
+        :param query_filter: the filter, None to fetch all entities
+        :param entity_type:
+        :param member_name: the dotted name of the member, e.g. base.basicState
+        :param member_value:
+        :param value_type: the xsi type of the value, None to leave it as is
+        :param prefetch: the number of pages to read ahead
+        :return:
+        '''
+        member_filter = self.get_equal_filter(member_name, member_value,
+                                              value_type)
+        return self.stream_pushdown(
+            query_filter, entity_type, member_name, member_filter,
+            lambda entity: self.equals(self.get_member(entity, member_name),
+                                       member_value),
+            prefetch)
+
+    def stream_pushdown(self, query_filter, entity_type, member_name,
+                        member_filter, predicate, prefetch=0):
+        '''
+        Iterate over the entities matching given type and filter, and a
+        filter on one member. The member filter is added to the query, so
+        that the broker only returns matching entities. If the broker refuses
+        to filter on the member, the predicate is applied to the unfiltered
+        results instead, and from then on for this type and member. Other
+        errors, e.g. of the transport or the session, are raised.
+        :param query_filter: the filter, None to fetch all entities
+        :param entity_type:
+        :param member_name: the dotted name of the filtered member
+        :param member_filter: the filter on the member
+        :param predicate: the same filter, applied to an entity
+        :param prefetch: the number of pages to read ahead
+        :return:
+        '''
+        key = (entity_type, member_name)
+        refused = False
+        if key not in self.client_side_members:
+            if query_filter is not None:
+                member_filter = self.get_and_filter([query_filter,
+                                                     member_filter])
+            pages = self.pages(member_filter, entity_type, prefetch=prefetch)
+            try:
+                page = next(pages, None)
+            except WebFault as e:
+                if not Queries.is_filter_refused(e, member_name):
+                    raise
+                logging.debug(self.get_host() + ': ' + entity_type
+                              + ' cannot be filtered on ' + member_name
+                              + ', filtering results instead')
+                self.client_side_members.add(key)
+                refused = True
+            if not refused:
+                try:
+                    while page is not None:
+                        for entity in page:
+                            yield entity
+                        page = next(pages, None)
+                finally:
+                    pages.close()
+                return
+
+        try:
+            for entity in self.stream(query_filter, entity_type,
+                                      prefetch=prefetch):
+                if predicate(entity):
+                    yield entity
+        except Exception:
+            ## the query fails as a whole, not because of the member
+            if refused:
+                self.client_side_members.discard(key)
+            raise
+
+    @staticmethod
+    def is_filter_refused(fault, member_name):
+        '''
+        Whether a fault is the broker refusing a filter on the given member
+        :param fault: the WebFault
+        :param member_name:
+        :return:
+        '''
+        fault = fault.fault
+        if member_name in unicode(getattr(fault, 'faultstring', '')):
+            return True
+        detail = getattr(fault, 'detail', None)
+        return any(name in Queries.FILTER_FAULTS
+                   for name in getattr(detail, '__keylist__', ()))
+
+    def resolve(self, entity_type, member_name, names, width=RESOLVE_WIDTH,
+                query_filter=None):
+        '''
+        Search for the entities matching any of the given names, using one OR
+        query per batch of width names instead of one query per name
+        :param entity_type:
+        :param member_name: the name member, e.g. data.name
+        :param names:
+        :param width: the number of names per query
+        :param query_filter: an additional filter, None for no filter
+        :return: the list of matching entities of each name
+        '''
+        ret = {}
+        by_lower_name = OrderedDict()
+        for name in names:
+            by_lower_name.setdefault(name.lower(), name)
+            ret[name] = []
+        lower_names = by_lower_name.keys()
+
+        for i in range(0, len(lower_names), width):
+            filters = [self.get_equal_filter(member_name,
+                                             by_lower_name[lower_name])
+                       for lower_name in lower_names[i:i + width]]
+            if len(filters) == 1:
+                batch_filter = filters[0]
+            else:
+                batch_filter = self.get_or_filter(filters)
+            if query_filter is not None:
+                batch_filter = self.get_and_filter([query_filter,
+                                                    batch_filter])
+            for entity in self.stream(batch_filter, entity_type):
+                name = self.get_member(entity, member_name)
+                if name.lower() in by_lower_name:
+                    ret[by_lower_name[name.lower()]].append(entity)
+
+        for name in names:
+            ret[name] = ret[by_lower_name[name.lower()]]
+        return ret
+
+    @staticmethod
+    def get_unique_ids(resolved, label, get_id=lambda entity: entity.id):
+        '''
+        Reduce the result of resolve to the ID of each name, making sure that
+        every name matches exactly one entity
+        :param resolved: the result of resolve
+        :param label: the kind of entity for error messages, e.g. pool
+        :param get_id: fetches the ID of an entity
+        :return:
+        '''
+        missing = sorted(name for name, entities in resolved.items()
+                         if not entities)
+        if missing:
+            raise Exception('Found no ' + label + ' with name '
+                            + ', '.join(missing))
+        duplicates = sorted(name for name, entities in resolved.items()
+                            if len(entities) > 1)
+        if duplicates:
+            raise Exception('Found more than 1 ' + label + ' with name '
+                            + ', '.join(duplicates))
+        return dict((name, get_id(entities[0]))
+                    for name, entities in resolved.items())
+
     def query(self, query_filter, entity_type):
         '''
         Search for entities matching given type and filter
@@ -2702,6 +4311,108 @@ class Queries(ViewBase):
         '''
         self.viewapi.QueryService_Delete(self.mor, query_id)
 
+    def pages(self, query_filter, entity_type, page_size=None, prefetch=0):
+        '''
+        Iterate over the result pages of entities matching given type and
+        filter. Only the current page is held in memory. The query is deleted
+        once the iteration ends, including when the caller stops early and
+        closes or drops the iterator.
+        :param query_filter: the filter, None to fetch all entities
+        :param entity_type:
+        :param page_size: the maximum number of entities per page
+        :param prefetch: the number of pages to read ahead on a worker
+        thread, 0 to read each page when the caller asks for it
+        :return:
+        '''
+        query_def = self.get_query_def(query_filter, entity_type)
+        if page_size:
+            query_def.maxPageSize = page_size
+        ret = self.viewapi.QueryService_Create(self.mor, query_def)
+        query_id = ret.id
+        reader = None
+        try:
+            if prefetch:
+                reader = PageReader(self, ret, query_id, prefetch)
+                for page in reader:
+                    yield page
+            else:
+                while 'results' in ret:
+                    yield ret.results
+                    ret = self.next(query_id)
+        finally:
+            if reader:
+                reader.stop()
+            self.delete(query_id)
+
+    def count(self, query_filter, entity_type, key=None,
+              page_size=COUNT_PAGE_SIZE):
+        '''
+        Count the entities matching given type and filter. The result pages
+        are read and dropped one by one, only the counters are kept.
+        :param query_filter: the filter, None to count all entities
+        :param entity_type:
+        :param key: fetches the key to count an entity under, None to only
+        count the entities
+        :param page_size: the maximum number of entities per page
+        :return: the count, or the count of each key
+        '''
+        ret = 0 if key is None else {}
+        for page in self.pages(query_filter, entity_type, page_size):
+            if key is None:
+                ret += len(page)
+            else:
+                for entity in page:
+                    entity_key = key(entity)
+                    ret[entity_key] = ret.get(entity_key, 0) + 1
+        return ret
+
+    def count_by_ref(self, entity_type, member_name, ids, key,
+                         query_filter=None, width=RESOLVE_WIDTH):
+        '''
+        Count the entities referencing any of the given ids, using one OR
+        query per batch of width ids. See count.
+        :param entity_type:
+        :param member_name: the member referencing the id, e.g. base.desktop
+        :param ids:
+        :param key: fetches the key to count an entity under
+        :param query_filter: an additional filter, None for no filter
+        :param width: the number of ids per query
+        :return: the count of each key
+        '''
+        ret = {}
+        for i in range(0, len(ids), width):
+            filters = [self.get_equal_filter(member_name, ref_id)
+                       for ref_id in ids[i:i + width]]
+            if len(filters) == 1:
+                batch_filter = filters[0]
+            else:
+                batch_filter = self.get_or_filter(filters)
+            if query_filter is not None:
+                batch_filter = self.get_and_filter([query_filter,
+                                                    batch_filter])
+            for entity_key, count in self.count(batch_filter, entity_type,
+                                                key).items():
+                ret[entity_key] = ret.get(entity_key, 0) + count
+        return ret
+
+    def stream(self, query_filter, entity_type, page_size=None, prefetch=0):
+        '''
+        Iterate over the entities matching given type and filter, page by
+        page. See pages.
+        :param query_filter: the filter, None to fetch all entities
+        :param entity_type:
+        :param page_size: the maximum number of entities per page
+        :param prefetch: the number of pages to read ahead
+        :return:
+        '''
+        pages = self.pages(query_filter, entity_type, page_size, prefetch)
+        try:
+            for page in pages:
+                for entity in page:
+                    yield entity
+        finally:
+            pages.close()
+
 
 class GlobalSettings(ViewBase):
     '''
@@ -2747,47 +4458,116 @@ class Misc(ViewBase):
     Helper for misc View APIs
     '''
 
-    def __init__(self, sud):
-        super(Misc, self).__init__(sud)
-        self.queries = Queries(sud)
+    queries = Helper('Queries')
+    principals = Shared(PrincipalCache)
 
     def get_user_or_group_id(self, login_name, domain_name=None):
         '''
-        Fetch the user or group ID object given the name
+        Fetch the user or group ID objects given the name, cached
         :param login_name:
         :param domain_name:
         :return:
         '''
-        q_filter = None
-        if domain_name:
-            filters = []
-            filters.append(
-                self.queries.get_equal_filter('base.loginName', login_name))
-            filters.append(
-                self.queries.get_equal_filter('base.domain', domain_name))
-            q_filter = self.queries.get_and_filter(filters)
-        else:
-            q_filter = self.queries.get_equal_filter('base.loginName',
-                                                     login_name)
-
-        rt = self.query_user_or_group(q_filter)
+        rt = self.resolve_users_or_groups([login_name],
+                                          domain_name)[login_name]
         logging.debug(self.get_host() + ': user/group ' + login_name
                       + ' = ' + String.to_string(rt))
         return rt
 
+    def resolve_users_or_groups(self, login_names, domain_name=None,
+                                width=None):
+        '''
+        Fetch the user or group ID objects of many names, cached. The names
+        missing from the cache are searched for in batched queries.
+        :param login_names:
+        :param domain_name: None to search all domains
+        :param width: the number of names per query
+        :return: the list of user or group ID objects of each name, empty if
+        the name is not found
+        '''
+        def get_key(login_name):
+            return (domain_name or '').lower() + '\\' + login_name.lower()
+
+        ret = {}
+        missing = []
+        for login_name in login_names:
+            uog_ids = self.principals.peek('principal',
+                                           get_key(login_name))
+            if uog_ids is None:
+                missing.append(login_name)
+            else:
+                ret[login_name] = uog_ids
+
+        if missing:
+            domain_filter = None
+            if domain_name:
+                domain_filter = self.queries.get_equal_filter('base.domain',
+                                                              domain_name)
+            resolved = self.queries.resolve('ADUserOrGroupSummaryView',
+                                            'base.loginName', missing,
+                                            width or Queries.RESOLVE_WIDTH,
+                                            domain_filter)
+            for login_name, entities in resolved.items():
+                uog_ids = [entity.id for entity in entities]
+                ttl_sec = None
+                if not uog_ids:
+                    ttl_sec = PrincipalCache.NEGATIVE_TTL_SEC
+                self.principals.put('principal', get_key(login_name),
+                                    uog_ids, ttl_sec)
+                ret[login_name] = uog_ids
+        return ret
+
+    def entitle_many(self, resource_ids, login_names, domain_name=None,
+                     max_concurrency=BatchRunner.MAX_CONCURRENCY):
+        '''
+        Entitle every user or group to every desktop or app pool. The users
+        and groups are resolved in batches, and the entitlements are created
+        max_concurrency at a time. A failed entitlement does not stop the
+        others.
+        :param resource_ids: the desktop or app ID objects, keyed by name
+        :param login_names:
+        :param domain_name:
+        :param max_concurrency:
+        :return: the outcome of each entitlement, a dict with resource,
+        login_name and error, which is None if the entitlement was created
+        '''
+        uog_ids = self.resolve_users_or_groups(login_names, domain_name)
+        items = [(resource_name, login_name)
+                 for resource_name in resource_ids
+                 for login_name in login_names]
+
+        def entitle(item):
+            resource_name, login_name = item
+            if not uog_ids[login_name]:
+                raise Exception('User or group ' + login_name
+                                + ' is not found')
+            ue_base = self.sud.get_object('ns0:UserEntitlementBase')
+            ue_base.resource = resource_ids[resource_name]
+            ue_base.userOrGroup = uog_ids[login_name]
+            self.viewapi.UserEntitlement_Create(
+                MOR.get_mor('UserEntitlement'), ue_base)
+
+        results = BatchRunner(max_concurrency).run(entitle, items)
+        ret = []
+        for (resource_name, login_name), (_, error) in zip(items, results):
+            if error:
+                logging.error(self.get_host() + ': failed to entitle '
+                              + login_name + ' to ' + resource_name + ': '
+                              + str(error))
+            ret.append({'resource': resource_name, 'login_name': login_name,
+                        'error': error})
+        return ret
+
     def query_user_or_group(self, query_filter):
         '''
         Search for the user or group given a filter
         :param query_filter:
         :return:
         '''
-        ret = self.queries.create(query_filter, 'ADUserOrGroupSummaryView')
-        query_id = ret.id
         rets = []
-        while 'results' in ret:
-            for res in ret.results:
-                rets.append(res.id)
-            ret = self.queries.next(query_id)
+        for res in self.queries.stream(query_filter,
+                                       'ADUserOrGroupSummaryView'):
+            rets.append(res.id)
         return rets
 
     def entitle_user_or_group(self, desktop_id, login_name, domain_name=None):
@@ -2844,23 +4624,36 @@ class Sessions(ViewBase):
     Helper for View session APIs
     '''
 
-    def __init__(self, sud):
-        super(Sessions, self).__init__(sud)
-        self.queries = Queries(sud)
-        self.desktops = Desktops(sud)
-        self.apps = Apps(sud)
+    queries = Helper('Queries')
+    desktops = Helper('Desktops')
+    apps = Helper('Apps')
 
     def get_mor_type(self):
         return 'Session'
 
-    def get_local_session(self, session_type, session_state, query_filters):
+    def get_local_session(self, session_type, session_state, query_filters,
+                          prefetch=0):
         '''
         Fetch a list of sessions matching given type, state, and filters
         :param session_type:
         :param session_state:
         :param query_filters:
+        :param prefetch: the number of result pages to read ahead
         :return:
         '''
+        return list(self.queries.stream(
+            self.get_session_filter(session_type, session_state,
+                                    query_filters),
+            'SessionLocalSummaryView', prefetch=prefetch))
+
+    def get_session_filter(self, session_type, session_state, query_filters):
+        '''
+        Get the filter of sessions matching given type, state, and filters
+        :param session_type:
+        :param session_state:
+        :param query_filters:
+        :return: the filter, None to match all sessions
+        '''
         filters = []
         if session_type in ('DESKTOP', 'APPLICATION'):
             query_filter = self.queries \
@@ -2873,7 +4666,7 @@ class Sessions(ViewBase):
             filters.append(query_filter)
 
         if query_filters:
-            if query_filters is list:
+            if isinstance(query_filters, list):
                 filters.extend(query_filters)
             else:
                 filters.extend([query_filters])
@@ -2883,32 +4676,21 @@ class Sessions(ViewBase):
             filter_tmp = filters[0]
         elif len(filters) > 1:
             filter_tmp = self.queries.get_and_filter(filters)
+        return filter_tmp
 
-        query_id = None
-        try:
-            ret = self.queries.create(filter_tmp, 'SessionLocalSummaryView')
-            query_id = ret.id
-            sessions = []
-            while 'results' in ret:
-                for session in ret.results:
-                    sessions.append(session)
-                ret = self.queries.next(query_id)
-            return sessions
-        finally:
-            if query_id:
-                self.queries.delete(query_id)
-
-    def get_desktop_sessions(self, session_state, desktop_name):
+    def get_desktop_sessions(self, session_state, desktop_name, prefetch=0):
         '''
         Fetch desktop sessions matching given state and desktop name
         :param session_state:
         :param desktop_name:
+        :param prefetch: the number of result pages to read ahead
         :return:
         '''
         desktop_id = self.desktops.get_desktop_id_by_name(desktop_name)
         query_filter = self.queries.get_equal_filter('referenceData.desktop',
                                                      desktop_id)
-        return self.get_local_session('DESKTOP', session_state, query_filter)
+        return self.get_local_session('DESKTOP', session_state, query_filter,
+                                      prefetch)
 
     def get_desktop_session_count(self, session_state, desktop_name):
         '''
@@ -2918,20 +4700,39 @@ class Sessions(ViewBase):
         :param desktop_name:
         :return:
         '''
-        sessions = self.get_desktop_sessions(session_state, desktop_name)
-        return len(sessions)
+        return self.count_desktop_sessions(session_state,
+                                           [desktop_name])[desktop_name]
+
+    def count_desktop_sessions(self, session_state, desktop_names):
+        '''
+        Count the desktop sessions matching given state of many pools, without
+        keeping the sessions
+        :param session_state:
+        :param desktop_names:
+        :return: the session count of each pool name
+        '''
+        desktop_ids = self.desktops.get_desktop_ids(desktop_names)
+        counts = self.queries.count_by_ref(
+            'SessionLocalSummaryView', 'referenceData.desktop',
+            desktop_ids.values(),
+            lambda session: session.referenceData.desktop.id,
+            self.get_session_filter('DESKTOP', session_state, None))
+        return dict((desktop_name, counts.get(desktop_id.id, 0))
+                    for desktop_name, desktop_id in desktop_ids.items())
 
-    def get_app_sessions(self, session_state, app_name):
+    def get_app_sessions(self, session_state, app_name, prefetch=0):
         '''
         Fetch application sessions matching given state and app name
         :param session_state:
         :param app_name:
+        :param prefetch: the number of result pages to read ahead
         :return:
         '''
         farm_id = self.apps.get_farm_id_by_app_name(app_name)
         query_filter = self.queries.get_equal_filter('referenceData.farm',
                                                      farm_id)
-        return self.get_local_session('APPLICATION', session_state, query_filter)
+        return self.get_local_session('APPLICATION', session_state, query_filter,
+                                      prefetch)
 
     def get_app_session_count(self, session_state, app_name):
         '''
@@ -2941,8 +4742,28 @@ class Sessions(ViewBase):
         :param app_name:
         :return:
         '''
-        sessions = self.get_app_sessions(session_state, app_name)
-        return len(sessions)
+        return self.count_app_sessions(session_state, [app_name])[app_name]
+
+    def count_app_sessions(self, session_state, app_names):
+        '''
+        Count the app sessions matching given state of many apps, without
+        keeping the sessions. Sessions are counted per farm, so apps of the
+        same farm get the same count.
+        :param session_state:
+        :param app_names:
+        :return: the session count of each app name
+        '''
+        farm_ids = dict((app_name, self.apps.get_farm_id_by_app_name(app_name))
+                        for app_name in app_names)
+        unique_farm_ids = dict((farm_id.id, farm_id)
+                               for farm_id in farm_ids.values())
+        counts = self.queries.count_by_ref(
+            'SessionLocalSummaryView', 'referenceData.farm',
+            unique_farm_ids.values(),
+            lambda session: session.referenceData.farm.id,
+            self.get_session_filter('APPLICATION', session_state, None))
+        return dict((app_name, counts.get(farm_id.id, 0))
+                    for app_name, farm_id in farm_ids.items())
 
 
 class View(ISession):
@@ -2950,6 +4771,17 @@ class View(ISession):
     Wrapper for all View APIs
     '''
 
+    lookups = Shared(LookupCache)
+    global_settings = Helper('GlobalSettings')
+    desktops = Helper('Desktops')
+    sessions = Helper('Sessions')
+    vc = Helper('VC')
+    misc = Helper('Misc')
+    connection_servers = Helper('ConnectionServer')
+    instantclonedomain = Helper('InstantCloneDomain')
+    farms = Helper('Farms')
+    apps = Helper('Apps')
+
     def __init__(self, host, user, password, domain, wsdl_file):
         '''
         Constructor
@@ -2958,6 +4790,8 @@ class View(ISession):
         self.user = user
         self.password = password
         self.domain = domain
+        ## as given, to create other sessions
+        self.wsdl_path = wsdl_file
         self.wsdl_file = wsdl_file
         if self.wsdl_file.startswith('/'):
             self.wsdl_file = self.wsdl_file[1:]
@@ -2968,57 +4802,57 @@ class View(ISession):
         self.sud = Suds(self.wsdl_file, 'https://' + host + '/view-vlsi/sdk')
         self.viewapi = self.sud.get_svc()
 
-        self.global_settings = GlobalSettings(self.sud)
-        self.desktops = Desktops(self.sud)
-        self.sessions = Sessions(self.sud)
-        self.vc = VC(self.sud)
-        self.misc = Misc(self.sud)
-        self.connection_servers = ConnectionServer(self.sud)
-        self.instantclonedomain = InstantCloneDomain(self.sud)
-        self.farms = Farms(self.sud)
-        self.apps = Apps(self.sud)
+        ## helpers are built on first access and shared by all of them
+        self.helpers = {}
 
     def get_session_key(self):
         return 'ViewAPI|' + self.host + '|' + self.user
 
+    def new_session(self):
+        '''
+        Create another View client with its own SOAP session, not logged in
+        :return:
+        '''
+        return View(self.host, self.user, self.password, self.domain,
+                    self.wsdl_path)
+
     def is_logged_in(self):
-        # temporarily disable error logging from suds.client while checking
-        from logging import NullHandler
-        handler = NullHandler()
-        logger = logging.getLogger('suds.client')
-        propagate = logger.propagate
-        logger.addHandler(handler)
-        logger.propagate = False
-        ret = False
+        # disable error logging from suds.client in this thread while checking
+        probe_log_filter.local.probing = True
         try:
             self.get_settings()
-            ret = True
+            return True
         except:
-            pass
+            return False
         finally:
-            logger.removeHandler(handler)
-            logger.propagate = propagate
-
-        return ret
+            probe_log_filter.local.probing = False
 
     def login(self):
         '''
         Login to View API
         :return:
         '''
-        if self.is_logged_in():
-            return
+        if not self.check_logged_in():
+            self.force_login()
+
+    def force_login(self):
+        '''
+        Login to View API without checking the session first
+        :return:
+        '''
         ss = self.sud.get_object('ns0:SecureString')
         ss.utf8String = base64.b64encode(self.password.encode('utf-8'))
         self.viewapi \
             .AuthenticationManager_Login(MOR.get_mor('AuthenticationManager'),
                                          self.user, ss, self.domain)
+        self.mark_alive()
 
     def logout(self):
         '''
         Logout of View API
         :return:
         '''
+        self.last_alive = 0
         self.viewapi \
             .AuthenticationManager_Logout(MOR.get_mor('AuthenticationManager'))
 
@@ -3047,6 +4881,21 @@ class View(ISession):
         self.login()
         return self.desktops.get_machines_in_state(desktop_name, machine_state)
 
+    def wait_machines_in_state(self, desktop_name, machine_state,
+                               machine_count=None, max_wait_sec=None):
+        '''
+        Wait for machines of given desktop to be in given state, see
+        Desktops.wait_machines_in_state
+        :param desktop_name:
+        :param machine_state:
+        :param machine_count:
+        :param max_wait_sec:
+        :return:
+        '''
+        self.login()
+        return self.desktops.wait_machines_in_state(
+            desktop_name, machine_state, machine_count, max_wait_sec)
+
     def get_rds_machines_in_state(self, rds_name, machine_state):
         '''
         Fetch rds servers in the given state
@@ -3078,15 +4927,37 @@ class View(ISession):
         return self.sessions.get_desktop_session_count(session_state,
                                                        desktop_name)
 
-    def get_desktop_sessions(self, session_state, desktop_name):
+    def count_desktop_sessions(self, session_state, desktop_names):
+        '''
+        Fetch the count of desktop sessions matching given state of many pools
+        :param session_state:
+        :param desktop_names:
+        :return: the session count of each pool name
+        '''
+        self.login()
+        return self.sessions.count_desktop_sessions(session_state,
+                                                    desktop_names)
+
+    def count_machines(self, desktop_names):
+        '''
+        Fetch the count of machines of each state of many pools
+        :param desktop_names:
+        :return: the machine count of each state of each pool name
+        '''
+        self.login()
+        return self.desktops.count_machines(desktop_names)
+
+    def get_desktop_sessions(self, session_state, desktop_name, prefetch=0):
         '''
         Fetch desktop session objects matching given state and desktop name
         :param session_state:
         :param desktop_name:
+        :param prefetch: the number of result pages to read ahead
         :return:
         '''
         self.login()
-        return self.sessions.get_desktop_sessions(session_state, desktop_name)
+        return self.sessions.get_desktop_sessions(session_state, desktop_name,
+                                                  prefetch)
 
     def get_app_session_count(self, session_state, app_name):
         '''
@@ -3099,15 +4970,27 @@ class View(ISession):
         return self.sessions.get_app_session_count(session_state,
                                                    app_name)
 
-    def get_app_sessions(self, session_state, app_name):
+    def count_app_sessions(self, session_state, app_names):
+        '''
+        Fetch the count of app sessions matching given state of many apps
+        :param session_state:
+        :param app_names:
+        :return: the session count of each app name
+        '''
+        self.login()
+        return self.sessions.count_app_sessions(session_state, app_names)
+
+    def get_app_sessions(self, session_state, app_name, prefetch=0):
         '''
         Fetch app session objects matching given state and app pool name
         :param session_state:
         :param app_name:
+        :param prefetch: the number of result pages to read ahead
         :return:
         '''
         self.login()
-        return self.sessions.get_app_sessions(session_state, app_name)
+        return self.sessions.get_app_sessions(session_state, app_name,
+                                              prefetch)
 
     def create_automated_desktop(self, pool_params):
         '''
@@ -3117,6 +5000,20 @@ class View(ISession):
         '''
         return self.desktops.create_automated_desktop(pool_params)
 
+    def create_pools(self, template_params, overrides_list,
+                     max_concurrency=BatchRunner.MAX_CONCURRENCY):
+        '''
+        Create many automated desktops from one template, see
+        Desktops.create_pools
+        :param template_params:
+        :param overrides_list:
+        :param max_concurrency:
+        :return: the outcome of each pool
+        '''
+        self.login()
+        return self.desktops.create_pools(template_params, overrides_list,
+                                          max_concurrency)
+
     def create_automated_full_desktop(self, pool_params):
         '''
         Create automated full clone desktop
@@ -3166,19 +5063,30 @@ class View(ISession):
         '''
         self.desktops.delete_by_name(desktop_name)
 
-    def delete_all_desktops(self):
+    def delete_all_desktops(self, max_concurrency=BatchRunner.MAX_CONCURRENCY,
+                            journal_path=None, wait=False):
         '''
-        Destroy all desktops
+        Destroy all desktops, see Desktops.delete_all
+        :param max_concurrency:
+        :param journal_path:
+        :param wait:
         :return:
         '''
-        self.desktops.delete_all(None)
+        return self.desktops.delete_all(None, max_concurrency, journal_path,
+                                        wait)
 
-    def delete_all_rds_desktops(self):
+    def delete_all_rds_desktops(self,
+                                max_concurrency=BatchRunner.MAX_CONCURRENCY,
+                                journal_path=None, wait=False):
         '''
-        Destroy all RDS desktops
+        Destroy all RDS desktops, see Desktops.delete_all
+        :param max_concurrency:
+        :param journal_path:
+        :param wait:
         :return:
         '''
-        self.desktops.delete_all('RDS')
+        return self.desktops.delete_all('RDS', max_concurrency, journal_path,
+                                        wait)
 
     def app_delete(self, app_name):
         '''
@@ -3249,6 +5157,114 @@ class View(ISession):
         '''
         self.desktops.push_image(pool_params)
 
+    def rolling_refresh_desktops(self, desktop_names,
+                                 max_concurrency=RollingWaves.MAX_CONCURRENCY,
+                                 max_offline_pct=RollingWaves.MAX_OFFLINE_PCT,
+                                 online_states=RollingWaves.ONLINE_STATES):
+        '''
+        Refresh many desktops in waves, see RollingWaves
+        :param desktop_names:
+        :param max_concurrency:
+        :param max_offline_pct:
+        :param online_states:
+        :return: the list of waves done
+        '''
+        return RollingWaves(self.desktops.refresh,
+                            self.desktops.count_machines, max_concurrency,
+                            max_offline_pct, poller=self.desktops.poller,
+                            online_states=online_states) \
+            .run(desktop_names)
+
+    def rolling_rebalance_desktops(self, desktop_names,
+                                   max_concurrency=RollingWaves.MAX_CONCURRENCY,
+                                   max_offline_pct=RollingWaves.MAX_OFFLINE_PCT,
+                                   online_states=RollingWaves.ONLINE_STATES):
+        '''
+        Rebalance many desktops in waves, see RollingWaves
+        :param desktop_names:
+        :param max_concurrency:
+        :param max_offline_pct:
+        :param online_states:
+        :return: the list of waves done
+        '''
+        return RollingWaves(self.desktops.rebalance,
+                            self.desktops.count_machines, max_concurrency,
+                            max_offline_pct, poller=self.desktops.poller,
+                            online_states=online_states) \
+            .run(desktop_names)
+
+    def rolling_recompose_desktops(self, desktop_names, vc_host, parent_vm,
+                                   parent_snapshot, stopOnFirstError=True,
+                                   max_concurrency=RollingWaves.MAX_CONCURRENCY,
+                                   max_offline_pct=RollingWaves.MAX_OFFLINE_PCT,
+                                   online_states=RollingWaves.ONLINE_STATES):
+        '''
+        Recompose many desktops on the same parent VM in waves, see
+        RollingWaves
+        :param desktop_names:
+        :param vc_host:
+        :param parent_vm:
+        :param parent_snapshot:
+        :param stopOnFirstError:
+        :param max_concurrency:
+        :param max_offline_pct:
+        :param online_states:
+        :return: the list of waves done
+        '''
+        def recompose(desktop_name):
+            self.desktops.recompose(desktop_name, vc_host, parent_vm,
+                                    parent_snapshot, stopOnFirstError)
+        return RollingWaves(recompose, self.desktops.count_machines,
+                            max_concurrency, max_offline_pct,
+                            poller=self.desktops.poller,
+                            online_states=online_states).run(desktop_names)
+
+    def rolling_push_image(self, pool_params_list,
+                           max_concurrency=RollingWaves.MAX_CONCURRENCY,
+                           max_offline_pct=RollingWaves.MAX_OFFLINE_PCT,
+                           online_states=RollingWaves.ONLINE_STATES):
+        '''
+        Push images to many instant clone pools in waves, see RollingWaves
+        :param pool_params_list: the params of each pool, as for push_image
+        :param max_concurrency:
+        :param max_offline_pct:
+        :param online_states:
+        :return: the list of waves done
+        '''
+        params_by_name = OrderedDict(
+            (pool_params['pool_settings']['pool_name'], pool_params)
+            for pool_params in pool_params_list)
+        return RollingWaves(
+            lambda pool_name: self.desktops.push_image(
+                params_by_name[pool_name]),
+            self.desktops.count_machines, max_concurrency, max_offline_pct,
+            poller=self.desktops.poller, online_states=online_states) \
+            .run(params_by_name.keys())
+
+    def rolling_recompose_farms(self, farm_params_list,
+                                max_concurrency=RollingWaves.MAX_CONCURRENCY,
+                                max_offline_pct=RollingWaves.MAX_OFFLINE_PCT,
+                                online_states=RollingWaves.ONLINE_STATES):
+        '''
+        Recompose many farms in waves, see RollingWaves. The RDS servers
+        count as the machines of a farm.
+        :param farm_params_list: the params of each farm, as for
+        recompose_farm
+        :param max_concurrency:
+        :param max_offline_pct:
+        :param online_states:
+        :return: the list of waves done
+        '''
+        params_by_name = OrderedDict(
+            (farm_params['farm_settings']['farm_name'], farm_params)
+            for farm_params in farm_params_list)
+        return RollingWaves(
+            lambda farm_name: self.farms.recompose_farm(
+                params_by_name[farm_name]),
+            self.farms.count_rds_servers, max_concurrency, max_offline_pct,
+            poller=self.farms.poller, online_states=online_states) \
+            .run(params_by_name.keys())
+
     def get_ad_user_or_group(self, user_or_group_login_name):
         '''
         Fetch the user or group given the name
@@ -3282,6 +5298,41 @@ class View(ISession):
         app_id = self.apps.get_app_id_by_name(app_name)
         return self.misc.entitle_user_or_group_to_app(app_id, user_or_group_login_name, domain_name)
 
+    def entitle_users_or_groups(self, desktop_names, login_names,
+                                domain_name=None,
+                                max_concurrency=BatchRunner.MAX_CONCURRENCY):
+        '''
+        Entitle every given user or group to every given desktop, see
+        Misc.entitle_many
+        :param desktop_names:
+        :param login_names:
+        :param domain_name:
+        :param max_concurrency:
+        :return: the outcome of each entitlement
+        '''
+        self.login()
+        desktop_ids = self.desktops.get_desktop_ids(desktop_names)
+        return self.misc.entitle_many(desktop_ids, login_names, domain_name,
+                                      max_concurrency)
+
+    def entitle_users_or_groups_to_apps(self, app_names, login_names,
+                                        domain_name=None,
+                                        max_concurrency=BatchRunner
+                                        .MAX_CONCURRENCY):
+        '''
+        Entitle every given user or group to every given app pool, see
+        Misc.entitle_many
+        :param app_names:
+        :param login_names:
+        :param domain_name:
+        :param max_concurrency:
+        :return: the outcome of each entitlement
+        '''
+        self.login()
+        app_ids = self.apps.resolve_app_ids(app_names)
+        return self.misc.entitle_many(app_ids, login_names, domain_name,
+                                      max_concurrency)
+
     def update_auto_recovery_disabled(self, desktop_id, val):
         '''
         Update the auto-recovery-disabled attribute of given desktop
@@ -3401,15 +5452,75 @@ class View(ISession):
         '''
         return self.desktops.get_desktop_id_by_name(desktop_name)
 
-    def get_machine_props_in_pool(self, pool_name):
+    def resolve_desktop_ids(self, desktop_names, width=None):
+        '''
+        Get the desktop ids of many pools at once
+        :param desktop_names:
+        :param width: the number of names per query
+        :return: the desktop id of each name
+        '''
+        return self.desktops.resolve_desktop_ids(desktop_names, width)
+
+    def get_farms_health(self, farm_names, width=None):
+        '''
+        Fetch the RDS server health of many farms at once
+        :param farm_names:
+        :param width: the number of farms per query
+        :return: the list of RDS server health of each farm name
+        '''
+        farm_ids = self.farms.resolve_farm_ids(farm_names, width)
+        health = self.farms.get_farms_health(farm_ids.values(), width)
+        return dict((farm_name, health[farm_id.id])
+                    for farm_name, farm_id in farm_ids.items())
+
+    def resolve_farm_ids(self, farm_names, width=None):
+        '''
+        Get the farm ids of many farms at once
+        :param farm_names:
+        :param width: the number of names per query
+        :return: the farm id of each name
+        '''
+        return self.farms.resolve_farm_ids(farm_names, width)
+
+    def resolve_app_ids(self, app_names, width=None):
+        '''
+        Get the app ids of many app pools at once
+        :param app_names:
+        :param width: the number of names per query
+        :return: the app id of each name
+        '''
+        return self.apps.resolve_app_ids(app_names, width)
+
+    def get_machine_props_in_pool(self, pool_name, prefetch=0):
         '''
         Calls get_all_machines_in_pool() from Desktop Class
         :param pool_name:
+        :param prefetch: the number of result pages to read ahead
         :return: Machine properties in the form of a dictionary
         Key- Machine Name
         Attributes include View Agent State, Computer FQDN
         '''
-        return self.desktops.get_all_machines_in_pool(pool_name)
+        return self.desktops.get_all_machines_in_pool(pool_name, prefetch)
+
+    def get_lookup_stats(self):
+        '''
+        Fetch the hit/miss counters of the name to ID lookup cache
+        :return:
+        '''
+        return self.lookups.get_stats()
+
+    def refresh_vc_inventory(self, vc_host=None):
+        '''
+        Drop the cached VM, template and snapshot lists of given VC, e.g.
+        after taking a new snapshot of a base image
+        :param vc_host: None to drop the lists of all VCs
+        :return:
+        '''
+        vc_id = None
+        if vc_host:
+            vc_id = self.vc.get_id(vc_host)
+            Validation.validate_param(vc_id, 'VC ' + vc_host + ' is not found')
+        self.vc.refresh_inventory(vc_id)
 
     def enable_saml(self,name):
         '''
@@ -3429,19 +5540,26 @@ class ConnectionServer(ViewBase):
         return 'ConnectionServer'
 
     def wait_server(self, name):
-        MAX_WAIT_SEC = Timings().get_timeout_sec_4()
-        start_time = datetime.now()
-        elapsed = 0
-        msg = self.get_host() + ': waiting for connection server [' + name \
-              + '] to be ready'
-
-        while elapsed < MAX_WAIT_SEC:
-            svr = self.get_server_by_name(name)
-            if svr:
-                return svr
-            time.sleep(Timings().get_task_wait_interval_sec_3())
-            elapsed = (datetime.now() - start_time).total_seconds()
-            logging.debug(msg)
+        '''
+        Wait until the given connection server is listed. Concurrent waits
+        share one listing per poll.
+        :param name: this is the name displayed in the View admin UI under
+        View configuration/Servers/Connection Servers
+        :return: the connection server object, None if timed out
+        '''
+        lower_name = name.lower()
+
+        def find(servers):
+            for server in servers:
+                if server.general.name.lower() == lower_name:
+                    return server
+
+        return self.poller.wait(
+            ('ConnectionServer', None),
+            lambda: self.viewapi.ConnectionServer_List(self.mor), find,
+            Timings().get_timeout_sec_4(),
+            self.get_host() + ': waiting for connection server [' + name
+            + '] to be ready')
 
     def get_server_by_name(self, name):
         '''
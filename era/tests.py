@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import time
+import unittest
+
+from suds.sudsobject import Object
+
+from core import Suds
+from pyview import LookupCache
+from pyview import Queries
+
+WSDL = 'file:///' + os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'misc',
+    'wsdl', 'vdi', 'viewApiService.wsdl').lstrip('/')
+
+
+class QueryServiceStub(object):
+    '''
+    Serves a fixed number of pages per query, recording the calls
+    '''
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.remaining = {}
+        self.fetched = 0
+        self.deleted = []
+        self.lock = threading.Lock()
+
+    def page(self, query_id):
+        ret = Object()
+        ret.id = query_id
+        with self.lock:
+            if self.remaining[query_id]:
+                self.remaining[query_id] -= 1
+                self.fetched += 1
+                ret.results = [query_id]
+        return ret
+
+    def QueryService_Create(self, mor, query_def):
+        query_id = len(self.remaining) + len(self.deleted)
+        self.remaining[query_id] = self.pages
+        return self.page(query_id)
+
+    def QueryService_GetNext(self, mor, query_id):
+        return self.page(query_id)
+
+    def QueryService_Delete(self, mor, query_id):
+        del self.remaining[query_id]
+        self.deleted.append(query_id)
+
+
+class StubSuds(Suds):
+    '''
+    Builds the service objects from the real schema, calls the stub
+    '''
+
+    def __init__(self, service):
+        Suds.__init__(self, WSDL, 'https://localhost/view-vlsi/sdk', 0)
+        self.service = service
+
+    def get_svc(self):
+        return self.service
+
+
+class PagesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.service = QueryServiceStub(10)
+        self.queries = Queries(StubSuds(self.service))
+
+    def read_first_page(self, prefetch):
+        '''
+        Read the first page, then stop
+        :return: the number of pages fetched
+        '''
+        start = self.service.fetched
+        pages = self.queries.pages(None, 'MachineNamesView',
+                                   prefetch=prefetch)
+        next(pages)
+        ## leave the reader time to fill the queue
+        time.sleep(0.2)
+        fetched = self.service.fetched - start
+        pages.close()
+        return fetched
+
+    def test_stop_early_deletes_query(self):
+        for prefetch in (0, 1, 3):
+            self.read_first_page(prefetch)
+        self.assertEqual(self.service.deleted, [0, 1, 2])
+        self.assertEqual(self.service.remaining, {})
+
+    def test_read_ahead_depth(self):
+        self.assertEqual(self.read_first_page(0), 1)
+        self.assertEqual(self.read_first_page(3), 1 + 3)
+        self.assertEqual(self.read_first_page(1), 1 + 2)
+
+    def test_read_all(self):
+        for prefetch in (0, 2):
+            pages = list(self.queries.pages(None, 'MachineNamesView',
+                                            prefetch=prefetch))
+            self.assertEqual(len(pages), 10)
+
+
+
+class LookupCacheTest(unittest.TestCase):
+
+    def test_peek_does_not_count(self):
+        cache = LookupCache()
+        self.assertIsNone(cache.peek('desktop', 'pool'))
+        cache.put('desktop', 'pool', 'id')
+        self.assertEqual(cache.peek('desktop', 'pool'), 'id')
+        self.assertEqual(cache.get_stats(),
+                         {'hits': 0, 'misses': 0, 'size': 1})
+        self.assertEqual(cache.get('desktop', 'pool', lambda: None), 'id')
+        self.assertEqual(cache.get_stats()['hits'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()